@@ -0,0 +1,42 @@
+"""presence session history
+
+Revision ID: 3c1f0a9d2b47
+Revises: 8ae058b05aaf
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1f0a9d2b47'
+down_revision: Union[str, Sequence[str], None] = '8ae058b05aaf'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'presence_session',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('device_id', sa.Integer(), nullable=False),
+        sa.Column('tracked_entity_id', sa.Integer(), nullable=False),
+        sa.Column('start_datetime', sa.DateTime(), nullable=False),
+        sa.Column('end_datetime', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['device_id'], ['device.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['tracked_entity_id'], ['tracked_entity.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_presence_session_open', 'presence_session', ['device_id', 'end_datetime'])
+    op.create_index(op.f('ix_presence_session_tracked_entity_id'), 'presence_session', ['tracked_entity_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_presence_session_tracked_entity_id'), table_name='presence_session')
+    op.drop_index('ix_presence_session_open', table_name='presence_session')
+    op.drop_table('presence_session')
@@ -0,0 +1,50 @@
+"""occupancy rollups
+
+Revision ID: 5e2b7c4a9f10
+Revises: 3c1f0a9d2b47
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2b7c4a9f10'
+down_revision: Union[str, Sequence[str], None] = '3c1f0a9d2b47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'hourly_occupancy',
+        sa.Column('hour_start', sa.DateTime(), nullable=False),
+        sa.Column('entities', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('hour_start'),
+    )
+    op.create_table(
+        'hourly_presence',
+        sa.Column('hour_start', sa.DateTime(), nullable=False),
+        sa.Column('tracked_entity_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['tracked_entity_id'], ['tracked_entity.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('hour_start', 'tracked_entity_id'),
+    )
+    op.create_table(
+        'daily_presence',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('tracked_entity_id', sa.Integer(), nullable=False),
+        sa.Column('seconds', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['tracked_entity_id'], ['tracked_entity.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('day', 'tracked_entity_id'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_presence')
+    op.drop_table('hourly_presence')
+    op.drop_table('hourly_occupancy')
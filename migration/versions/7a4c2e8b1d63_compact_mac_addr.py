@@ -0,0 +1,61 @@
+"""store MAC addresses as 48-bit integers, index MACs and names
+
+Revision ID: 7a4c2e8b1d63
+Revises: 5e2b7c4a9f10
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7a4c2e8b1d63'
+down_revision: Union[str, Sequence[str], None] = '5e2b7c4a9f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.alter_column(
+        'device', 'mac_addr',
+        type_=sa.BigInteger(),
+        existing_type=sa.String(length=17),
+        existing_nullable=False,
+        postgresql_using="('x' || lpad(regexp_replace(lower(mac_addr), '[:.-]', '', 'g'), 16, '0'))::bit(64)::bigint",
+    )
+    # Normalising may have revealed the same device registered twice. Only a
+    # duplicate of the same entity can go, others need a person to decide.
+    conflicts = op.get_bind().execute(sa.text(
+        "SELECT a.mac_addr, b.id, b.tracked_entity_id, a.id, a.tracked_entity_id FROM device a "
+        "JOIN device b ON a.mac_addr = b.mac_addr AND a.id > b.id AND a.tracked_entity_id <> b.tracked_entity_id "
+        "ORDER BY a.mac_addr, b.id, a.id"
+    )).all()
+    if conflicts:
+        rows = "\n".join(
+            f"  {mac_addr:012x}: device {first_id} of entity {first_entity}, device {id} of entity {entity}"
+            for (mac_addr, first_id, first_entity, id, entity) in conflicts
+        )
+        raise RuntimeError(f"Devices of different tracked entities share a MAC address, resolve these first:\n{rows}")
+    op.execute(
+        "DELETE FROM device a USING device b "
+        "WHERE a.mac_addr = b.mac_addr AND a.tracked_entity_id = b.tracked_entity_id AND a.id > b.id"
+    )
+    op.create_index(op.f('ix_device_mac_addr'), 'device', ['mac_addr'], unique=True)
+    op.create_index(op.f('ix_tracked_entity_name'), 'tracked_entity', ['name'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_tracked_entity_name'), table_name='tracked_entity')
+    op.drop_index(op.f('ix_device_mac_addr'), table_name='device')
+    op.alter_column(
+        'device', 'mac_addr',
+        type_=sa.String(length=17),
+        existing_type=sa.BigInteger(),
+        existing_nullable=False,
+        postgresql_using="regexp_replace(lpad(to_hex(mac_addr), 12, '0'), '(..)(?!$)', '\\1:', 'g')",
+    )
@@ -1,5 +1,8 @@
 """empty message
 
+Databases that predate the migrations got their tables from
+Base.metadata.create_all, so the tables are only created when missing.
+
 Revision ID: 8ae058b05aaf
 Revises: 
 Create Date: 2025-12-04 16:03:09.047295
@@ -20,11 +23,49 @@ depends_on: Union[str, Sequence[str], None] = None
 
 def upgrade() -> None:
     """Upgrade schema."""
-    # ### commands auto generated by Alembic - please adjust! ###
-    # ### end Alembic commands ###
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'tracked_entity' not in existing:
+        op.create_table(
+            'tracked_entity',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=20), nullable=False),
+            sa.Column('created_datetime', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    if 'group' not in existing:
+        op.create_table(
+            'group',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('created_date', sa.Date(), nullable=False),
+            sa.Column('name', sa.String(length=255), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    if 'device' not in existing:
+        op.create_table(
+            'device',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('mac_addr', sa.String(length=17), nullable=False),
+            sa.Column('name', sa.String(length=20), nullable=True),
+            sa.Column('hostname', sa.String(length=255), nullable=True),
+            sa.Column('tracked_entity_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['tracked_entity_id'], ['tracked_entity.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    if 'membership' not in existing:
+        op.create_table(
+            'membership',
+            sa.Column('tracked_entity_id', sa.Integer(), nullable=False),
+            sa.Column('group_id', sa.Integer(), nullable=False),
+            sa.Column('joined_date', sa.Date(), nullable=False),
+            sa.ForeignKeyConstraint(['group_id'], ['group.id']),
+            sa.ForeignKeyConstraint(['tracked_entity_id'], ['tracked_entity.id']),
+            sa.PrimaryKeyConstraint('tracked_entity_id', 'group_id'),
+        )
 
 
 def downgrade() -> None:
     """Downgrade schema."""
-    # ### commands auto generated by Alembic - please adjust! ###
-    # ### end Alembic commands ###
+    op.drop_table('membership')
+    op.drop_table('device')
+    op.drop_table('group')
+    op.drop_table('tracked_entity')
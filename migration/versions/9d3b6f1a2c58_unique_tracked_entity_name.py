@@ -0,0 +1,51 @@
+"""make tracked entity names unique
+
+Revision ID: 9d3b6f1a2c58
+Revises: 7a4c2e8b1d63
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d3b6f1a2c58'
+down_revision: Union[str, Sequence[str], None] = '7a4c2e8b1d63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Racing sign-ups may have created the same name twice, suffix the later ones with their id
+    connection = op.get_bind()
+    rows = connection.execute(sa.text("SELECT id, name FROM tracked_entity ORDER BY id")).all()
+    taken = {name for (_, name) in rows}
+    kept = set()
+    for (id, name) in rows:
+        if name not in kept:
+            kept.add(name)
+            continue
+        # The suffixed name may itself be taken, count on until it isn't
+        attempt = 0
+        while True:
+            suffix = str(id) if attempt == 0 else f"{id}{attempt}"
+            new_name = name[:20 - len(suffix)] + suffix
+            if new_name not in taken:
+                break
+            attempt += 1
+        taken.add(new_name)
+        connection.execute(
+            sa.text("UPDATE tracked_entity SET name = :name WHERE id = :id"), {"name": new_name, "id": id}
+        )
+    op.drop_index(op.f('ix_tracked_entity_name'), table_name='tracked_entity')
+    op.create_index(op.f('ix_tracked_entity_name'), 'tracked_entity', ['name'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_tracked_entity_name'), table_name='tracked_entity')
+    op.create_index(op.f('ix_tracked_entity_name'), 'tracked_entity', ['name'])
@@ -0,0 +1,35 @@
+"""shared lease snapshot for multi-worker mode
+
+Revision ID: b6e1d4f7a3c9
+Revises: 9d3b6f1a2c58
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e1d4f7a3c9'
+down_revision: Union[str, Sequence[str], None] = '9d3b6f1a2c58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'shared_lease_snapshot',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('generation', sa.BigInteger(), nullable=False),
+        sa.Column('leases', sa.String(), nullable=False),
+        sa.Column('updated_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('shared_lease_snapshot')
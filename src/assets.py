@@ -0,0 +1,243 @@
+"""Fingerprinted, precompressed static assets.
+
+`python -m src.assets` copies everything under static/ to static/build/
+with a content hash in the file name, next to gzip and brotli variants and
+a WOFF2 subset of each TrueType font. The Docker image runs it at build
+time. The app only reads the manifest, without one that matches the
+sources it serves the assets unfingerprinted.
+"""
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from fontTools import subset as font_subset
+    from fontTools.ttLib import TTFont
+except ImportError:
+    font_subset = None
+
+logger = logging.getLogger(__name__)
+
+BUILD_DIR = "build"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".ttf", ".txt", ".json", ".ico"}
+# Latin-1 and the usual punctuation covers Finnish and English text
+FONT_SUBSET_UNICODES = [*range(0x20, 0x7F), *range(0xA0, 0x100), *range(0x2010, 0x2028),
+                        0x2030, 0x2039, 0x203A, 0x20AC, 0x2122]
+# Preferred first
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+_CSS_URL = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+def fingerprint(path: str, data: bytes) -> str:
+    (stem, suffix) = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{suffix}"
+
+
+def woff2_subset(data: bytes) -> bytes | None:
+    if font_subset is None or brotli is None:
+        logger.warning("fonttools and brotli are needed for WOFF2 subsets, skipping")
+        return None
+    options = font_subset.Options()
+    options.flavor = "woff2"
+    options.layout_features = ["*"]
+    font = TTFont(io.BytesIO(data))
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(unicodes=FONT_SUBSET_UNICODES)
+    subsetter.subset(font)
+    output = io.BytesIO()
+    font.save(output)
+    return output.getvalue()
+
+
+def compressed_variants(data: bytes) -> dict[str, bytes]:
+    variants = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return {encoding: variant for encoding, variant in variants.items() if len(variant) < len(data)}
+
+
+class StaticAssets():
+    """Manifest of the built assets, mapping source paths to fingerprinted ones."""
+
+    def __init__(self, directory: str = "static", url_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.build_directory = os.path.join(directory, BUILD_DIR)
+        self.assets: dict[str, str] = {}
+        self.built: frozenset[str] = frozenset()
+        self.digest = ""
+        # Fingerprinted path -> encodings it has a precompressed variant for
+        self.variants: dict[str, frozenset[str]] = {}
+
+
+    def url(self, path: str) -> str:
+        path = path.lstrip("/")
+        if (built := self.assets.get(path)) is not None:
+            return f"{self.url_prefix}/{BUILD_DIR}/{built}"
+        return f"{self.url_prefix}/{path}"
+
+
+    def _sources(self) -> dict[str, bytes]:
+        sources = {}
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory and BUILD_DIR in dirs:
+                dirs.remove(BUILD_DIR)
+            for name in files:
+                full_path = os.path.join(root, name)
+                with open(full_path, "rb") as f:
+                    sources[os.path.relpath(full_path, self.directory).replace(os.sep, "/")] = f.read()
+        return sources
+
+
+    @staticmethod
+    def _digest(sources: dict[str, bytes]) -> str:
+        digest = hashlib.sha256()
+        for path in sorted(sources):
+            digest.update(path.encode() + b"\0" + hashlib.sha256(sources[path]).digest())
+        return digest.hexdigest()
+
+
+    def load(self):
+        """Load the manifest, if it was built from the current sources.
+
+        Never builds, several workers importing the app would race to write
+        the same files.
+        """
+        digest = self._digest(self._sources())
+        try:
+            with open(os.path.join(self.build_directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = None
+        if manifest is None or manifest.get("sources") != digest:
+            logger.warning("No static asset build for the current sources, run python -m src.assets")
+            manifest = {"assets": {}, "variants": {}}
+        self.digest = digest
+        self.assets = manifest["assets"]
+        self.built = frozenset(self.assets.values())
+        self.variants = {path: frozenset(encodings) for path, encodings in manifest["variants"].items()}
+
+
+    def build(self, sources: dict[str, bytes] | None = None, digest: str | None = None) -> dict:
+        sources = sources if sources is not None else self._sources()
+        digest = digest or self._digest(sources)
+        for path, data in list(sources.items()):
+            if path.endswith(".ttf") and (woff2 := woff2_subset(data)) is not None:
+                sources[path.removesuffix(".ttf") + ".woff2"] = woff2
+
+        assets: dict[str, str] = {}
+        outputs: dict[str, bytes] = {}
+        # Stylesheets last, their url()s point at the fingerprinted names
+        for path in sorted(sources, key=lambda path: path.endswith(".css")):
+            data = sources[path]
+            if path.endswith(".css"):
+                data = self._rewrite_css(path, data.decode(), assets).encode()
+            assets[path] = fingerprint(path, data)
+            outputs[assets[path]] = data
+
+        variants: dict[str, list[str]] = {}
+        os.makedirs(self.build_directory, exist_ok=True)
+        for built, data in outputs.items():
+            files = {built: data}
+            if os.path.splitext(built)[1] in COMPRESSIBLE:
+                for encoding, variant in compressed_variants(data).items():
+                    files[built + ENCODINGS[encoding]] = variant
+                    variants.setdefault(built, []).append(encoding)
+            for name, content in files.items():
+                full_path = os.path.join(self.build_directory, name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                with open(full_path, "wb") as f:
+                    f.write(content)
+
+        manifest = {"sources": digest, "assets": assets, "variants": variants}
+        with open(os.path.join(self.build_directory, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        logger.info("Built %d static assets into %s", len(assets), self.build_directory)
+        return manifest
+
+
+    @staticmethod
+    def _rewrite_css(path: str, css: str, assets: dict[str, str]) -> str:
+        base = os.path.dirname(path)
+
+        def replace(match: re.Match) -> str:
+            url = match.group(2).strip()
+            if url.startswith(("data:", "http:", "https:", "//", "#")):
+                return match.group(0)
+            target = os.path.normpath(os.path.join(base, url)).replace(os.sep, "/")
+            if target not in assets:
+                return match.group(0)
+            # The build keeps the source layout, so the relative URL only changes name
+            return f"url({os.path.relpath(assets[target], base or '.').replace(os.sep, '/')})"
+
+        return _CSS_URL.sub(replace, css)
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    accepted = set()
+    for item in accept_encoding.split(","):
+        (coding, _, params) = item.strip().partition(";")
+        if not coding:
+            continue
+        quality = params.strip().removeprefix("q=")
+        try:
+            if params and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class AssetStaticFiles(StaticFiles):
+    """StaticFiles serving fingerprinted assets precompressed and cached forever.
+
+    Anything outside the build directory is served as before, revalidated
+    with ETag and Last-Modified.
+    """
+
+    def __init__(self, assets: StaticAssets, **kwargs):
+        super().__init__(directory=assets.directory, **kwargs)
+        self.static_assets = assets
+
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        built = os.path.relpath(full_path, self.static_assets.build_directory).replace(os.sep, "/")
+        if built not in self.static_assets.built:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        encodings = self.static_assets.variants.get(built)
+
+        headers = {"Cache-Control": IMMUTABLE}
+        if encodings:
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+            for encoding, suffix in ENCODINGS.items():
+                if encoding in encodings and encoding in accepted:
+                    headers["Content-Encoding"] = encoding
+                    return FileResponse(full_path + suffix, status_code=status_code, headers=headers,
+                                        media_type=mimetypes.guess_type(full_path)[0])
+        return FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("fontTools").setLevel(logging.WARNING)
+    StaticAssets().build()
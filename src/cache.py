@@ -0,0 +1,186 @@
+import bisect
+import time
+from typing import Callable, Iterable
+
+
+class PresenceNamesCache():
+    """Names of the present tracked entities, computed once per lease snapshot.
+
+    Entries are keyed by the lease snapshot generation and the name table
+    generation. Writes to tracked entities bump the latter through
+    invalidate(), which makes every older entry unreachable.
+    """
+
+    def __init__(self):
+        # Clock based like snapshot generations, a restart must not repeat an ETag
+        self.generation = time.time_ns() // 1000
+        self._key: tuple[int, int] | None = None
+        self._names: list[str] = []
+
+
+    def key(self, snapshot_generation: int) -> tuple[int, int]:
+        return (snapshot_generation, self.generation)
+
+
+    def get(self, key: tuple[int, int]) -> list[str] | None:
+        if key == self._key:
+            return self._names
+        return None
+
+
+    def set(self, key: tuple[int, int], names: list[str]):
+        # A write may have landed while the names were being queried
+        if key[1] == self.generation:
+            self._key = key
+            self._names = names
+
+
+    def invalidate(self):
+        self.generation += 1
+        self._key = None
+
+
+class RosterCache(PresenceNamesCache):
+    """Group rosters, computed once per lease snapshot.
+
+    Keyed like the present names, plus a membership generation bumped by
+    membership writes through invalidate().
+    """
+
+    def __init__(self, names: PresenceNamesCache):
+        super().__init__()
+        self._presence_names = names
+
+
+    def key(self, snapshot_generation: int) -> tuple[int, int, int]:
+        return (snapshot_generation, self.generation, self._presence_names.generation)
+
+
+    def set(self, key: tuple[int, int, int], rosters):
+        if key[2] == self._presence_names.generation:
+            super().set(key, rosters)
+
+
+class IdentityCache():
+    """Tracked entity records resolved for a MAC address.
+
+    Holds plain column values rather than ORM instances, so that no session
+    ever shares its objects with another. Unknown MAC addresses are cached
+    as an empty record so unregistered visitors don't hit the database
+    either. Any write clears the cache and bumps its generation.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self._max_size = max_size
+        self._entries: dict[str, tuple] = {}
+        self.generation = 0
+
+
+    def get(self, mac_addr: str) -> tuple | None:
+        return self._entries.get(mac_addr)
+
+
+    def set(self, mac_addr: str, identity: tuple, generation: int):
+        # A write may have landed while the identity was being queried
+        if generation != self.generation:
+            return
+        if len(self._entries) >= self._max_size:
+            del self._entries[next(iter(self._entries))]
+        self._entries[mac_addr] = identity
+
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
+class NameIndex():
+    """Tracked entity names sorted case-insensitively, for prefix lookups.
+
+    Loaded from the database at startup and kept up to date by the writes
+    of this process. A write in another worker process marks it unloaded
+    until the cluster has loaded it again.
+    """
+
+    def __init__(self):
+        self._entries: list[tuple[str, str]] = []
+        self.loaded = False
+        self.generation = 0
+
+
+    def load(self, names: Iterable[str], generation: int):
+        self._entries = sorted((name.casefold(), name) for name in names)
+        # A write that landed while the names were being queried isn't in them
+        self.loaded = generation == self.generation
+
+
+    def add(self, name: str):
+        self.generation += 1
+        entry = (name.casefold(), name)
+        i = bisect.bisect_left(self._entries, entry)
+        if i == len(self._entries) or self._entries[i] != entry:
+            self._entries.insert(i, entry)
+
+
+    def discard(self, name: str):
+        self.generation += 1
+        entry = (name.casefold(), name)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+
+    def complete(self, prefix: str, limit: int = 10) -> list[str]:
+        prefix = prefix.casefold()
+        names = []
+        for i in range(bisect.bisect_left(self._entries, (prefix,)), len(self._entries)):
+            (key, name) = self._entries[i]
+            if not key.startswith(prefix) or len(names) == limit:
+                break
+            names.append(name)
+        return names
+
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded = False
+
+
+presence_names = PresenceNamesCache()
+identities = IdentityCache()
+rosters = RosterCache(presence_names)
+name_index = NameIndex()
+
+
+_invalidation_listeners: list[tuple[Callable[[str], None], bool]] = []
+
+
+def subscribe_invalidations(listener: Callable[[str], None], remote: bool = False) -> Callable[[], None]:
+    """Call listener with the scope of every local invalidation, to pass it on to other workers.
+
+    With remote the listener also hears the invalidations other workers
+    passed on, for reacting to any write wherever it happened.
+    """
+    entry = (listener, remote)
+    _invalidation_listeners.append(entry)
+    return lambda: _invalidation_listeners.remove(entry)
+
+
+def invalidate(scope: str, broadcast: bool = True):
+    """Drop what a write made stale, scope is "entities" or "memberships".
+
+    broadcast is False for invalidations received from other workers.
+    """
+    if scope == "entities":
+        presence_names.invalidate()
+        identities.clear()
+        if not broadcast:
+            # Written by another worker, our own writes keep the index current
+            name_index.invalidate()
+    elif scope == "memberships":
+        rosters.invalidate()
+    else:
+        raise ValueError(f"Unknown cache scope: {scope}")
+    for (listener, remote) in tuple(_invalidation_listeners):
+        if broadcast or remote:
+            listener(scope)
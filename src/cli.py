@@ -0,0 +1,109 @@
+"""Maintenance commands, run with `python -m src.cli <command>`.
+
+The database defaults to the one the app uses, configured the same way
+through POSTGRES_USER, POSTGRES_DB and the postgres-passwd secret.
+DATABASE_URL or --database-url overrides it.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+import src.replay as replay
+import src.transfer as transfer
+
+
+def _database_url(url: str | None) -> str:
+    if url:
+        return url
+    from src.database import DB_URL
+    return make_url(DB_URL).set(drivername="postgresql+psycopg2").render_as_string(hide_password=False)
+
+
+def import_legacy(args: argparse.Namespace):
+    engine = create_engine(_database_url(args.database_url))
+    counts = transfer.import_legacy(args.legacy_db, engine, args.batch_size, progress=args.progress)
+    print(f"Imported {counts['tracked_entities']} tracked entities and {counts['devices']} devices, "
+          f"skipped {counts['skipped']} invalid devices")
+
+
+def export(args: argparse.Namespace):
+    engine = create_engine(_database_url(args.database_url))
+    if args.output == "-":
+        transfer.export(engine, args.table, sys.stdout, args.format, args.batch_size, progress=args.progress)
+        return
+    with open(args.output, "w", newline="") as out:
+        transfer.export(engine, args.table, out, args.format, args.batch_size, progress=args.progress)
+
+
+def replay_leases(args: argparse.Namespace):
+    if args.recording:
+        captures = replay.read_recording(args.recording)
+    else:
+        captures = replay.synthetic_captures(args.synthetic, args.devices, args.hours, args.interval, args.churn)
+    server = replay.ReplayServer(captures, args.speed)
+    try:
+        asyncio.run(_serve_replay(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve_replay(server: replay.ReplayServer, host: str, port: int):
+    runner = await server.serve(host, port)
+    try:
+        for (i, source) in enumerate(server.sources):
+            print(f"{source}: http://{host}:{server.port}/leases/{i}")
+        print(f"Replaying {(server.end - server.start) / 3600:.1f} h at {server.speed:g}x, Ctrl-C stops")
+        while not server.finished:
+            await asyncio.sleep(1)
+        print(f"Replay finished after {server.requests} requests, serving the last tables until stopped")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src.cli")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"),
+                        help="SQLAlchemy URL of the target database, with a sync driver")
+    parser.add_argument("--batch-size", type=int, default=transfer.BATCH_SIZE)
+    parser.add_argument("--quiet", dest="progress", action="store_const",
+                        const=lambda label: transfer.Progress(label, out=None), default=transfer.Progress,
+                        help="don't report progress")
+    commands = parser.add_subparsers(required=True, metavar="command")
+
+    command = commands.add_parser("import-legacy", help="load the old SQLite database, safe to rerun")
+    command.add_argument("legacy_db", help="path to the old seuranta.db")
+    command.set_defaults(run=import_legacy)
+
+    command = commands.add_parser("export", help="dump a table as CSV or JSON lines")
+    command.add_argument("table", choices=sorted(transfer.EXPORTS))
+    command.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    command.add_argument("-o", "--output", default="-", help="file to write, stdout by default")
+    command.set_defaults(run=export)
+
+    command = commands.add_parser("replay-leases", help="serve recorded or synthetic lease tables as a fake router")
+    command.add_argument("recording", nargs="?", help="file recorded with LEASE_RECORD_FILE")
+    command.add_argument("--synthetic", choices=replay.PROFILES, default="day",
+                         help="churn profile served without a recording")
+    command.add_argument("--devices", type=int, default=200)
+    command.add_argument("--hours", type=float, default=24)
+    command.add_argument("--interval", type=float, default=15, help="seconds between synthetic tables")
+    command.add_argument("--churn", type=float, default=0.02, help="share of present devices swapped per table")
+    command.add_argument("--speed", type=float, default=60, help="replayed seconds per real second")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8080)
+    command.set_defaults(run=replay_leases)
+    return parser
+
+
+def main(argv: list[str] | None = None):
+    args = parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import datetime
+import json
+import logging
+from typing import Awaitable, Callable
+
+import asyncpg
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+import src.crud as crud
+import src.models as models
+from src.cache import invalidate, name_index, subscribe_invalidations
+from src.database import dialect_insert
+from src.lease_monitor import LeaseDiff, LeaseMonitor, LeaseSnapshot, encode_leases, decode_leases
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CHANNEL = "seuranta_snapshot"
+INVALIDATE_CHANNEL = "seuranta_invalidate"
+
+
+class Coordinator():
+    """Leadership and notifications between worker processes.
+
+    This one is for a single worker, which always leads and has nobody
+    to notify.
+    """
+    shared = False
+
+    async def start(self, on_notify: Callable[[str, str], None]):
+        pass
+
+
+    async def try_lead(self) -> bool:
+        return True
+
+
+    def leading(self) -> bool:
+        return True
+
+
+    async def notify(self, channel: str, payload: str):
+        pass
+
+
+    async def close(self):
+        pass
+
+
+class PostgresCoordinator(Coordinator):
+    """Leadership through a session level advisory lock, notifications through LISTEN/NOTIFY.
+
+    The lock is tied to the connection, so the server releases it when
+    the leader dies or loses its connection.
+    """
+    shared = True
+    lock_key = 0x5e07a17a
+
+    def __init__(self, dsn: str):
+        self._dsn = dsn
+        self._connection: asyncpg.Connection | None = None
+        # One asyncpg connection runs one command at a time
+        self._lock = asyncio.Lock()
+        self._on_notify: Callable[[str, str], None] | None = None
+        self._leader = False
+
+
+    async def start(self, on_notify: Callable[[str, str], None]):
+        self._on_notify = on_notify
+        await self._connect()
+
+
+    async def _connect(self):
+        self._leader = False
+        self._connection = await asyncpg.connect(self._dsn)
+        own_pid = self._connection.get_server_pid()
+
+        def listener(connection, pid: int, channel: str, payload: str):
+            if pid != own_pid:
+                self._on_notify(channel, payload)
+
+        for channel in (SNAPSHOT_CHANNEL, INVALIDATE_CHANNEL):
+            await self._connection.add_listener(channel, listener)
+
+
+    async def _ensure_connected(self):
+        if self._connection is None or self._connection.is_closed():
+            # A new connection doesn't hold the lock, a leader notices and steps down
+            await self._connect()
+
+
+    async def try_lead(self) -> bool:
+        async with self._lock:
+            await self._ensure_connected()
+            self._leader = await self._connection.fetchval("SELECT pg_try_advisory_lock($1)", self.lock_key)
+        return self._leader
+
+
+    def leading(self) -> bool:
+        return self._leader and self._connection is not None and not self._connection.is_closed()
+
+
+    async def notify(self, channel: str, payload: str):
+        async with self._lock:
+            await self._ensure_connected()
+            await self._connection.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+        self._leader = False
+
+
+class Cluster():
+    """Runs the lease poller in one worker process and shares its snapshots with the rest.
+
+    The leader stores every changed snapshot in the database and notifies
+    the followers, which load and adopt it. Cache invalidations are passed
+    between the workers the same way. Followers keep trying to take over,
+    so a dead leader is replaced within retry_interval.
+    """
+
+    def __init__(self, coordinator: Coordinator, monitor: LeaseMonitor, sessionmaker: sessionmaker,
+                 on_lead: Callable[[], Awaitable[None]], on_step_down: Callable[[], Awaitable[None]],
+                 retry_interval: float = 10):
+        self._coordinator = coordinator
+        self._monitor = monitor
+        self._sessionmaker = sessionmaker
+        self._on_lead = on_lead
+        self._on_step_down = on_step_down
+        self._retry_interval = retry_interval
+        self._task: asyncio.Task | None = None
+        self._pending: set[asyncio.Task] = set()
+        self._unsubscribe: list[Callable[[], None]] = []
+        self._unsubscribe_share: Callable[[], None] | None = None
+        self.is_leader = False
+
+
+    async def start(self):
+        await self._coordinator.start(self._on_notify)
+        self._unsubscribe.append(subscribe_invalidations(self._on_invalidation, remote=True))
+        if self._coordinator.shared:
+            self._unsubscribe.append(subscribe_invalidations(self._broadcast_invalidation))
+            await self.load_snapshot()
+        await self._elect()
+        self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for unsubscribe in self._unsubscribe:
+            unsubscribe()
+        self._unsubscribe.clear()
+        if self.is_leader:
+            await self._step_down()
+        await asyncio.gather(*self._pending, return_exceptions=True)
+        await self._coordinator.close()
+
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._retry_interval)
+            if self.is_leader and not self._coordinator.leading():
+                logger.warning("Lost leadership")
+                await self._step_down()
+            if not self.is_leader:
+                await self._elect()
+
+
+    async def _elect(self):
+        try:
+            if not await self._coordinator.try_lead():
+                return
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            logger.warning("Leader election failed: %r", e)
+            return
+        logger.info("Leading, polling leases in this worker")
+        self.is_leader = True
+        if self._coordinator.shared:
+            self._unsubscribe_share = self._monitor.subscribe(self.share_snapshot)
+        await self._on_lead()
+
+
+    async def _step_down(self):
+        self.is_leader = False
+        if self._unsubscribe_share is not None:
+            self._unsubscribe_share()
+            self._unsubscribe_share = None
+        await self._on_step_down()
+
+
+    async def share_snapshot(self, diff: LeaseDiff):
+        if diff.names_changed:
+            # Same snapshot, the other workers heard of the write themselves
+            return
+        snapshot = diff.snapshot
+        async with self._sessionmaker() as session:
+            insert = dialect_insert(session)
+            stmt = insert(models.SharedLeaseSnapshot).values(
+                id=1,
+                generation=snapshot.generation,
+                leases=json.dumps(encode_leases(snapshot.leases), separators=(",", ":")),
+                updated_datetime=datetime.datetime.now().replace(microsecond=0),
+            )
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[models.SharedLeaseSnapshot.id],
+                set_={column: stmt.excluded[column] for column in ("generation", "leases", "updated_datetime")},
+            ))
+            await session.commit()
+        await self._coordinator.notify(SNAPSHOT_CHANNEL, str(snapshot.generation))
+
+
+    async def load_snapshot(self):
+        async with self._sessionmaker() as session:
+            db_result = await session.execute(
+                select(models.SharedLeaseSnapshot.generation, models.SharedLeaseSnapshot.leases)
+                .where(models.SharedLeaseSnapshot.id == 1)
+            )
+            row = db_result.first()
+        if row is not None and row.generation > self._monitor.snapshot.generation:
+            await self._monitor.adopt(LeaseSnapshot(decode_leases(json.loads(row.leases)), generation=row.generation))
+
+
+    def _on_notify(self, channel: str, payload: str):
+        if channel == INVALIDATE_CHANNEL:
+            invalidate(payload, broadcast=False)
+        elif channel == SNAPSHOT_CHANNEL and not self.is_leader:
+            if int(payload) > self._monitor.snapshot.generation:
+                self._spawn(self.load_snapshot())
+
+
+    def _on_invalidation(self, scope: str):
+        # Registrations and renames change the present names without a lease diff
+        if scope == "entities":
+            self._spawn(self._monitor.republish(leader=self.is_leader))
+            if not name_index.loaded:
+                # Written by another worker, which only kept its own index current
+                self._spawn(self._load_name_index())
+
+
+    async def _load_name_index(self):
+        async with self._sessionmaker() as session:
+            await crud.load_name_index(session)
+
+
+    def _broadcast_invalidation(self, scope: str):
+        self._spawn(self._coordinator.notify(INVALIDATE_CHANNEL, scope))
+
+
+    def _spawn(self, coroutine: Awaitable[None]):
+        task = asyncio.ensure_future(coroutine)
+        self._pending.add(task)
+        task.add_done_callback(self._finished)
+
+
+    def _finished(self, task: asyncio.Task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Cluster task failed", exc_info=task.exception())
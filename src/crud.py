@@ -1,50 +1,155 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload, make_transient_to_detached
 
 import src.schemas as schemas
 import src.models as models
-from src.utils import sanitise_name
+from src.utils import NAME_MINLENGTH, sanitise_name, normalise_mac, valid_name
+from src.cache import identities, invalidate, name_index
+from src.database import dialect_insert
 
 import datetime
 
-async def create_tracked_entity_with_device(db: AsyncSession, tracked_entity: schemas.TrackedEntityCreate, device: schemas.DeviceCreate):
-    db_tracked_entity = models.TrackedEntity(
-        name=sanitise_name(tracked_entity.name),
-        devices=[models.Device(mac_addr=device.mac_addr, hostname=device.hostname)],
-        created_datetime=datetime.datetime.now().replace(microsecond=0)
+async def register_device(db: AsyncSession, name: str, device: schemas.DeviceCreate) -> int:
+    """Link the device to the tracked entity called name, creating the entity if needed.
+
+    Names are unique in the database, so concurrent sign-ups with the same
+    name end up on the same entity. On PostgreSQL both upserts go out as one
+    statement, SQLite can't nest the INSERT in a CTE and takes two. Raises
+    ValueError if the sanitised name is too short.
+    """
+    name = valid_name(name)
+    insert = dialect_insert(db)
+    entity_stmt = insert(models.TrackedEntity).values(
+        name=name,
+        created_datetime=datetime.datetime.now().replace(microsecond=0),
     )
-    db.add(db_tracked_entity)
+    # A no-op update, so that RETURNING also yields an existing row
+    entity_stmt = entity_stmt.on_conflict_do_update(
+        index_elements=[models.TrackedEntity.name],
+        set_={"name": entity_stmt.excluded.name},
+    ).returning(models.TrackedEntity.id)
+
+    mac_addr = normalise_mac(device.mac_addr)
+    if db.bind.dialect.name == "postgresql":
+        entity = entity_stmt.cte("entity")
+        device_stmt = insert(models.Device).from_select(
+            ["mac_addr", "hostname", "tracked_entity_id"],
+            select(literal(mac_addr, models.MacAddress), literal(device.hostname), entity.c.id),
+        )
+    else:
+        tracked_entity_id = (await db.execute(entity_stmt)).scalar_one()
+        device_stmt = insert(models.Device).values(
+            mac_addr=mac_addr, hostname=device.hostname, tracked_entity_id=tracked_entity_id
+        )
+    device_stmt = device_stmt.on_conflict_do_update(
+        index_elements=[models.Device.mac_addr],
+        set_={"hostname": device_stmt.excluded.hostname, "tracked_entity_id": device_stmt.excluded.tracked_entity_id},
+    ).returning(models.Device.tracked_entity_id)
+    tracked_entity_id = (await db.execute(device_stmt)).scalar_one()
     await db.commit()
-    await db.refresh(db_tracked_entity)
-    return db_tracked_entity
+    invalidate("entities")
+    name_index.add(name)
+    return tracked_entity_id
+
+async def rename_tracked_entity(db: AsyncSession, tracked_entity_id: int, name: str) -> bool:
+    """Rename the tracked entity, False if another one already has the name.
+
+    Raises ValueError if the sanitised name is too short.
+    """
+    name = valid_name(name)
+    try:
+        old_name = await db.scalar(
+            select(models.TrackedEntity.name).where(models.TrackedEntity.id == tracked_entity_id)
+        )
+        await db.execute(
+            update(models.TrackedEntity)
+            .where(models.TrackedEntity.id == tracked_entity_id)
+            .values(name=name)
+        )
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    invalidate("entities")
+    if old_name is not None:
+        name_index.discard(old_name)
+        name_index.add(name)
+    return True
 
 async def get_device_by_mac_addr(db: AsyncSession, mac_addr: str):
     db_result = await db.execute(select(models.Device).filter(models.Device.mac_addr == mac_addr))
     device = db_result.scalars().first()
     return device
 
+def _identity_record(tracked_entity: models.TrackedEntity | None) -> tuple:
+    if tracked_entity is None:
+        return ()
+    devices = tuple((d.id, d.mac_addr, d.name, d.hostname) for d in tracked_entity.devices)
+    return (tracked_entity.id, tracked_entity.name, tracked_entity.created_datetime, devices)
+
+def _tracked_entity_from_record(record: tuple) -> models.TrackedEntity:
+    (id, name, created_datetime, devices) = record
+    tracked_entity = models.TrackedEntity(
+        id=id,
+        name=name,
+        created_datetime=created_datetime,
+        devices=[models.Device(id=d[0], mac_addr=d[1], name=d[2], hostname=d[3], tracked_entity_id=id) for d in devices],
+    )
+    make_transient_to_detached(tracked_entity)
+    for device in tracked_entity.devices:
+        make_transient_to_detached(device)
+    return tracked_entity
+
+async def get_identity_by_mac_addr(db: AsyncSession, mac_addr: str) -> tuple[models.Device | None, models.TrackedEntity | None]:
+    mac_addr = normalise_mac(mac_addr)
+    if (record := identities.get(mac_addr)) is None:
+        generation = identities.generation
+        db_result = await db.execute(
+            select(models.TrackedEntity)
+            .where(models.TrackedEntity.devices.any(models.Device.mac_addr == mac_addr))
+            .options(joinedload(models.TrackedEntity.devices))
+        )
+        tracked_entity = db_result.unique().scalars().first()
+        identities.set(mac_addr, _identity_record(tracked_entity), generation)
+    elif record:
+        tracked_entity = await db.merge(_tracked_entity_from_record(record), load=False)
+    else:
+        tracked_entity = None
+
+    if tracked_entity is None:
+        return None, None
+    device = next((d for d in tracked_entity.devices if d.mac_addr == mac_addr), None)
+    return device, tracked_entity
+
 async def get_tracked_entity_by_mac_addr(db: AsyncSession, mac_addr: str) -> schemas.TrackedEntity:
     db_result = await db.execute(select(models.TrackedEntity).join(models.Device).filter(models.Device.mac_addr == mac_addr))
     tracked_entity = db_result.scalars().first()
     return tracked_entity
 
+async def load_name_index(db: AsyncSession):
+    """Fill the name index from the database, at startup and after writes by other workers."""
+    while not name_index.loaded:
+        generation = name_index.generation
+        db_result = await db.execute(select(models.TrackedEntity.name))
+        name_index.load(db_result.scalars().all(), generation)
+
+def complete_tracked_entity_names(prefix: str, limit: int = 10) -> list[str]:
+    """Names starting with prefix, case-insensitively, from the in-memory index.
+
+    Too short a prefix completes nothing, so the members can't be listed.
+    """
+    prefix = sanitise_name(prefix)
+    if len(prefix) < NAME_MINLENGTH:
+        return []
+    return name_index.complete(prefix, limit)
+
 async def get_tracked_entity_by_name(db: AsyncSession, name: str):
     db_result = await db.execute(select(models.TrackedEntity).filter(models.TrackedEntity.name == name))
     tracked_entity = db_result.scalars().first()
     return tracked_entity
 
-async def update_tracked_entity_name(db: AsyncSession, tracked_entity: models.TrackedEntity, name: str):
-    tracked_entity.name = sanitise_name(name)
-    await db.commit()
-    await db.refresh(tracked_entity)
-    return tracked_entity
-
-async def add_device_to_tracked_entity(db: AsyncSession, tracked_entity: models.TrackedEntity, device: models.Device):
-    tracked_entity.devices.append(device)
-    await db.commit()
-    await db.refresh(tracked_entity)
-    return tracked_entity
-
 async def get_tracked_entities_by_mac_addrs(db: AsyncSession, mac_addrs: list[str]):
     db_result = await db.execute(select(models.TrackedEntity).join(models.Device).filter(models.Device.mac_addr.in_(mac_addrs)))
     tracked_entities = db_result.scalars().all()
@@ -52,22 +157,36 @@ async def get_tracked_entities_by_mac_addrs(db: AsyncSession, mac_addrs: list[st
 
 async def get_tracked_entity_names_by_mac_addrs(db: AsyncSession, mac_addrs: list[str]) -> list[str]:
     db_result = await db.execute(select(models.TrackedEntity.name).where(models.TrackedEntity.devices.any(models.Device.mac_addr.in_(mac_addrs))))
-    names = db_result.scalars()
-    return names
+    names = db_result.scalars().all()
+    return list(names)
+
+async def get_groups_with_members(db: AsyncSession) -> list[models.Group]:
+    db_result = await db.execute(
+        select(models.Group)
+        .options(
+            selectinload(models.Group.members)
+            .selectinload(models.Membership.tracked_entity)
+            .selectinload(models.TrackedEntity.devices)
+        )
+        .order_by(models.Group.name)
+    )
+    return list(db_result.scalars().all())
 
 async def add_membership(db: AsyncSession, membership: schemas.MembershipCreate):
     db_membership = models.Membership(
         tracked_entity_id=membership.tracked_entity_id,
-        group_id=membership.tracked_entity_id,
+        group_id=membership.group_id,
         joined_date=datetime.date.today()
     )
     db.add(db_membership)
     await db.commit()
+    invalidate("memberships")
     await db.refresh(db_membership)
     return db_membership
 
 async def delete_membership(db: AsyncSession, membership: schemas.MembershipDelete):
     ident = {"tracked_entity_id": membership.tracked_entity_id, "group_id": membership.group_id}
-    db_membership = db.get_one(models.Membership, ident)
-    db.delete(db_membership)
+    db_membership = await db.get_one(models.Membership, ident)
+    await db.delete(db_membership)
     await db.commit()
+    invalidate("memberships")
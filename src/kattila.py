@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+from get_docker_secret import get_docker_secret
+
+from src.metrics import kattila_export_seconds
+from src.sinks import PresenceUpdate, Sink, SinkError
+
+KATTILA_API_URL = os.getenv("KATTILA_API_URL", None)
+_KATTILA_API_KEY = get_docker_secret("apikey")
+
+logger = logging.getLogger(__name__)
+
+
+class KattilaExporter(Sink):
+    """Export sink pushing the present names to the Kattila API.
+
+    Kattila only wants the current presence set, so pending exports are
+    coalesced: when the queue is full the oldest one is dropped, and a
+    failing export is given up on as soon as a newer one is waiting.
+    """
+    type = "kattila"
+    coalesce = True
+
+    def __init__(self, api_url: str | None, api_key: str | None, max_pending: int = 1,
+                 timeout: httpx.Timeout = httpx.Timeout(10, connect=5),
+                 max_retries: int = 3, backoff: float = 1.0):
+        # Retries have their own timeouts
+        super().__init__(max_pending=max_pending, timeout=None)
+        self.api_url = api_url
+        self._api_key = api_key
+        self._http_timeout = timeout
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._client: httpx.AsyncClient | None = None
+
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_url)
+
+
+    async def start(self, transport: httpx.AsyncBaseTransport | None = None):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self._http_timeout,
+                headers={"X-API-Key": self._api_key or ""},
+                transport=transport,
+            )
+        await super().start()
+
+
+    async def close(self):
+        await super().close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        json = {"users": [{"username": name} for name in batch[-1].present]}
+        for attempt in range(self._max_retries + 1):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                response = await self._client.put(f"{self.api_url}/seuranta/users", json=json)
+                outcome = str(response.status_code)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return True
+                logger.warning("Kattila export got status %d", response.status_code)
+            except httpx.HTTPStatusError as e:
+                raise SinkError(f"Kattila export rejected: {e}") from e
+            except httpx.HTTPError as e:
+                logger.warning("Kattila export failed: %r", e)
+            finally:
+                kattila_export_seconds.observe(time.perf_counter() - started, outcome=outcome)
+            if attempt == self._max_retries:
+                break
+            await asyncio.sleep(self._backoff * 2 ** attempt)
+            if not self._queue.empty():
+                # A newer presence set is waiting, no point retrying this one
+                return False
+        raise SinkError(f"Kattila export failed {self._max_retries + 1} times")
+
+
+exporter = KattilaExporter(KATTILA_API_URL, _KATTILA_API_KEY)
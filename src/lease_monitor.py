@@ -1,68 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
 import aiohttp
-import src.utils as utils
+from src.lease_sources import Lease, LeaseFetch, LeaseSource, DnsmasqParser, parse_sources, merge_leases
+from src.replay import LeaseRecorder
 from src.database import SessionLocal
 import src.crud as crud
+from src.cache import presence_names
+from src.metrics import lease_fetch_seconds, lease_update_seconds, lease_skipped_lines
+
+class LeaseSnapshot():
+    """Immutable view of the leases from one poll, indexed by IP and MAC.
+
+    A new snapshot is built for every poll and swapped in as a whole, so
+    readers never see a half-updated lease table and never need to copy it.
+    """
+    __slots__ = ("generation", "leases", "mac_addrs", "_by_ip", "_by_mac")
+    _last_generation = 0
+
+    def __init__(self, leases: list[Lease] | tuple[Lease, ...] = (), generation: int | None = None):
+        self.generation: int = self.next_generation() if generation is None else generation
+        LeaseSnapshot._last_generation = max(LeaseSnapshot._last_generation, self.generation)
+        self.leases: tuple[Lease, ...] = tuple(leases)
+        self.mac_addrs: tuple[str, ...] = tuple(lease.mac_addr for lease in self.leases)
+        self._by_ip: dict[str, Lease] = {lease.ipv4_addr: lease for lease in self.leases}
+        self._by_mac: dict[str, Lease] = {lease.mac_addr: lease for lease in self.leases}
+
+
+    @classmethod
+    def next_generation(cls) -> int:
+        # Clock based, so generations stay unique across restarts and worker processes
+        return max(cls._last_generation + 1, time.time_ns() // 1000)
+
+
+    def get_by_ip(self, ipv4_addr: str | None) -> Lease | None:
+        return self._by_ip.get(ipv4_addr)
+
+
+    def get_by_mac(self, mac_addr: str | None) -> Lease | None:
+        return self._by_mac.get(mac_addr)
+
+
+    def __len__(self) -> int:
+        return len(self.leases)
+
+
+EMPTY_SNAPSHOT = LeaseSnapshot()
+
+
+class LeaseDiff():
+    """Difference between two consecutive lease snapshots.
+
+    names_changed marks a diff republishing the same snapshot after a
+    device was registered or renamed.
+    """
+    __slots__ = ("joined", "left", "changed", "snapshot", "names_changed")
 
-class Lease():
-    def __init__(self, ipv4_addr: str, hostname: str, mac_addr: str):
-        self.ipv4_addr: str = ipv4_addr
-        self.hostname: str = hostname
-        self.mac_addr: str = mac_addr
+    def __init__(self, joined: tuple[Lease, ...], left: tuple[Lease, ...],
+                 changed: tuple[tuple[Lease, Lease], ...], snapshot: LeaseSnapshot, names_changed: bool = False):
+        self.joined = joined
+        self.left = left
+        self.changed = changed
+        self.snapshot = snapshot
+        self.names_changed = names_changed
 
 
-    def __eq__(self, other: object) -> bool:
-        return self.__dict__ == other.__dict__
+    @classmethod
+    def between(cls, old: LeaseSnapshot, new: LeaseSnapshot) -> "LeaseDiff":
+        joined = tuple(lease for lease in new.leases if old.get_by_mac(lease.mac_addr) is None)
+        left = tuple(lease for lease in old.leases if new.get_by_mac(lease.mac_addr) is None)
+        changed = tuple((prev, lease) for lease in new.leases
+                        if (prev := old.get_by_mac(lease.mac_addr)) is not None and prev != lease)
+        return cls(joined, left, changed, new)
+
+
+    @property
+    def membership_changed(self) -> bool:
+        return bool(self.joined or self.left or self.names_changed)
+
+
+    def __bool__(self) -> bool:
+        return bool(self.joined or self.left or self.changed or self.names_changed)
+
+
+    def __repr__(self):
+        return f"LeaseDiff(joined={self.joined}, left={self.left}, changed={self.changed})"
+
+
+LeaseListener = Callable[[LeaseDiff], Awaitable[None]]
+
+
+def encode_leases(leases: tuple[Lease, ...]) -> list[list]:
+    return [[lease.ipv4_addr, lease.hostname, lease.mac_addr, lease.expires] for lease in leases]
+
+
+def decode_leases(data: list[list]) -> list[Lease]:
+    return [Lease(ipv4_addr, hostname, mac_addr, expires) for (ipv4_addr, hostname, mac_addr, expires) in data]
+
+
+logger = logging.getLogger(__name__)
 
 
 class LeaseMonitor():
-    _leases: list[Lease] = []
+    _snapshot: LeaseSnapshot = EMPTY_SNAPSHOT
+    _last_diff: LeaseDiff | None = None
+    # Seconds a lease may be missing from the router before it counts as left
+    _leave_hysteresis: float = float(os.getenv("LEASE_LEAVE_HYSTERESIS", 60))
+    # Seconds the last good leases of a failing source are still served
+    _stale_grace: float = float(os.getenv("LEASE_STALE_GRACE", 120))
     _req_timeout = aiohttp.ClientTimeout(total=10, connect=5)
-    _endpoint = 'http://192.168.1.1/moi'
+    _keepalive_timeout = 60
+    _default_sources = '[{"url": "http://192.168.1.1/moi", "parser": "dnsmasq"}]'
+    # Where the last snapshot is kept between restarts, and how old a kept one may be in seconds
+    _snapshot_file: str | None = os.getenv("LEASE_SNAPSHOT_FILE", "lease_snapshot.json")
+    _snapshot_max_age: float = float(os.getenv("LEASE_SNAPSHOT_MAX_AGE", 600))
+    # Raw responses of the sources are appended here when set, for replaying later
+    _record_file: str | None = os.getenv("LEASE_RECORD_FILE")
     _sessionmaker = SessionLocal
 
+    def __init__(self, sources: list[LeaseSource] | None = None):
+        self._sources = sources if sources is not None else parse_sources(os.getenv("LEASE_SOURCES") or self._default_sources)
+        self._missing_since: dict[str, float] = {}
+        self._listeners: list[LeaseListener] = []
+        self._tick_listeners: list[LeaseListener] = []
+        self._follower_listeners: list[LeaseListener] = []
+        self._http: aiohttp.ClientSession | None = None
+        self._source_leases: dict[str, list[Lease]] = {source.name: [] for source in self._sources}
+        self._source_success: dict[str, float] = {}
+        self.last_fetches: dict[str, LeaseFetch] = {}
+        self.last_fetch_seconds: float | None = None
+        self.last_fetch_status: int | None = None
+        self._recorder = LeaseRecorder(self._record_file) if self._record_file else None
+        for source in self._sources:
+            source.recorder = self._recorder
+
+
+    async def start(self):
+        if self._http is None or self._http.closed:
+            connector = aiohttp.TCPConnector(keepalive_timeout=self._keepalive_timeout)
+            self._http = aiohttp.ClientSession(timeout=self._req_timeout, connector=connector)
+
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        if self._recorder is not None:
+            self._recorder.close()
+
+
+    def subscribe(self, listener: LeaseListener, every_tick: bool = False, on_followers: bool = False) -> Callable[[], None]:
+        """Call listener with the diff of every poll that changed something.
+
+        With every_tick the listener is called after every successful poll,
+        with an empty diff when nothing changed. With on_followers it is
+        also called for snapshots adopted from the leader worker, for
+        listeners that serve this process's own clients.
+        """
+        lists = [self._tick_listeners if every_tick else self._listeners]
+        if on_followers:
+            lists.append(self._follower_listeners)
+        for listeners in lists:
+            listeners.append(listener)
+
+        def unsubscribe():
+            for listeners in lists:
+                listeners.remove(listener)
+        return unsubscribe
+
+
+    async def adopt(self, snapshot: LeaseSnapshot) -> LeaseDiff | None:
+        """Swap in a snapshot polled by another worker, unless it's older than ours."""
+        if snapshot.generation <= self._snapshot.generation:
+            return None
+        diff = self._last_diff = LeaseDiff.between(self._snapshot, snapshot)
+        self._snapshot = snapshot
+        if diff:
+            await self._publish(diff, self._follower_listeners)
+        return diff
+
+
+    async def _publish(self, diff: LeaseDiff, listeners: list[LeaseListener] | None = None):
+        if listeners is None:
+            listeners = (*self._listeners, *self._tick_listeners) if diff else tuple(self._tick_listeners)
+        results = await asyncio.gather(*(listener(diff) for listener in listeners), return_exceptions=True)
+        for listener, result in zip(listeners, results):
+            if isinstance(result, Exception):
+                logger.error("Lease listener %r failed", listener, exc_info=result)
+
+
+    def _swap_snapshot(self, leases: list[Lease], now: float | None = None) -> LeaseDiff:
+        now = time.monotonic() if now is None else now
+        current = {lease.mac_addr: lease for lease in leases}
+        for mac_addr in current:
+            self._missing_since.pop(mac_addr, None)
+        # Keep briefly missing leases around so flapping devices don't churn
+        for lease in self._snapshot.leases:
+            if lease.mac_addr in current:
+                continue
+            missing_since = self._missing_since.setdefault(lease.mac_addr, now)
+            if now - missing_since < self._leave_hysteresis:
+                current[lease.mac_addr] = lease
+            else:
+                del self._missing_since[lease.mac_addr]
+        snapshot = LeaseSnapshot(current.values())
+        self._last_diff = LeaseDiff.between(self._snapshot, snapshot)
+        self._snapshot = snapshot
+        return self._last_diff
+
 
     @staticmethod
     async def parse_leases(leases_str: str) -> list[Lease]:
-        leases: list[Lease] = []
-        lease_lines: list[str] = [line for line in leases_str.split("\n") if line]
-        for line in lease_lines:
-            (_, mac, ip, hostname, _) = line.split()
-            leases.append(Lease(ipv4_addr=ip, hostname=hostname, mac_addr=mac))
+        (leases, _) = DnsmasqParser.parse(leases_str)
         return leases
 
 
-    async def handle_lease_response(self, response: aiohttp.ClientResponse) -> int:
-        if response.status >= 400:
-            self._leases = []
-        else:
-            self._leases = await self.parse_leases(await response.text())
-        return response.status
+    def _apply_fetches(self, results: dict[str, LeaseFetch], now: float | None = None):
+        now = time.monotonic() if now is None else now
+        changed = False
+        for (name, result) in results.items():
+            if result.status < 400:
+                self._source_success[name] = now
+            if result.leases is not None:
+                self._source_leases[name] = result.leases
+                changed = True
+            elif (result.status >= 400 and self._source_leases[name]
+                  and now - self._source_success.get(name, now) >= self._stale_grace):
+                # Devices of a dead source leave through the hysteresis, others stay
+                self._source_leases[name] = []
+                changed = True
+        # Without changes only missing leases need to age out
+        if changed or self._missing_since:
+            self._swap_snapshot(merge_leases(list(self._source_leases.values())), now)
+
+
+    @property
+    def churn(self) -> int:
+        """Devices that joined or left in the last poll."""
+        diff = self._last_diff
+        return len(diff.joined) + len(diff.left) if diff else 0
 
 
     async def fetch_leases(self) -> int:
-        async with aiohttp.ClientSession(timeout=self._req_timeout) as session:
-            async with session.get(self._endpoint) as response:
-                return await self.handle_lease_response(response)
+        """Fetch every lease source concurrently and merge their leases.
+
+        Returns the best status among the sources, so a poll only counts as
+        failed when every source failed.
+        """
+        await self.start()
+        started = time.perf_counter()
+        results = await asyncio.gather(*(source.fetch(self._http) for source in self._sources))
+        self.last_fetches = {source.name: result for source, result in zip(self._sources, results)}
+        for (name, result) in self.last_fetches.items():
+            lease_fetch_seconds.observe(result.seconds, source=name, status=str(result.status))
+            if result.skipped:
+                lease_skipped_lines.inc(result.skipped, source=name)
+        self._apply_fetches(self.last_fetches)
+        self.last_fetch_seconds = time.perf_counter() - started
+        self.last_fetch_status = min((result.status for result in results), default=200)
+        return self.last_fetch_status
 
 
     async def update_leases(self) -> int:
+        with lease_update_seconds.time():
+            return await self._update_leases()
+
+
+    async def _update_leases(self) -> int:
+        self._last_diff = None
         status = await self.fetch_leases()
-        async with SessionLocal() as session:
-            names = await crud.get_tracked_entity_names_by_mac_addrs(session, self.mac_addrs)
-        await utils.export_names(names)
+        diff = self._last_diff
+        if not diff:
+            if self._tick_listeners and status < 400:
+                await self._publish(LeaseDiff((), (), (), self._snapshot))
+            return status
+        if diff.membership_changed:
+            await self._load_names(diff.snapshot)
+        await self._publish(diff)
         return status
 
 
+    async def _load_names(self, snapshot: LeaseSnapshot):
+        key = presence_names.key(snapshot.generation)
+        async with self._sessionmaker() as session:
+            names = await crud.get_tracked_entity_names_by_mac_addrs(session, snapshot.mac_addrs)
+        presence_names.set(key, names)
+
+
+    async def republish(self, leader: bool = True):
+        """Publish the current snapshot again after a tracked entity was registered or renamed.
+
+        Followers only publish to the listeners serving their own clients.
+        """
+        diff = LeaseDiff((), (), (), self._snapshot, names_changed=True)
+        await self._load_names(diff.snapshot)
+        await self._publish(diff, self._listeners if leader else self._follower_listeners)
+
+
+    def restore_snapshot(self) -> bool:
+        """Serve the snapshot saved by the previous run until the first poll, if it's recent enough."""
+        if not self._snapshot_file:
+            return False
+        try:
+            with open(self._snapshot_file) as f:
+                saved = json.load(f)
+            if time.time() - saved["saved_at"] > self._snapshot_max_age:
+                logger.info("Saved lease snapshot is too old, not restoring it")
+                return False
+            snapshot = LeaseSnapshot(decode_leases(saved["leases"]), generation=saved["generation"])
+            sources = {name: (decode_leases(source["leases"]), source["succeeded_at"])
+                       for (name, source) in saved.get("sources", {}).items()}
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Could not restore lease snapshot: %r", e)
+            return False
+        if snapshot.generation <= self._snapshot.generation:
+            return False
+        self._snapshot = snapshot
+        # Carry on where the sources were, so a router that is down at boot
+        # still gets its stale grace and its devices the leave hysteresis
+        now = time.monotonic()
+        for name in self._source_leases:
+            (leases, succeeded_at) = sources.get(name, (list(snapshot.leases), saved["saved_at"]))
+            self._source_leases[name] = leases
+            if succeeded_at is not None:
+                self._source_success[name] = now - max(0.0, time.time() - succeeded_at)
+        logger.info("Restored %d leases from %s", len(snapshot), self._snapshot_file)
+        return True
+
+
+    async def save_snapshot(self, diff: LeaseDiff | None = None):
+        if not self._snapshot_file or (diff is not None and diff.names_changed):
+            return
+        snapshot = self._snapshot
+        (now, wall_now) = (time.monotonic(), time.time())
+        sources = {
+            name: {
+                "leases": encode_leases(leases),
+                "succeeded_at": wall_now - (now - self._source_success[name]) if name in self._source_success else None,
+            }
+            for (name, leases) in self._source_leases.items()
+        }
+        data = json.dumps({
+            "generation": snapshot.generation,
+            "saved_at": wall_now,
+            "leases": encode_leases(snapshot.leases),
+            "sources": sources,
+        }, separators=(",", ":"))
+        await asyncio.to_thread(self._write_snapshot, data)
+
+
+    def _write_snapshot(self, data: str):
+        # Written aside and renamed over, a crash never leaves half a file
+        temporary = f"{self._snapshot_file}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(data)
+        os.replace(temporary, self._snapshot_file)
+
+
     async def get_lease_by_ip(self, ipv4_addr: str | None) -> Lease | None:
-        for lease in self.leases:
-            if lease.ipv4_addr == ipv4_addr:
-                return lease
+        return self._snapshot.get_by_ip(ipv4_addr)
 
 
     @property
-    def leases(self) -> list[Lease]:
-        return self._leases.copy()
+    def snapshot(self) -> LeaseSnapshot:
+        return self._snapshot
+
+    @property
+    def leases(self) -> tuple[Lease, ...]:
+        return self._snapshot.leases
 
     @property
-    def mac_addrs(self) -> list[str]:
-        return [lease.mac_addr for lease in self.leases]
+    def mac_addrs(self) -> tuple[str, ...]:
+        return self._snapshot.mac_addrs
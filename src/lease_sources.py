@@ -0,0 +1,415 @@
+import asyncio
+import codecs
+import datetime
+import ipaddress
+import json
+import logging
+import os
+import time
+from typing import Iterable
+
+import aiofiles
+import aiohttp
+
+from src.replay import LeaseRecorder
+
+
+logger = logging.getLogger(__name__)
+
+
+class Lease():
+    __slots__ = ("ipv4_addr", "hostname", "mac_addr", "expires")
+
+    def __init__(self, ipv4_addr: str, hostname: str, mac_addr: str, expires: float | None = None):
+        self.ipv4_addr: str = ipv4_addr
+        self.hostname: str = hostname
+        self.mac_addr: str = mac_addr
+        # Unix time the lease runs out, None if the source doesn't tell.
+        # Not part of equality, a renewed lease is the same lease.
+        self.expires: float | None = expires
+
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Lease):
+            return NotImplemented
+        return (self.ipv4_addr, self.hostname, self.mac_addr) == (other.ipv4_addr, other.hostname, other.mac_addr)
+
+
+    def __hash__(self) -> int:
+        return hash((self.ipv4_addr, self.hostname, self.mac_addr))
+
+
+    def __repr__(self):
+        return f"Lease(ipv4_addr={self.ipv4_addr}, hostname={self.hostname}, mac_addr={self.mac_addr})"
+
+
+def _ipv4(addr: str) -> str:
+    return str(ipaddress.IPv4Address(addr))
+
+
+def _mac(addr: str) -> str:
+    octets = addr.split(":")
+    if len(octets) != 6 or not all(len(octet) == 2 for octet in octets):
+        raise ValueError(f"Not a MAC address: {addr}")
+    int("".join(octets), 16)
+    return addr.lower()
+
+
+def _unexpired(leases: Iterable[Lease | None]) -> list[Lease]:
+    now = time.time()
+    return [lease for lease in leases if lease is not None and (lease.expires is None or lease.expires > now)]
+
+
+class LeaseParser():
+    """Incremental line based lease parser.
+
+    Bytes are fed in chunks as they arrive, complete lines are parsed right
+    away and only the trailing partial line is buffered. Lines that don't
+    parse are skipped and counted instead of failing the whole table.
+    """
+
+    def __init__(self, encoding: str = "utf-8"):
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        self._buffer = ""
+        self.skipped = 0
+
+
+    def feed(self, chunk: bytes) -> list[Lease]:
+        self._buffer += self._decoder.decode(chunk)
+        *lines, self._buffer = self._buffer.split("\n")
+        return self._parse_lines(lines)
+
+
+    def close(self) -> list[Lease]:
+        rest = self._buffer + self._decoder.decode(b"", final=True)
+        self._buffer = ""
+        return self._parse_lines([rest]) + self.finish()
+
+
+    def _parse_lines(self, lines: list[str]) -> list[Lease]:
+        leases: list[Lease] = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                lease = self.parse_line(line)
+            except (ValueError, IndexError):
+                self.skipped += 1
+                continue
+            if lease is not None:
+                leases.append(lease)
+        return leases
+
+
+    def parse_line(self, line: str) -> Lease | None:
+        raise NotImplementedError
+
+
+    def finish(self) -> list[Lease]:
+        return []
+
+
+    @classmethod
+    def parse(cls, data: str | bytes) -> tuple[list[Lease], int]:
+        parser = cls()
+        leases = parser.feed(data.encode() if isinstance(data, str) else data)
+        leases += parser.close()
+        return leases, parser.skipped
+
+
+class DnsmasqParser(LeaseParser):
+    """dnsmasq leases: `expiry mac ip hostname [client-id]`."""
+
+    def parse_line(self, line: str) -> Lease | None:
+        fields = line.split()
+        if fields[0] == "duid":
+            return None
+        if len(fields) < 4:
+            raise ValueError(line)
+        (expires, mac, ip, hostname) = fields[:4]
+        return Lease(ipv4_addr=_ipv4(ip), hostname="" if hostname == "*" else hostname,
+                     mac_addr=_mac(mac), expires=float(expires) or None)
+
+
+class KeaCsvParser(LeaseParser):
+    """Kea memfile lease4 CSV, columns are located from the header.
+
+    The file is append-only and a release is written as a new row with a
+    zero lifetime, so the last row for an address wins.
+    """
+    _active_state = "0"
+
+    def __init__(self, encoding: str = "utf-8"):
+        super().__init__(encoding)
+        self._columns: dict[str, int] | None = None
+        self._latest: dict[str, Lease | None] = {}
+
+
+    def parse_line(self, line: str) -> Lease | None:
+        fields = line.split(",")
+        if self._columns is None:
+            self._columns = {name: i for i, name in enumerate(fields)}
+            return None
+        columns = self._columns
+        address = _ipv4(fields[columns["address"]])
+        if (("state" in columns and fields[columns["state"]] != self._active_state)
+                or ("valid_lifetime" in columns and int(fields[columns["valid_lifetime"]]) == 0)):
+            self._latest[address] = None
+            return None
+        self._latest[address] = Lease(
+            ipv4_addr=address,
+            hostname=fields[columns["hostname"]].rstrip(".") if "hostname" in columns else "",
+            mac_addr=_mac(fields[columns["hwaddr"]]),
+            expires=float(fields[columns["expire"]]) if "expire" in columns else None,
+        )
+        return None
+
+
+    def finish(self) -> list[Lease]:
+        (latest, self._latest) = (self._latest, {})
+        return _unexpired(latest.values())
+
+
+class ArpParser(LeaseParser):
+    """Kernel neighbour table from /proc/net/arp."""
+    _complete_flag = 0x2
+
+    def parse_line(self, line: str) -> Lease | None:
+        if line.startswith("IP address"):
+            return None
+        (ip, _, flags, mac) = line.split()[:4]
+        if not int(flags, 16) & self._complete_flag:
+            return None
+        return Lease(ipv4_addr=_ipv4(ip), hostname="", mac_addr=_mac(mac))
+
+
+class IscDhcpdParser(LeaseParser):
+    """ISC dhcpd `dhcpd.leases`, one `lease <ip> { ... }` block per lease.
+
+    The file is append-only, the last block for an address wins.
+    """
+
+    def __init__(self, encoding: str = "utf-8"):
+        super().__init__(encoding)
+        self._block: dict[str, str] | None = None
+        self._latest: dict[str, Lease | None] = {}
+
+
+    def parse_line(self, line: str) -> Lease | None:
+        if line.startswith("#"):
+            return None
+        if self._block is None:
+            if line.startswith("lease ") and line.endswith("{"):
+                self._block = {"ip": line.split()[1]}
+            return None
+        if line == "}":
+            (block, self._block) = (self._block, None)
+            self._latest[_ipv4(block["ip"])] = self._lease(block)
+            return None
+        # A statement may be followed by a comment, as in `ends epoch 4102444800; # Fri Jan 01 ...`
+        (statement, end, comment) = line.rpartition(";")
+        if not end or (comment and not comment.lstrip().startswith("#")):
+            statement = line
+        (key, _, value) = statement.partition(" ")
+        if key == "hardware":
+            self._block["mac"] = value.split()[-1]
+        elif key in ("client-hostname", "ends"):
+            self._block[key] = value.strip('"')
+        elif key == "binding" and value.startswith("state "):
+            self._block["state"] = value.split()[1]
+        return None
+
+
+    def _lease(self, block: dict[str, str]) -> Lease | None:
+        if block.get("state", "active") != "active":
+            return None
+        return Lease(ipv4_addr=_ipv4(block["ip"]), hostname=block.get("client-hostname", ""),
+                     mac_addr=_mac(block.get("mac", "")), expires=self._ends(block.get("ends")))
+
+
+    @staticmethod
+    def _ends(ends: str | None) -> float | None:
+        if not ends or ends == "never":
+            return None
+        fields = ends.split()
+        if fields[0] == "epoch":
+            return float(fields[1])
+        ends_datetime = datetime.datetime.strptime(" ".join(fields[1:3]), "%Y/%m/%d %H:%M:%S")
+        return ends_datetime.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+    def finish(self) -> list[Lease]:
+        if self._block is not None:
+            self._block = None
+            self.skipped += 1
+        (latest, self._latest) = (self._latest, {})
+        return _unexpired(latest.values())
+
+
+PARSERS: dict[str, type[LeaseParser]] = {
+    "dnsmasq": DnsmasqParser,
+    "kea-csv": KeaCsvParser,
+    "arp": ArpParser,
+    "isc-dhcpd": IscDhcpdParser,
+}
+
+
+class LeaseFetch():
+    """Outcome of fetching one lease source. leases is None when unchanged."""
+    __slots__ = ("status", "leases", "skipped", "seconds")
+
+    def __init__(self, status: int, leases: list[Lease] | None = None, skipped: int = 0, seconds: float = 0):
+        self.status = status
+        self.leases = leases
+        self.skipped = skipped
+        self.seconds = seconds
+
+
+class LeaseSource():
+    chunk_size = 64 * 1024
+
+    def __init__(self, name: str, parser: type[LeaseParser] = DnsmasqParser, timeout: float = 10):
+        self.name = name
+        self.timeout = timeout
+        self._parser = parser
+        self.skipped = 0
+        # Gets every raw response when set, see src/replay.py
+        self.recorder: LeaseRecorder | None = None
+        self._raw: bytearray | None = None
+
+
+    async def fetch(self, http: aiohttp.ClientSession) -> LeaseFetch:
+        """Fetch the leases, never taking longer than the source's timeout.
+
+        Errors are reported as a status code rather than raised, so one
+        broken source can't take down a poll of several.
+        """
+        started = time.perf_counter()
+        self._raw = bytearray() if self.recorder is not None else None
+        try:
+            result = await asyncio.wait_for(self._fetch(http), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Lease source %s timed out after %ss", self.name, self.timeout)
+            result = LeaseFetch(504)
+        except (aiohttp.ClientError, OSError) as e:
+            logger.warning("Lease source %s failed: %r", self.name, e)
+            result = LeaseFetch(502)
+        result.seconds = time.perf_counter() - started
+        self.skipped += result.skipped
+        if self.recorder is not None:
+            self.recorder.record(self.name, result.status, bytes(self._raw) if result.leases is not None else b"")
+        return result
+
+
+    async def _fetch(self, http: aiohttp.ClientSession) -> LeaseFetch:
+        raise NotImplementedError
+
+
+class HttpLeaseSource(LeaseSource):
+    """Lease table served over HTTP, fetched with conditional GETs."""
+
+    def __init__(self, url: str, parser: type[LeaseParser] = DnsmasqParser, name: str | None = None, timeout: float = 10):
+        super().__init__(name or url, parser, timeout)
+        self.url = url
+        self._etag: str | None = None
+        self._last_modified: str | None = None
+
+
+    def _conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+        return headers
+
+
+    async def _fetch(self, http: aiohttp.ClientSession) -> LeaseFetch:
+        async with http.get(self.url, headers=self._conditional_headers()) as response:
+            return await self.read_response(response)
+
+
+    async def read_response(self, response: aiohttp.ClientResponse) -> LeaseFetch:
+        if response.status == 304:
+            return LeaseFetch(response.status)
+        if response.status >= 400:
+            self._etag = self._last_modified = None
+            return LeaseFetch(response.status)
+        parser = self._parser()
+        leases: list[Lease] = []
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            if self._raw is not None:
+                self._raw += chunk
+            leases += parser.feed(chunk)
+        leases += parser.close()
+        self._etag = response.headers.get("ETag")
+        self._last_modified = response.headers.get("Last-Modified")
+        return LeaseFetch(response.status, leases, parser.skipped)
+
+
+class FileLeaseSource(LeaseSource):
+    """Lease file on the local filesystem, only re-read when it changes."""
+
+    def __init__(self, path: str, parser: type[LeaseParser] = DnsmasqParser, name: str | None = None, timeout: float = 10):
+        super().__init__(name or path, parser, timeout)
+        self.path = path
+        self._stat: tuple[int, int] | None = None
+
+
+    async def _fetch(self, http: aiohttp.ClientSession) -> LeaseFetch:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._stat = None
+            return LeaseFetch(404)
+        # procfs files report neither size nor a useful mtime
+        key = (stat.st_mtime_ns, stat.st_size) if stat.st_size else None
+        if key is not None and key == self._stat:
+            return LeaseFetch(304)
+        parser = self._parser()
+        leases: list[Lease] = []
+        async with aiofiles.open(self.path, "rb") as f:
+            while chunk := await f.read(self.chunk_size):
+                if self._raw is not None:
+                    self._raw += chunk
+                leases += parser.feed(chunk)
+        leases += parser.close()
+        self._stat = key
+        return LeaseFetch(200, leases, parser.skipped)
+
+
+def parse_sources(spec: str) -> list[LeaseSource]:
+    """Lease sources from a JSON list such as the LEASE_SOURCES variable.
+
+    Each entry has a url (http(s):// or file://, or a plain path) and
+    optionally a parser name from PARSERS, a name and a timeout in seconds.
+    """
+    sources: list[LeaseSource] = []
+    for entry in json.loads(spec):
+        url = entry["url"]
+        kwargs = {
+            "parser": PARSERS[entry.get("parser", "dnsmasq")],
+            "name": entry.get("name"),
+            "timeout": float(entry.get("timeout", 10)),
+        }
+        if url.startswith(("http://", "https://")):
+            sources.append(HttpLeaseSource(url, **kwargs))
+        else:
+            sources.append(FileLeaseSource(url.removeprefix("file://"), **kwargs))
+    return sources
+
+
+def merge_leases(lease_lists: list[list[Lease]]) -> list[Lease]:
+    """Deduplicate leases by MAC, the one expiring last wins.
+
+    A lease without an expiry only wins over leases that have none either,
+    between equals the earlier list wins.
+    """
+    merged: dict[str, Lease] = {}
+    for leases in lease_lists:
+        for lease in leases:
+            current = merged.get(lease.mac_addr)
+            if current is None or (lease.expires or 0) > (current.expires or 0):
+                merged[lease.mac_addr] = lease
+    return list(merged.values())
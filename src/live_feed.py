@@ -0,0 +1,96 @@
+import asyncio
+import json
+from typing import AsyncIterator
+
+from sqlalchemy.orm import sessionmaker
+
+import src.crud as crud
+from src.cache import presence_names
+from src.lease_monitor import LeaseDiff
+
+
+class PresenceFeed():
+    """Fans present names out to Server-Sent Events clients.
+
+    The lease monitor is the only producer. Each event is serialised once
+    and put in every client's bounded queue. A client whose queue is full
+    is too slow to keep up and gets disconnected.
+    """
+
+    def __init__(self, sessionmaker: sessionmaker, max_buffer: int = 8, heartbeat: float = 15):
+        self._sessionmaker = sessionmaker
+        self._max_buffer = max_buffer
+        self._heartbeat = heartbeat
+        self._clients: set[asyncio.Queue[str | None]] = set()
+        self._latest: str | None = None
+        self.dropped = 0
+
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+
+    def connect(self) -> asyncio.Queue[str | None]:
+        queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize=self._max_buffer)
+        if self._latest is not None:
+            queue.put_nowait(self._latest)
+        self._clients.add(queue)
+        return queue
+
+
+    def disconnect(self, queue: asyncio.Queue[str | None]):
+        self._clients.discard(queue)
+
+
+    def broadcast(self, data: str):
+        self._latest = data
+        for queue in tuple(self._clients):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self._drop(queue)
+
+
+    def _drop(self, queue: asyncio.Queue[str | None]):
+        self.dropped += 1
+        self._end(queue)
+
+
+    def _end(self, queue: asyncio.Queue[str | None]):
+        self.disconnect(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+    def close(self):
+        """End every client's stream, so shutdown doesn't wait on open connections."""
+        for queue in tuple(self._clients):
+            self._end(queue)
+
+
+    async def publish(self, diff: LeaseDiff):
+        if not diff.membership_changed:
+            return
+        key = presence_names.key(diff.snapshot.generation)
+        if (names := presence_names.get(key)) is None:
+            async with self._sessionmaker() as session:
+                names = await crud.get_tracked_entity_names_by_mac_addrs(session, diff.snapshot.mac_addrs)
+            presence_names.set(key, names)
+        self.broadcast(json.dumps({"present": names}))
+
+
+    async def events(self, queue: asyncio.Queue[str | None]) -> AsyncIterator[str]:
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(queue.get(), self._heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if data is None:
+                    return
+                yield f"data: {data}\n\n"
+        finally:
+            self.disconnect(queue)
@@ -1,4 +1,5 @@
 from typing import Annotated, Any
+import os
 
 from fastapi import (
     FastAPI,
@@ -6,27 +7,87 @@ from fastapi import (
     Request,
     Response,
     Form,
+    Query,
+    HTTPException,
 )
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse, JSONResponse
 
 from contextlib import asynccontextmanager
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
-from src.utils import NAME_MAXLENGTH, JINJA_TEMPLATES
-import src.models as models
+from src.utils import NAME_MINLENGTH, NAME_MAXLENGTH, JINJA_ENV, JINJA_TEMPLATES, templates_digest, etag_matches
 import src.schemas as schemas
 import src.crud as crud
-from src.database import SessionLocal, engine
+from src.database import SessionLocal, engine, asyncpg_dsn
 from src.lease_monitor import LeaseMonitor
-
+from src.scheduler import PollScheduler
+from src.kattila import exporter
+from src.sinks import PresenceExport, parse_sinks
+from src.cache import presence_names
+from src.presence_history import PresenceHistory
+from src.occupancy import OccupancyRollups, get_occupancy_stats
+from src.live_feed import PresenceFeed
+from src.rosters import get_group_rosters
+from src.cluster import Cluster, Coordinator, PostgresCoordinator
+from src.assets import StaticAssets, AssetStaticFiles
+from src.metrics import REGISTRY, Gauge, RequestTimer, instrument_engine
+
+
+static_assets = StaticAssets("static")
+static_assets.load()
+JINJA_ENV.globals["asset_url"] = static_assets.url
+# Pages change on deploys as well as with the data
+PAGE_VERSION = templates_digest()[:8] + static_assets.digest[:8]
 
 lease_monitor = LeaseMonitor()
+presence_history = PresenceHistory(SessionLocal)
+lease_monitor.subscribe(presence_history.record)
+occupancy_rollups = OccupancyRollups(SessionLocal)
+lease_monitor.subscribe(occupancy_rollups.tick, every_tick=True)
+presence_feed = PresenceFeed(SessionLocal)
+lease_monitor.subscribe(presence_feed.publish, on_followers=True)
+lease_monitor.subscribe(lease_monitor.save_snapshot)
+presence_export = PresenceExport(SessionLocal, [exporter, *parse_sinks(os.getenv("EXPORT_SINKS") or "[]")])
+lease_monitor.subscribe(presence_export.publish)
+
+lease_monitor_scheduler = PollScheduler(
+    lease_monitor.update_leases,
+    lambda: lease_monitor.churn,
+    interval=float(os.getenv("LEASE_POLL_INTERVAL", 15)),
+    min_interval=float(os.getenv("LEASE_POLL_MIN_INTERVAL")) if os.getenv("LEASE_POLL_MIN_INTERVAL") else None,
+    max_interval=float(os.getenv("LEASE_POLL_MAX_INTERVAL")) if os.getenv("LEASE_POLL_MAX_INTERVAL") else None,
+)
+
+
+async def start_polling():
+    await presence_export.start()
+    await lease_monitor.start()
+    # Poll once before serving, so nobody sees an empty lease table
+    delay = await lease_monitor_scheduler.run_once()
+    lease_monitor_scheduler.start(delay)
 
-lease_monitor_scheduler = AsyncIOScheduler()
-lease_monitor_scheduler.add_job(lease_monitor.update_leases, CronTrigger(second="*/15"))
+async def stop_polling():
+    await lease_monitor_scheduler.stop()
+    await occupancy_rollups.flush()
+    await lease_monitor.close()
+    await presence_export.close()
+
+# With several worker processes (MULTI_WORKER=1) only the leader polls
+cluster = Cluster(
+    PostgresCoordinator(asyncpg_dsn()) if os.getenv("MULTI_WORKER") == "1" else Coordinator(),
+    lease_monitor, SessionLocal, on_lead=start_polling, on_step_down=stop_polling,
+)
+
+instrument_engine(engine)
+REGISTRY.register(Gauge("seuranta_leases", "Leases in the current snapshot.", lambda: len(lease_monitor.snapshot)))
+REGISTRY.register(Gauge("seuranta_lease_fetch_last_seconds", "Duration of the last lease fetch.", lambda: lease_monitor.last_fetch_seconds))
+REGISTRY.register(Gauge("seuranta_scheduler_lag_seconds", "How late the last poll started.", lambda: lease_monitor_scheduler.lag))
+REGISTRY.register(Gauge("seuranta_scheduler_interval_seconds", "Current poll interval.", lambda: lease_monitor_scheduler.interval))
+REGISTRY.register(Gauge("seuranta_scheduler_failures", "Consecutive failed polls.", lambda: lease_monitor_scheduler.failures))
+REGISTRY.register(Gauge("seuranta_leader", "1 in the worker that polls the leases.", lambda: int(cluster.is_leader)))
+REGISTRY.register(Gauge("seuranta_live_clients", "Connected live feed clients.", lambda: presence_feed.clients))
 
 
 async def get_session():
@@ -44,69 +105,145 @@ async def associate_tracked_entity_data(req: Request, session: SessionDep):
     req.state.tracked_entity = None
 
     if req.state.lease:
-        req.state.device = await crud.get_device_by_mac_addr(session, req.state.lease.mac_addr)
-        if req.state.device:
-            req.state.tracked_entity = await session.get_one(models.TrackedEntity, req.state.device.tracked_entity_id)
+        (req.state.device, req.state.tracked_entity) = await crud.get_identity_by_mac_addr(session, req.state.lease.mac_addr)
+
+IDENTIFIED = [Depends(associate_tracked_entity_data)]
+
+async def check_page_etag(req: Request):
+    """Answer a matching If-None-Match with 304 before the page touches the database.
+
+    The page only depends on the lease snapshot, the names and devices in
+    the database and on whose lease the visitor is on.
+    """
+    lease = await lease_monitor.get_lease_by_ip(req.client.host)
+    req.state.etag = etag = (
+        f'W/"{PAGE_VERSION}-{lease_monitor.snapshot.generation}-{presence_names.generation}'
+        f'-{lease.mac_addr.replace(":", "") if lease else "anon"}"'
+    )
+    if etag_matches(req.headers.get("If-None-Match"), etag):
+        raise HTTPException(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+CONDITIONAL = [Depends(check_page_etag)]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as connection:
-        await connection.run_sync(models.Base.metadata.create_all)
-    lease_monitor_scheduler.start()
+    # The schema is managed by Alembic alone, see alembic-upgrade.Dockerfile
+    lease_monitor.restore_snapshot()
+    async with SessionLocal() as session:
+        await crud.load_name_index(session)
+    await cluster.start()
+    app.state.ready = True
     yield
-    lease_monitor_scheduler.shutdown()
+    app.state.ready = False
+    # Open event streams would otherwise hold the shutdown up
+    presence_feed.close()
+    await cluster.stop()
 
-app = FastAPI(lifespan=lifespan, dependencies=[Depends(associate_tracked_entity_data)])
+app = FastAPI(lifespan=lifespan)
+app.state.ready = False
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", AssetStaticFiles(static_assets), name="static")
 
 
-@app.get("/")
+app.add_middleware(RequestTimer)
+
+
+@app.get("/", dependencies=CONDITIONAL + IDENTIFIED)
 async def root(req: Request, session: SessionDep) -> Response:
     context: dict[str, Any] = {}
-    context["present_names"] = await crud.get_tracked_entity_names_by_mac_addrs(session, lease_monitor.mac_addrs)
+    snapshot = lease_monitor.snapshot
+    key = presence_names.key(snapshot.generation)
+    if (present_names := presence_names.get(key)) is None:
+        present_names = await crud.get_tracked_entity_names_by_mac_addrs(session, snapshot.mac_addrs)
+        presence_names.set(key, present_names)
+    context["present_names"] = present_names
+    template = "index.html"
     if te := req.state.tracked_entity:
         context["tracked_entity"] = te
         context["joined_datetime_isoformat"] = te.created_datetime.isoformat()
         await te.awaitable_attrs.devices
-        return JINJA_TEMPLATES.TemplateResponse(request=req, name="informative.html", context=context)
-    return JINJA_TEMPLATES.TemplateResponse(request=req, name="index.html", context=context)
+        template = "informative.html"
+    # The ETag was taken before reading anything, at worst it's older than the page
+    headers = {"ETag": req.state.etag, "Cache-Control": "no-cache"}
+    return JINJA_TEMPLATES.TemplateResponse(request=req, name=template, context=context, headers=headers)
 
-@app.get("/name-form")
+@app.get("/name-form", dependencies=IDENTIFIED)
 async def serve_name_form(req: Request, session: SessionDep):
-    context: dict[str, Any] = {"name_maxlength": NAME_MAXLENGTH}
+    context: dict[str, Any] = {"name_minlength": NAME_MINLENGTH, "name_maxlength": NAME_MAXLENGTH}
     context["tracked_entity"] = req.state.tracked_entity
     return JINJA_TEMPLATES.TemplateResponse(request=req, name="name-form.html", context=context)
 
-@app.post("/name-form")
-async def handle_name_form(req: Request, username: Annotated[str, Form()], session: SessionDep):
+@app.post("/name-form", dependencies=IDENTIFIED)
+async def handle_name_form(req: Request, session: SessionDep, username: Annotated[str, Form()] = ""):
     if not req.state.lease:
         return Response(content="Could not find associated DHCP lease", status_code=500)
 
-    # Device is associated with an existing tracked entity, so 
-    if te := req.state.tracked_entity:
-        await crud.update_tracked_entity_name(session, te, username)
-        return RedirectResponse("/", status_code=302)
-    
-    new_device = schemas.DeviceCreate(mac_addr=req.state.lease.mac_addr, hostname=req.state.lease.hostname)
-    
-    if te := await crud.get_tracked_entity_by_name(session, username):
-        await crud.add_device_to_tracked_entity(session, te, new_device)
-        return RedirectResponse("/", status_code=302)
-    
-    new_tracked_entity = schemas.TrackedEntityCreate(name=username)
-
-    await crud.create_tracked_entity_with_device(session, new_tracked_entity, new_device)
+    try:
+        # Device is associated with an existing tracked entity, so rename it
+        if te := req.state.tracked_entity:
+            if not await crud.rename_tracked_entity(session, te.id, username):
+                return Response(content="Name is already taken", status_code=409)
+            return RedirectResponse("/", status_code=302)
+
+        new_device = schemas.DeviceCreate(mac_addr=req.state.lease.mac_addr, hostname=req.state.lease.hostname)
+        await crud.register_device(session, username, new_device)
+    except ValueError as e:
+        return Response(content=str(e), status_code=400)
     return RedirectResponse("/", status_code=302)
 
-@app.post("/memberships")
+@app.get("/names")
+async def complete_names(req: Request, prefix: Annotated[str, Query(max_length=NAME_MAXLENGTH)] = "",
+                         limit: Annotated[int, Query(ge=1, le=20)] = 10) -> list[str]:
+    # Only for devices on the network, like the name form
+    if not await lease_monitor.get_lease_by_ip(req.client.host):
+        raise HTTPException(status_code=403, detail="Could not find associated DHCP lease")
+    return crud.complete_tracked_entity_names(prefix, limit)
+
+@app.get("/live")
+async def live_presence() -> StreamingResponse:
+    queue = presence_feed.connect()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(presence_feed.events(queue), media_type="text/event-stream", headers=headers)
+
+@app.get("/healthz")
+async def liveness() -> dict[str, str]:
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readiness(session: SessionDep) -> JSONResponse:
+    status = {"leases": len(lease_monitor.snapshot), "leader": cluster.is_leader}
+    if not app.state.ready:
+        return JSONResponse({"status": "starting", **status}, status_code=503)
+    try:
+        await session.execute(text("SELECT 1"))
+    except (OSError, SQLAlchemyError):
+        return JSONResponse({"status": "database unavailable", **status}, status_code=503)
+    return JSONResponse({"status": "ready", **status})
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/occupancy")
+async def occupancy_stats(session: SessionDep, days: Annotated[int, Query(ge=1, le=366)] = 28) -> schemas.OccupancyStats:
+    return await get_occupancy_stats(session, days)
+
+@app.get("/groups")
+async def group_rosters(session: SessionDep) -> list[schemas.GroupRoster]:
+    return list((await get_group_rosters(session, lease_monitor.snapshot)).values())
+
+@app.get("/groups/{group_id}")
+async def group_roster(group_id: int, session: SessionDep) -> schemas.GroupRoster:
+    if (roster := (await get_group_rosters(session, lease_monitor.snapshot)).get(group_id)) is None:
+        raise HTTPException(status_code=404, detail="No such group")
+    return roster
+
+@app.post("/memberships", dependencies=IDENTIFIED)
 async def add_membership(req: Request, membership: schemas.MembershipCreate, session: SessionDep):
-    if te := req.state.tracked_entity \
-    and te.tracked_entity_id == membership.tracked_entity_id:
+    if (te := req.state.tracked_entity) and te.id == membership.tracked_entity_id:
         await crud.add_membership(session, membership)
 
-@app.delete("/memberships")
+@app.delete("/memberships", dependencies=IDENTIFIED)
 async def delete_membership(req: Request, membership: schemas.MembershipDelete, session: SessionDep):
-    if te := req.state.tracked_entity \
-    and te.tracked_entity_id == membership.tracked_entity_id:
+    if (te := req.state.tracked_entity) and te.id == membership.tracked_entity_id:
         await crud.delete_membership(session, membership)
@@ -0,0 +1,218 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric():
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """Gauge read from a callback when scraped, so nothing has to keep it up to date."""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float | None]):
+        super().__init__(name, help)
+        self._read = read
+
+
+    def samples(self) -> Iterator[str]:
+        value = self._read()
+        if value is not None:
+            yield f"{self.name} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if key not in self._counts:
+            self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0
+        self._counts[key][bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                bucket_labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(self._sums[key])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry():
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+http_request_seconds = REGISTRY.register(Histogram(
+    "seuranta_http_request_seconds", "HTTP request latency by route.", ("method", "route", "status")))
+db_query_seconds = REGISTRY.register(Histogram(
+    "seuranta_db_query_seconds", "Database statement duration."))
+lease_fetch_seconds = REGISTRY.register(Histogram(
+    "seuranta_lease_fetch_seconds", "Time to fetch and parse one lease source.", ("source", "status")))
+lease_update_seconds = REGISTRY.register(Histogram(
+    "seuranta_lease_update_seconds", "Duration of a whole lease update, fetch through listeners."))
+lease_skipped_lines = REGISTRY.register(Counter(
+    "seuranta_lease_skipped_lines_total", "Lease lines that failed to parse.", ("source",)))
+kattila_export_seconds = REGISTRY.register(Histogram(
+    "seuranta_kattila_export_seconds", "Kattila API PUT latency.", ("outcome",)))
+export_seconds = REGISTRY.register(Histogram(
+    "seuranta_export_seconds", "Duration of export sink deliveries, retries included.", ("sink", "outcome")))
+export_updates = REGISTRY.register(Counter(
+    "seuranta_export_updates_total", "Presence updates by export sink and result.", ("sink", "result")))
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Time every statement the engine executes."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - conn.info["query_started"].pop())
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
+
+
+class RequestTimer():
+    """ASGI middleware timing HTTP requests by route, until the response starts.
+
+    Plain ASGI, so streamed responses pass straight through rather than
+    through the extra task and queue of a @app.middleware("http") one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        responded = False
+
+        def observe(status: int):
+            # The router has put the matched route in the scope by now
+            route = scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=route.path if route else "unmatched",
+                status=str(status),
+            )
+
+        async def timed_send(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except Exception:
+            if not responded:
+                observe(500)
+            raise
@@ -3,6 +3,9 @@ import src.utils as utils
 from sqlalchemy import ForeignKey
 from sqlalchemy import MetaData
 from sqlalchemy import String
+from sqlalchemy import Index
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase
@@ -14,6 +17,21 @@ import datetime
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
+class MacAddress(TypeDecorator):
+    """MAC address stored as a 48-bit integer, read back in canonical form.
+
+    Every bound value goes through the same conversion, so lookups match the
+    index whatever case or separators the input used.
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: str | None, dialect) -> int | None:
+        return None if value is None else utils.mac_to_int(value)
+
+    def process_result_value(self, value: int | None, dialect) -> str | None:
+        return None if value is None else utils.int_to_mac(value)
+
 class Membership(Base):
     __tablename__= "membership"
 
@@ -32,7 +50,7 @@ class TrackedEntity(Base):
         return f"TrackedEntity(id={self.id}, name={self.name}, created_datetime={self.created_datetime}, devices={self.devices})"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    name: Mapped[str] = mapped_column(String(utils.NAME_MAXLENGTH))
+    name: Mapped[str] = mapped_column(String(utils.NAME_MAXLENGTH), unique=True, index=True)
     created_datetime: Mapped[datetime.datetime]
     devices: Mapped[List["Device"]] = relationship(
         back_populates="tracked_entity",
@@ -47,7 +65,7 @@ class Device(Base):
         return f"Device(id={self.id}, mac_addr={self.mac_addr}, name={self.name}, hostname={self.hostname}, tracked_entity_id={self.tracked_entity_id})"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    mac_addr: Mapped[str] = mapped_column(String(17))
+    mac_addr: Mapped[str] = mapped_column(MacAddress, unique=True, index=True)
     name: Mapped[Optional[str]] = mapped_column(String(20))
     hostname: Mapped[Optional[str]] = mapped_column(String(255))
     tracked_entity_id: Mapped[int] = mapped_column(ForeignKey("tracked_entity.id"))
@@ -60,3 +78,45 @@ class Group(Base):
     created_date: Mapped[datetime.date]
     name: Mapped[str] = mapped_column(String(255))
     members: Mapped[List["Membership"]] = relationship(back_populates="group")
+
+class PresenceSession(Base):
+    __tablename__ = "presence_session"
+    __table_args__ = (
+        Index("ix_presence_session_open", "device_id", "end_datetime"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    device_id: Mapped[int] = mapped_column(ForeignKey("device.id", ondelete="CASCADE"))
+    tracked_entity_id: Mapped[int] = mapped_column(ForeignKey("tracked_entity.id", ondelete="CASCADE"), index=True)
+    start_datetime: Mapped[datetime.datetime]
+    end_datetime: Mapped[Optional[datetime.datetime]]
+
+class HourlyOccupancy(Base):
+    __tablename__ = "hourly_occupancy"
+
+    hour_start: Mapped[datetime.datetime] = mapped_column(primary_key=True)
+    entities: Mapped[int]
+
+class HourlyPresence(Base):
+    """Entities seen during the current hour, the working set of HourlyOccupancy."""
+    __tablename__ = "hourly_presence"
+
+    hour_start: Mapped[datetime.datetime] = mapped_column(primary_key=True)
+    tracked_entity_id: Mapped[int] = mapped_column(ForeignKey("tracked_entity.id", ondelete="CASCADE"), primary_key=True)
+
+class DailyPresence(Base):
+    __tablename__ = "daily_presence"
+
+    day: Mapped[datetime.date] = mapped_column(primary_key=True)
+    tracked_entity_id: Mapped[int] = mapped_column(ForeignKey("tracked_entity.id", ondelete="CASCADE"), primary_key=True)
+    seconds: Mapped[int]
+
+class SharedLeaseSnapshot(Base):
+    """The leader worker's latest lease snapshot, for the other workers to load."""
+    __tablename__ = "shared_lease_snapshot"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    generation: Mapped[int] = mapped_column(BigInteger)
+    # JSON list of [ipv4_addr, hostname, mac_addr, expires]
+    leases: Mapped[str]
+    updated_datetime: Mapped[datetime.datetime]
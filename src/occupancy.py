@@ -0,0 +1,153 @@
+import collections
+import datetime
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import src.models as models
+import src.schemas as schemas
+from src.cache import presence_names
+from src.database import dialect_insert
+from src.lease_monitor import LeaseDiff
+
+
+class OccupancyRollups():
+    """Maintains the occupancy rollup tables from lease monitor ticks.
+
+    Present seconds per entity are accumulated in memory and flushed as one
+    upsert every flush_interval. The distinct entities of the current hour
+    are only written when a new entity shows up during that hour.
+    """
+    # Longer gaps between ticks are most likely downtime, not presence
+    _max_tick_gap = datetime.timedelta(minutes=2)
+
+    def __init__(self, sessionmaker: sessionmaker, flush_interval: datetime.timedelta = datetime.timedelta(minutes=1)):
+        self._sessionmaker = sessionmaker
+        self._flush_interval = flush_interval
+        self._present: frozenset[int] | None = None
+        self._names_generation: int | None = None
+        self._hour: datetime.datetime | None = None
+        self._seen_this_hour: set[int] = set()
+        self._pending_seconds: collections.Counter[tuple[datetime.date, int]] = collections.Counter()
+        self._last_tick: datetime.datetime | None = None
+        self._last_flush: datetime.datetime | None = None
+
+
+    async def tick(self, diff: LeaseDiff, now: datetime.datetime | None = None):
+        now = now or datetime.datetime.now().replace(microsecond=0)
+        async with self._sessionmaker() as session:
+            present = await self._present_entities(session, diff)
+            if self._last_tick is not None:
+                elapsed = min(now - self._last_tick, self._max_tick_gap)
+                for tracked_entity_id in present:
+                    self._pending_seconds[(now.date(), tracked_entity_id)] += int(elapsed.total_seconds())
+            self._last_tick = now
+
+            await self._update_hour(session, present, now)
+            if self._last_flush is None or now - self._last_flush >= self._flush_interval:
+                await self._flush(session)
+                self._last_flush = now
+            await session.commit()
+
+
+    async def flush(self):
+        async with self._sessionmaker() as session:
+            await self._flush(session)
+            await session.commit()
+
+
+    async def _present_entities(self, session: AsyncSession, diff: LeaseDiff) -> frozenset[int]:
+        # Registrations and renames can make a present device count
+        if self._present is None or diff.membership_changed or self._names_generation != presence_names.generation:
+            self._names_generation = presence_names.generation
+            db_result = await session.execute(
+                select(models.Device.tracked_entity_id)
+                .where(models.Device.mac_addr.in_(diff.snapshot.mac_addrs))
+                .distinct()
+            )
+            self._present = frozenset(db_result.scalars().all())
+        return self._present
+
+
+    async def _update_hour(self, session: AsyncSession, present: frozenset[int], now: datetime.datetime):
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        if hour != self._hour:
+            await session.execute(delete(models.HourlyPresence).where(models.HourlyPresence.hour_start < hour))
+            db_result = await session.execute(
+                select(models.HourlyPresence.tracked_entity_id).where(models.HourlyPresence.hour_start == hour)
+            )
+            self._hour = hour
+            self._seen_this_hour = set(db_result.scalars().all())
+
+        new = present - self._seen_this_hour
+        if not new:
+            return
+        self._seen_this_hour |= new
+        insert = dialect_insert(session)
+        await session.execute(
+            insert(models.HourlyPresence)
+            .values([{"hour_start": hour, "tracked_entity_id": i} for i in new])
+            .on_conflict_do_nothing()
+        )
+        stmt = insert(models.HourlyOccupancy).values(hour_start=hour, entities=len(self._seen_this_hour))
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[models.HourlyOccupancy.hour_start],
+            set_={"entities": stmt.excluded.entities},
+        ))
+
+
+    async def _flush(self, session: AsyncSession):
+        if not self._pending_seconds:
+            return
+        insert = dialect_insert(session)
+        stmt = insert(models.DailyPresence).values([
+            {"day": day, "tracked_entity_id": tracked_entity_id, "seconds": seconds}
+            for (day, tracked_entity_id), seconds in self._pending_seconds.items()
+        ])
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[models.DailyPresence.day, models.DailyPresence.tracked_entity_id],
+            set_={"seconds": models.DailyPresence.seconds + stmt.excluded.seconds},
+        ))
+        self._pending_seconds.clear()
+
+
+async def get_occupancy_stats(db: AsyncSession, days: int, now: datetime.datetime | None = None) -> schemas.OccupancyStats:
+    now = now or datetime.datetime.now()
+    since = now.date() - datetime.timedelta(days=days - 1)
+    since_datetime = datetime.datetime.combine(since, datetime.time())
+
+    db_result = await db.execute(
+        select(models.HourlyOccupancy)
+        .where(models.HourlyOccupancy.hour_start >= since_datetime)
+        .order_by(models.HourlyOccupancy.hour_start)
+    )
+    hourly = [schemas.OccupancyHour(hour_start=row.hour_start, entities=row.entities) for row in db_result.scalars()]
+
+    # Empty hours have no row, the means count every elapsed hour of the window
+    elapsed: collections.Counter[tuple[int, int]] = collections.Counter()
+    hour_start = since_datetime
+    while hour_start <= now:
+        elapsed[(hour_start.weekday(), hour_start.hour)] += 1
+        hour_start += datetime.timedelta(hours=1)
+    weekday_hours: dict[tuple[int, int], list[int]] = collections.defaultdict(list)
+    for row in hourly:
+        weekday_hours[(row.hour_start.weekday(), row.hour_start.hour)].append(row.entities)
+    weekday = [
+        schemas.WeekdayOccupancy(weekday=weekday, hour=hour,
+                                 mean_entities=sum(counts) / max(elapsed[(weekday, hour)], len(counts)))
+        for (weekday, hour), counts in sorted(weekday_hours.items())
+    ]
+
+    db_result = await db.execute(
+        select(models.TrackedEntity.name, func.sum(models.DailyPresence.seconds), func.count())
+        .join(models.TrackedEntity, models.TrackedEntity.id == models.DailyPresence.tracked_entity_id)
+        .where(models.DailyPresence.day >= since)
+        .group_by(models.TrackedEntity.id, models.TrackedEntity.name)
+        .order_by(func.sum(models.DailyPresence.seconds).desc())
+    )
+    entities = [
+        schemas.EntityPresenceTotal(name=name, minutes=seconds // 60, days=visit_days)
+        for (name, seconds, visit_days) in db_result.all()
+    ]
+    return schemas.OccupancyStats(since=since, hourly=hourly, weekday=weekday, entities=entities)
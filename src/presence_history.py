@@ -0,0 +1,83 @@
+import datetime
+
+from sqlalchemy import select, insert, update, exists, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import src.models as models
+from src.lease_monitor import LeaseDiff
+
+
+class PresenceHistory():
+    """Records presence sessions of registered devices from lease diffs.
+
+    Each diff is written with one INSERT ... SELECT opening intervals for
+    the devices that joined and one UPDATE closing the intervals of the
+    devices that left. Open intervals are not touched while the device
+    stays present.
+    """
+
+    def __init__(self, sessionmaker: sessionmaker):
+        self._sessionmaker = sessionmaker
+        self._reconciled = False
+
+
+    async def record(self, diff: LeaseDiff, now: datetime.datetime | None = None):
+        now = now or datetime.datetime.now().replace(microsecond=0)
+        joined = [lease.mac_addr for lease in diff.joined]
+        left = [lease.mac_addr for lease in diff.left]
+        async with self._sessionmaker() as session:
+            if not self._reconciled:
+                # Intervals left open by a previous run end now, unless still present
+                await self._close_absent(session, diff.snapshot.mac_addrs, now)
+                joined = list(diff.snapshot.mac_addrs)
+            elif diff.names_changed:
+                # A device registered while present starts its interval now
+                joined = list(diff.snapshot.mac_addrs)
+            if left:
+                await self._close(session, left, now)
+            if joined:
+                await self._open(session, joined, now)
+            await session.commit()
+        self._reconciled = True
+
+
+    @staticmethod
+    def _open_session_exists():
+        return exists().where(
+            models.PresenceSession.device_id == models.Device.id,
+            models.PresenceSession.end_datetime.is_(None),
+        )
+
+
+    async def _open(self, session: AsyncSession, mac_addrs: list[str], now: datetime.datetime):
+        devices = (
+            select(models.Device.id, models.Device.tracked_entity_id, literal(now))
+            .where(models.Device.mac_addr.in_(mac_addrs))
+            .where(~self._open_session_exists())
+        )
+        await session.execute(
+            insert(models.PresenceSession).from_select(
+                ["device_id", "tracked_entity_id", "start_datetime"], devices
+            )
+        )
+
+
+    async def _close(self, session: AsyncSession, mac_addrs: list[str], now: datetime.datetime):
+        devices = select(models.Device.id).where(models.Device.mac_addr.in_(mac_addrs))
+        await session.execute(
+            update(models.PresenceSession)
+            .where(models.PresenceSession.end_datetime.is_(None))
+            .where(models.PresenceSession.device_id.in_(devices))
+            .values(end_datetime=now)
+        )
+
+
+    async def _close_absent(self, session: AsyncSession, present_mac_addrs: tuple[str, ...], now: datetime.datetime):
+        present = select(models.Device.id).where(models.Device.mac_addr.in_(present_mac_addrs))
+        await session.execute(
+            update(models.PresenceSession)
+            .where(models.PresenceSession.end_datetime.is_(None))
+            .where(models.PresenceSession.device_id.not_in(present))
+            .values(end_datetime=now)
+        )
@@ -0,0 +1,251 @@
+"""Capture and replay of raw lease source responses.
+
+With LEASE_RECORD_FILE set, every response the lease sources fetch is
+appended to that file with its time, source and status. Bodies are zlib
+compressed, and a body identical to the source's previous one is stored
+as a reference to it, so a day of polls stays small. A crash can only
+leave a partial last record, which readers skip.
+
+`python -m src.cli replay-leases` serves a recording, or a synthetic churn
+profile, as a fake router at an accelerated speed. Point LEASE_SOURCES at
+it to run the whole poll pipeline through a day of traffic in minutes,
+with LEASE_POLL_INTERVAL and LEASE_LEAVE_HYSTERESIS divided by the speed.
+The replay scenario of tests/bench_load.py steps through one instead and
+reports the time spent per tick.
+"""
+import bisect
+import hashlib
+import logging
+import math
+import random
+import struct
+import time
+import zlib
+from typing import BinaryIO, Iterable, Iterator
+
+from aiohttp import web
+
+from src.utils import int_to_mac
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SEURANTA-LEASES\x01"
+# time, status, flags, source name length, data length
+RECORD = struct.Struct("!dHBHI")
+COMPRESSED = 0x1
+SAME_BODY = 0x2
+
+
+class Capture():
+    """One recorded fetch of a lease source."""
+    __slots__ = ("time", "source", "status", "body")
+
+    def __init__(self, time: float, source: str, status: int, body: bytes):
+        self.time = time
+        self.source = source
+        self.status = status
+        self.body = body
+
+
+    def __repr__(self):
+        return f"Capture(time={self.time}, source={self.source}, status={self.status}, body={len(self.body)} bytes)"
+
+
+class LeaseRecorder():
+    """Appends lease source responses to a recording file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: BinaryIO | None = None
+        self._previous: dict[str, bytes] = {}
+        self.records = 0
+
+
+    def _open(self) -> BinaryIO:
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            if self._file.tell() == 0:
+                self._file.write(MAGIC)
+        return self._file
+
+
+    def record(self, source: str, status: int, body: bytes = b"", now: float | None = None):
+        flags = 0
+        digest = hashlib.sha256(body).digest() if body else b""
+        if body and self._previous.get(source) == digest:
+            (flags, data) = (SAME_BODY, b"")
+        elif body:
+            (flags, data) = (COMPRESSED, zlib.compress(body))
+            self._previous[source] = digest
+        else:
+            data = b""
+        name = source.encode()
+        f = self._open()
+        f.write(RECORD.pack(time.time() if now is None else now, status, flags, len(name), len(data)) + name + data)
+        f.flush()
+        self.records += 1
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_recording(path: str) -> Iterator[Capture]:
+    """Captures of a recording in order, bodies of SAME_BODY records filled in."""
+    bodies: dict[str, bytes] = {}
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a lease recording")
+        while len(header := f.read(RECORD.size)) == RECORD.size:
+            (captured, status, flags, name_length, data_length) = RECORD.unpack(header)
+            name = f.read(name_length)
+            data = f.read(data_length)
+            if len(name) != name_length or len(data) != data_length:
+                logger.warning("Recording %s ends in a partial record", path)
+                return
+            source = name.decode()
+            if flags & SAME_BODY:
+                body = bodies.get(source, b"")
+            elif flags & COMPRESSED:
+                body = bodies[source] = zlib.decompress(data)
+            else:
+                body = data
+            yield Capture(captured, source, status, body)
+
+
+def _dnsmasq(leases: Iterable[tuple[int, str, str, str]]) -> bytes:
+    return "".join(f"{expires} {mac} {ip} {hostname} *\n" for (expires, mac, ip, hostname) in leases).encode()
+
+
+PROFILES = ("steady", "day")
+
+
+def synthetic_captures(profile: str = "day", devices: int = 200, hours: float = 24, interval: float = 15,
+                       churn: float = 0.02, start: float = 0, seed: int = 0) -> Iterator[Capture]:
+    """dnsmasq lease tables of a made-up population, one per poll interval.
+
+    steady keeps about half the devices present with a fraction churn of
+    them swapped every poll. day follows a daily curve, nearly empty at
+    night and busiest in the late afternoon, as in a club room.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown churn profile: {profile}")
+    rng = random.Random(seed)
+    population = [(int_to_mac(0x020000000000 + i), f"10.0.{i >> 8 & 255}.{i & 255}", f"device-{i}")
+                  for i in range(devices)]
+    present: set[int] = set()
+    for tick in range(int(hours * 3600 / interval)):
+        now = start + tick * interval
+        if profile == "day":
+            hour = now / 3600 % 24
+            occupancy = 0.05 + 0.6 * max(0.0, math.sin(math.pi * (hour - 10) / 14))
+        else:
+            occupancy = 0.5
+        target = round(devices * occupancy)
+        swaps = rng.sample(sorted(present), min(len(present), round(len(present) * churn)))
+        present.difference_update(swaps)
+        absent = [i for i in range(devices) if i not in present]
+        if len(present) < target:
+            present.update(rng.sample(absent, min(len(absent), target - len(present))))
+        elif len(present) > target:
+            present.difference_update(rng.sample(sorted(present), len(present) - target))
+        leases = ((int(now) + 3600, *population[i]) for i in sorted(present))
+        yield Capture(now, "synthetic", 200, _dnsmasq(leases))
+
+
+class ReplayServer():
+    """Fake router serving captured lease tables on their own, sped up clock.
+
+    Each source of the recording is served at /leases/<n>, numbered in
+    the order the sources first appear. A GET returns the latest capture
+    at the replay clock, with an ETag, so conditional GETs behave like
+    against a real router. Recorded failures are served as their status.
+    """
+
+    def __init__(self, captures: Iterable[Capture], speed: float = 60):
+        self.captures: list[list[Capture]] = []
+        self.sources: list[str] = []
+        for capture in captures:
+            if capture.source not in self.sources:
+                self.sources.append(capture.source)
+                self.captures.append([])
+            self.captures[self.sources.index(capture.source)].append(capture)
+        self._times = [[capture.time for capture in captures] for captures in self.captures]
+        self.start = min((captures[0].time for captures in self.captures), default=0)
+        self.end = max((captures[-1].time for captures in self.captures), default=0)
+        self.speed = speed
+        self._started = time.monotonic()
+        self._pinned: float | None = None
+        self.port: int | None = None
+        self.requests = 0
+
+
+    def now(self) -> float:
+        """The recorded time being replayed."""
+        if self._pinned is not None:
+            return self._pinned
+        return self.start + (time.monotonic() - self._started) * self.speed
+
+
+    def pin(self, replay_time: float | None):
+        """Stop the clock at replay_time, or let it run on from there with None."""
+        if replay_time is None and self._pinned is not None:
+            self._started = time.monotonic() - (self._pinned - self.start) / self.speed
+        self._pinned = replay_time
+
+
+    @property
+    def finished(self) -> bool:
+        return self.now() >= self.end
+
+
+    def capture_at(self, source: int, replay_time: float) -> tuple[int, Capture | None]:
+        captures = self.captures[source]
+        index = bisect.bisect_right(self._times[source], replay_time) - 1
+        if index < 0:
+            return -1, None
+        # An unchanged table is served from the capture that last had it
+        found = index
+        while found >= 0 and captures[found].status == 304:
+            found -= 1
+        if captures[index].status >= 400:
+            return found, captures[index]
+        if found < 0:
+            # Recorded as unchanged from a table the recording doesn't have
+            return -1, None
+        return found, captures[found]
+
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        try:
+            source = int(request.match_info["source"])
+            self.captures[source]
+        except (ValueError, IndexError):
+            raise web.HTTPNotFound()
+        (index, capture) = self.capture_at(source, self.now())
+        if capture is None:
+            return web.Response(status=503)
+        if capture.status >= 400:
+            return web.Response(status=capture.status)
+        etag = f'"{source}-{index}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=capture.body, content_type="text/plain", headers={"ETag": etag})
+
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/leases/{source}", self.handle)
+        return app
+
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        """Start serving in the background, the runner has to be cleaned up."""
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        self.port = runner.addresses[0][1]
+        return runner
@@ -0,0 +1,37 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import src.crud as crud
+import src.schemas as schemas
+from src.cache import rosters
+from src.lease_monitor import LeaseSnapshot
+
+
+def build_rosters(groups, mac_addrs: frozenset[str]) -> dict[int, schemas.GroupRoster]:
+    result = {}
+    for group in groups:
+        members = [
+            schemas.RosterMember(
+                name=membership.tracked_entity.name,
+                present=any(device.mac_addr in mac_addrs for device in membership.tracked_entity.devices),
+            )
+            for membership in group.members
+        ]
+        # Present members first, then by name
+        members.sort(key=lambda member: (not member.present, member.name))
+        result[group.id] = schemas.GroupRoster(
+            id=group.id,
+            name=group.name,
+            present=sum(member.present for member in members),
+            members=members,
+        )
+    return result
+
+
+async def get_group_rosters(db: AsyncSession, snapshot: LeaseSnapshot) -> dict[int, schemas.GroupRoster]:
+    """Rosters of every group by id, loaded in a fixed number of queries and cached per snapshot."""
+    key = rosters.key(snapshot.generation)
+    if (result := rosters.get(key)) is None:
+        groups = await crud.get_groups_with_members(db)
+        result = build_rosters(groups, frozenset(snapshot.mac_addrs))
+        rosters.set(key, result)
+    return result
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class PollScheduler():
+    """Runs a poll job repeatedly, one run at a time.
+
+    The next run is scheduled only after the previous one has finished.
+    The interval halves while the job reports churn and grows back
+    towards max_interval while nothing changes. Without explicit bounds
+    it stays between a third and four times the base interval. Failed
+    runs back off exponentially. Every delay gets some random jitter, so
+    several instances don't poll in lockstep.
+    """
+
+    def __init__(self, job: Callable[[], Awaitable[int]], churn: Callable[[], int],
+                 interval: float = 15, min_interval: float | None = None, max_interval: float | None = None,
+                 max_backoff: float = 300, jitter: float = 0.1):
+        self._job = job
+        self._churn = churn
+        self.base_interval = interval
+        self.min_interval = interval / 3 if min_interval is None else min_interval
+        self.max_interval = interval * 4 if max_interval is None else max_interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.interval = interval
+        self.failures = 0
+        self.runs = 0
+        self.lag: float = 0
+        self.last_duration: float | None = None
+        self._task: asyncio.Task | None = None
+
+
+    def start(self, delay: float = 0):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(delay))
+
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+    async def run_once(self) -> float:
+        """Run the job once and return the delay until the next run."""
+        started = time.perf_counter()
+        try:
+            status = await self._job()
+        except Exception:
+            logger.exception("Poll job failed")
+            status = 500
+        self.last_duration = time.perf_counter() - started
+        self.runs += 1
+        return self._next_delay(status)
+
+
+    def _next_delay(self, status: int) -> float:
+        if status >= 400:
+            self.failures += 1
+            delay = min(self.base_interval * 2 ** self.failures, self.max_backoff)
+        else:
+            self.failures = 0
+            if self._churn():
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 1.25)
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+    async def _run(self, delay: float = 0):
+        while True:
+            due = time.monotonic() + delay
+            await asyncio.sleep(delay)
+            self.lag = max(0, time.monotonic() - due)
+            delay = await self.run_once()
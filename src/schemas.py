@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+import datetime
 
 class TrackedEntityBase(BaseModel):
     name: str
@@ -32,4 +33,34 @@ class MembershipCreate(MembershipBase):
 
 class MembershipDelete(MembershipBase):
     tracked_entity_id: int
-    group_id: int
\ No newline at end of file
+    group_id: int
+
+class OccupancyHour(BaseModel):
+    hour_start: datetime.datetime
+    entities: int
+
+class WeekdayOccupancy(BaseModel):
+    weekday: int
+    hour: int
+    mean_entities: float
+
+class EntityPresenceTotal(BaseModel):
+    name: str
+    minutes: int
+    days: int
+
+class OccupancyStats(BaseModel):
+    since: datetime.date
+    hourly: list[OccupancyHour]
+    weekday: list[WeekdayOccupancy]
+    entities: list[EntityPresenceTotal]
+
+class RosterMember(BaseModel):
+    name: str
+    present: bool
+
+class GroupRoster(BaseModel):
+    id: int
+    name: str
+    present: int
+    members: list[RosterMember]
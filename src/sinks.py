@@ -0,0 +1,414 @@
+"""Export sinks, the ways presence leaves the process.
+
+The leader's lease updates are turned into PresenceUpdates once and handed
+to every sink. A sink has its own bounded queue, batching window, limit of
+concurrent deliveries and delivery timeout, so a slow or dead consumer
+only ever delays itself. When its queue is full the oldest update is
+dropped. Sinks besides Kattila are configured with EXPORT_SINKS, a JSON
+list such as
+
+    [{"type": "webhook", "url": "https://example.org/hook", "batch_window": 5},
+     {"type": "jsonl", "path": "/var/lib/seuranta/presence.jsonl"},
+     {"type": "mqtt", "host": "broker", "topic": "linkki/presence"}]
+
+Every entry may also set name, batch_window (seconds), max_batch,
+concurrency, max_pending and timeout (seconds).
+"""
+import asyncio
+import datetime
+import functools
+import json
+import logging
+import os
+import struct
+import time
+from typing import Any, Sequence
+
+import httpx
+from sqlalchemy.orm import sessionmaker
+
+import src.crud as crud
+from src.cache import presence_names
+from src.lease_monitor import LeaseDiff
+from src.metrics import export_seconds, export_updates
+
+logger = logging.getLogger(__name__)
+
+
+class SinkError(Exception):
+    pass
+
+
+class PresenceUpdate():
+    """Who is present after one lease update, and who came and went."""
+    __slots__ = ("generation", "time", "present", "joined", "left")
+
+    def __init__(self, generation: int, present: Sequence[str], joined: Sequence[str] = (), left: Sequence[str] = (),
+                 time: datetime.datetime | None = None):
+        self.generation = generation
+        self.time = time or datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.present: list[str] = list(present)
+        self.joined: list[str] = list(joined)
+        self.left: list[str] = list(left)
+
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "generation": self.generation,
+            "time": self.time.isoformat(),
+            "present": self.present,
+            "joined": self.joined,
+            "left": self.left,
+        }
+
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), separators=(",", ":"))
+
+
+class Sink():
+    """Base of the export sinks, subclasses implement deliver().
+
+    Updates arriving within batch_window seconds of the first one are
+    delivered together, at most max_batch at a time. With coalesce only
+    the latest update of a batch is delivered, for consumers that only
+    care about the current state.
+    """
+    type = "sink"
+    coalesce = False
+
+    def __init__(self, name: str | None = None, batch_window: float = 0, max_batch: int = 100,
+                 concurrency: int = 1, max_pending: int = 1000, timeout: float | None = 30):
+        self.name = name or self.type
+        self._batch_window = batch_window
+        self._max_batch = max_batch
+        self._timeout = timeout
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queue: asyncio.Queue[PresenceUpdate] = asyncio.Queue(maxsize=max_pending)
+        self._worker: asyncio.Task | None = None
+        self._deliveries: set[asyncio.Task] = set()
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+
+    @property
+    def enabled(self) -> bool:
+        return True
+
+
+    def submit(self, update: PresenceUpdate):
+        if not self.enabled:
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self._count("dropped")
+        self._queue.put_nowait(update)
+
+
+    async def start(self):
+        if self._worker is None and self.enabled:
+            self._worker = asyncio.create_task(self._run())
+
+
+    async def close(self):
+        tasks = [*self._deliveries, *([self._worker] if self._worker is not None else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        # Updates left behind are stale by the time the sink starts again
+        self._queue = asyncio.Queue(maxsize=self._queue.maxsize)
+
+
+    async def join(self):
+        await self._queue.join()
+
+
+    def _count(self, result: str, updates: int = 1):
+        setattr(self, result, getattr(self, result) + updates)
+        export_updates.inc(updates, sink=self.name, result=result)
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._batch_window
+            while len(batch) < self._max_batch:
+                try:
+                    if (remaining := deadline - loop.time()) > 0:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(batch))
+            self._deliveries.add(task)
+            task.add_done_callback(functools.partial(self._delivered, self._queue, len(batch)))
+
+
+    def _delivered(self, queue: asyncio.Queue[PresenceUpdate], updates: int, task: asyncio.Task):
+        # Also runs for a delivery cancelled before it started
+        self._deliveries.discard(task)
+        self._slots.release()
+        for _ in range(updates):
+            queue.task_done()
+
+
+    async def _deliver(self, batch: list[PresenceUpdate]):
+        if self.coalesce and len(batch) > 1:
+            self._count("dropped", len(batch) - 1)
+            batch = batch[-1:]
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            delivered = await asyncio.wait_for(self.deliver(batch), self._timeout)
+            outcome = "sent" if delivered else "dropped"
+            self._count(outcome, len(batch))
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning("Export to %s timed out", self.name)
+            self._count("failed", len(batch))
+        except Exception as e:
+            logger.warning("Export to %s failed: %r", self.name, e)
+            self._count("failed", len(batch))
+        finally:
+            export_seconds.observe(time.perf_counter() - started, sink=self.name, outcome=outcome)
+
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        """Send a batch, returning False if it was given up on as superseded."""
+        raise NotImplementedError
+
+
+class WebhookSink(Sink):
+    """POSTs each batch as {"updates": [...]} to a URL."""
+    type = "webhook"
+
+    def __init__(self, url: str, headers: dict[str, str] | None = None,
+                 transport: httpx.AsyncBaseTransport | None = None, **kwargs):
+        kwargs.setdefault("batch_window", 1)
+        kwargs.setdefault("concurrency", 2)
+        super().__init__(**kwargs)
+        self.url = url
+        self._headers = headers or {}
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(10, connect=5), headers=self._headers,
+                                             transport=self._transport)
+        await super().start()
+
+
+    async def close(self):
+        await super().close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        response = await self._client.post(self.url, json={"updates": [update.as_dict() for update in batch]})
+        response.raise_for_status()
+        return True
+
+
+class JsonlFileSink(Sink):
+    """Appends every update to a file as one JSON line."""
+    type = "jsonl"
+
+    def __init__(self, path: str, **kwargs):
+        kwargs.setdefault("batch_window", 1)
+        # Lines have to stay in order
+        kwargs["concurrency"] = 1
+        super().__init__(**kwargs)
+        self.path = path
+
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        await asyncio.to_thread(self._append, "".join(update.to_json() + "\n" for update in batch))
+        return True
+
+
+    def _append(self, lines: str):
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+
+class MqttSink(Sink):
+    """Publishes every update to an MQTT topic, retained so new subscribers get the latest.
+
+    Speaks just enough MQTT 3.1.1 to connect and publish at QoS 0 or 1,
+    over one connection that is opened again after errors.
+    """
+    type = "mqtt"
+
+    def __init__(self, host: str, port: int = 1883, topic: str = "seuranta/presence", qos: int = 1,
+                 retain: bool = True, client_id: str | None = None, username: str | None = None,
+                 password: str | None = None, **kwargs):
+        # One connection, one publish at a time
+        kwargs["concurrency"] = 1
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        self._client_id = client_id or f"seuranta-{os.getpid()}"
+        self._username = username
+        self._password = password
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._packet_id = 0
+
+
+    @staticmethod
+    def _string(value: str | bytes) -> bytes:
+        data = value.encode() if isinstance(value, str) else value
+        return struct.pack("!H", len(data)) + data
+
+
+    @staticmethod
+    def _packet(header: int, body: bytes) -> bytes:
+        length = len(body)
+        encoded = bytearray()
+        while True:
+            (length, digit) = divmod(length, 128)
+            encoded.append(digit | (0x80 if length else 0))
+            if not length:
+                break
+        return bytes([header]) + bytes(encoded) + body
+
+
+    async def _read_packet(self) -> tuple[int, bytes]:
+        header = (await self._reader.readexactly(1))[0]
+        (length, shift) = (0, 0)
+        while True:
+            digit = (await self._reader.readexactly(1))[0]
+            length += (digit & 0x7F) << shift
+            shift += 7
+            if not digit & 0x80:
+                break
+        return header, await self._reader.readexactly(length)
+
+
+    async def _connect(self):
+        (self._reader, self._writer) = await asyncio.open_connection(self.host, self.port)
+        flags = 0x02  # clean session
+        payload = self._string(self._client_id)
+        if self._username is not None:
+            flags |= 0x80
+            payload += self._string(self._username)
+            if self._password is not None:
+                flags |= 0x40
+                payload += self._string(self._password)
+        # Keep alive off, a dropped connection shows up as an error on the next publish
+        body = self._string("MQTT") + bytes([4, flags]) + struct.pack("!H", 0) + payload
+        self._writer.write(self._packet(0x10, body))
+        await self._writer.drain()
+        (header, body) = await self._read_packet()
+        if header >> 4 != 2 or len(body) != 2 or body[1] != 0:
+            raise SinkError(f"MQTT connection refused: {body.hex()}")
+
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+            self._writer = self._reader = None
+
+
+    async def _publish(self, payload: str):
+        header = 0x30 | (self.qos << 1) | int(self.retain)
+        body = self._string(self.topic)
+        if self.qos:
+            self._packet_id = self._packet_id % 0xFFFF + 1
+            body += struct.pack("!H", self._packet_id)
+        self._writer.write(self._packet(header, body + payload.encode()))
+        await self._writer.drain()
+        if self.qos:
+            (header, body) = await self._read_packet()
+            if header >> 4 != 4 or body != struct.pack("!H", self._packet_id):
+                raise SinkError(f"Unexpected MQTT packet {header:#x} waiting for PUBACK")
+
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        try:
+            if self._writer is None:
+                await self._connect()
+            for update in batch:
+                await self._publish(update.to_json())
+        except BaseException:
+            await self._disconnect()
+            raise
+        return True
+
+
+    async def close(self):
+        await super().close()
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(self._packet(0xE0, b""))
+        await self._disconnect()
+
+
+SINKS: dict[str, type[Sink]] = {sink.type: sink for sink in (WebhookSink, JsonlFileSink, MqttSink)}
+
+
+def parse_sinks(spec: str) -> list[Sink]:
+    """Sinks from a JSON list such as the EXPORT_SINKS variable, see the module docstring."""
+    sinks: list[Sink] = []
+    for entry in json.loads(spec):
+        options = dict(entry)
+        sinks.append(SINKS[options.pop("type")](**options))
+    return sinks
+
+
+class PresenceExport():
+    """Turns the leader's lease updates into PresenceUpdates for every sink.
+
+    Publishing only puts the update in each sink's queue, so the poll loop
+    never waits for a consumer.
+    """
+
+    def __init__(self, sessionmaker: sessionmaker, sinks: list[Sink]):
+        self._sessionmaker = sessionmaker
+        self.sinks = [sink for sink in sinks if sink.enabled]
+        self._present: set[str] | None = None
+
+
+    async def start(self):
+        for sink in self.sinks:
+            await sink.start()
+
+
+    async def close(self):
+        await asyncio.gather(*(sink.close() for sink in self.sinks))
+
+
+    async def publish(self, diff: LeaseDiff):
+        if not diff.membership_changed or not self.sinks:
+            return
+        key = presence_names.key(diff.snapshot.generation)
+        if (names := presence_names.get(key)) is None:
+            async with self._sessionmaker() as session:
+                names = await crud.get_tracked_entity_names_by_mac_addrs(session, diff.snapshot.mac_addrs)
+            presence_names.set(key, names)
+        present = set(names)
+        previous = self._present if self._present is not None else set()
+        if present == self._present:
+            # Devices came and went, people didn't
+            return
+        self._present = present
+        update = PresenceUpdate(diff.snapshot.generation, names,
+                                joined=sorted(present - previous), left=sorted(previous - present))
+        for sink in self.sinks:
+            sink.submit(update)
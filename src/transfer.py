@@ -0,0 +1,158 @@
+"""Bulk import from the legacy SQLite database and export to CSV/JSONL.
+
+Rows are streamed in batches and written with multi-row upserts, one
+transaction per batch. Everything is keyed on natural keys (entity name,
+device MAC), so an interrupted import can simply be run again: rows that
+made it in are skipped and the rest are loaded.
+"""
+import csv
+import datetime
+import json
+import sqlite3
+import sys
+import time
+from typing import Callable, Iterator, TextIO
+
+from sqlalchemy import Engine, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+import src.models as models
+from src.utils import normalise_mac
+
+BATCH_SIZE = 5000
+
+
+class Progress():
+    """Rows per second of a running transfer, printed once per batch."""
+
+    def __init__(self, label: str, out: TextIO | None = sys.stderr):
+        self.label = label
+        self.rows = 0
+        self.skipped = 0
+        self._out = out
+        self._started = time.perf_counter()
+
+
+    def advance(self, rows: int, skipped: int = 0):
+        self.rows += rows
+        self.skipped += skipped
+        if self._out is not None:
+            elapsed = time.perf_counter() - self._started
+            self._out.write(f"\r{self.label}: {self.rows} rows, {self.skipped} skipped, {self.rows / max(elapsed, 1e-9):.0f} rows/s")
+            self._out.flush()
+
+
+    def done(self):
+        if self._out is not None:
+            self._out.write("\n")
+
+
+def _batches(cursor: sqlite3.Cursor, size: int) -> Iterator[list[tuple]]:
+    while rows := cursor.fetchmany(size):
+        yield rows
+
+
+def _insert(engine: Engine):
+    return {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[engine.dialect.name]
+
+
+def _columns(con: sqlite3.Connection, table: str) -> list[str]:
+    return [column[0] for column in con.execute(f"SELECT * FROM {table} LIMIT 0").description]
+
+
+def import_legacy(legacy_path: str, engine: Engine, batch_size: int = BATCH_SIZE,
+                  progress: Callable[[str], Progress] = Progress) -> dict[str, int]:
+    """Load the tracked entities and devices of the old SQLite database.
+
+    Entities without devices are left out, as before. Entities are merged
+    by name and devices by MAC with whatever the target already has.
+    """
+    insert = _insert(engine)
+    with sqlite3.connect(f"file:{legacy_path}?mode=ro", uri=True) as con:
+        # The legacy tables are positional: (name, id, created) and (hostname, mac, entity id)
+        (te_name, te_id, te_created) = _columns(con, "trackedentity")[:3]
+        (d_hostname, d_mac, d_entity) = _columns(con, "device")[:3]
+
+        entity_ids: dict[int, int] = {}
+        entities = progress("tracked entities")
+        cursor = con.execute(
+            f"SELECT {te_name}, {te_id}, {te_created} FROM trackedentity te "
+            f"WHERE EXISTS (SELECT 1 FROM device d WHERE d.{d_entity} = te.{te_id}) ORDER BY {te_id}"
+        )
+        for rows in _batches(cursor, batch_size):
+            # DO UPDATE can't touch a row twice in one statement, so names are deduplicated first
+            values = {}
+            for (name, legacy_id, created) in rows:
+                values.setdefault(name, {"name": name, "created_datetime": datetime.datetime.fromisoformat(created)})
+            stmt = insert(models.TrackedEntity).values(list(values.values()))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[models.TrackedEntity.name],
+                set_={"name": stmt.excluded.name},
+            ).returning(models.TrackedEntity.id, models.TrackedEntity.name)
+            with engine.begin() as connection:
+                ids = dict((name, id) for (id, name) in connection.execute(stmt))
+            for (name, legacy_id, _) in rows:
+                entity_ids[legacy_id] = ids[name]
+            entities.advance(len(rows))
+        entities.done()
+
+        devices = progress("devices")
+        inserted = 0
+        cursor = con.execute(f"SELECT {d_hostname}, {d_mac}, {d_entity} FROM device ORDER BY rowid")
+        for rows in _batches(cursor, batch_size):
+            values = []
+            for (hostname, mac_addr, legacy_entity_id) in rows:
+                try:
+                    values.append({
+                        "mac_addr": normalise_mac(mac_addr),
+                        "hostname": hostname,
+                        "tracked_entity_id": entity_ids[legacy_entity_id],
+                    })
+                except (ValueError, TypeError, KeyError):
+                    continue
+            if values:
+                stmt = (insert(models.Device).values(values)
+                        .on_conflict_do_nothing(index_elements=[models.Device.mac_addr])
+                        .returning(models.Device.id))
+                with engine.begin() as connection:
+                    inserted += len(connection.execute(stmt).all())
+            devices.advance(len(values), len(rows) - len(values))
+        devices.done()
+    return {"tracked_entities": len(set(entity_ids.values())), "devices": inserted, "skipped": devices.skipped}
+
+
+EXPORTS = {
+    "entities": (models.TrackedEntity.id, models.TrackedEntity.name, models.TrackedEntity.created_datetime),
+    "devices": (models.Device.id, models.Device.mac_addr, models.Device.name, models.Device.hostname,
+                models.Device.tracked_entity_id),
+    "memberships": (models.Membership.tracked_entity_id, models.Membership.group_id, models.Membership.joined_date),
+}
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def export(engine: Engine, table: str, out: TextIO, format: str = "csv", batch_size: int = BATCH_SIZE,
+           progress: Callable[[str], Progress] = Progress) -> int:
+    """Stream one table to out as CSV with a header row, or as JSON lines."""
+    columns = EXPORTS[table]
+    names = [column.key for column in columns]
+    writer = csv.writer(out) if format == "csv" else None
+    if writer is not None:
+        writer.writerow(names)
+    report = progress(table)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+            select(*columns).order_by(columns[0])
+        )
+        for rows in result.partitions():
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                out.writelines(json.dumps(dict(zip(names, map(_json_value, row)))) + "\n" for row in rows)
+            report.advance(len(rows))
+    report.done()
+    return report.rows
@@ -1,10 +1,10 @@
+import hashlib
+import os
 import re
-import httpx
 from jinja2 import Environment, FileSystemLoader
 from fastapi.templating import Jinja2Templates
-from get_docker_secret import get_docker_secret
-import os
 
+NAME_MINLENGTH = 2
 NAME_MAXLENGTH = 20
 
 JINJA_ENV = Environment(
@@ -13,15 +13,41 @@ JINJA_ENV = Environment(
 )
 JINJA_TEMPLATES = Jinja2Templates(env=JINJA_ENV)
 
-KATTILA_API_URL = os.getenv("KATTILA_API_URL", None)
-_KATTILA_API_KEY = get_docker_secret("apikey")
+def templates_digest(directory: str = "templates") -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), "rb") as f:
+                digest.update(name.encode() + b"\0" + f.read())
+    return digest.hexdigest()
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match calls for
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
 
 def sanitise_name(name: str, max_length: int = NAME_MAXLENGTH) -> str:
     return re.sub(r'[^a-zA-Z0-9]', '', name)[:max_length]
 
+def valid_name(name: str) -> str:
+    """The sanitised name, ValueError if too little of it is left."""
+    name = sanitise_name(name)
+    if len(name) < NAME_MINLENGTH:
+        raise ValueError(f"Name must have at least {NAME_MINLENGTH} letters or digits")
+    return name
+
+def mac_to_int(mac_addr: str) -> int:
+    digits = re.sub(r'[:.-]', '', mac_addr)
+    if len(digits) != 12:
+        raise ValueError(f"Not a MAC address: {mac_addr}")
+    return int(digits, 16)
+
+def int_to_mac(value: int) -> str:
+    digits = f"{value:012x}"
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
 
-async def export_names(names: list[str]):
-    if KATTILA_API_URL:
-        headers = {"X-API-Key": _KATTILA_API_KEY}
-        json={"users": [{"username": name} for name in names]}
-        httpx.put(f"{KATTILA_API_URL}/seuranta/users", headers=headers, json=json)
\ No newline at end of file
+def normalise_mac(mac_addr: str) -> str:
+    return int_to_mac(mac_to_int(mac_addr))
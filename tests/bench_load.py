@@ -0,0 +1,245 @@
+"""Load benchmark for the ASGI app and the lease pipeline.
+
+Not collected with the regular tests, run it explicitly:
+
+    python -m pytest -s tests/bench_load.py
+
+BENCH_LEASES, BENCH_ENTITIES, BENCH_REQUESTS and BENCH_CONCURRENCY size the
+run. The replay scenario polls through BENCH_RECORDING, a file recorded with
+LEASE_RECORD_FILE, or else a synthetic day of BENCH_PROFILE churn, one tick
+per recorded table up to BENCH_REPLAY_TICKS. The results are printed as
+JSON and also written to BENCH_OUTPUT when it is set, so runs on different
+commits can be compared.
+"""
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import time
+from typing import Awaitable, Callable
+
+import pytest
+import pytest_asyncio
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import src.main as main
+import src.models as models
+from src.cache import presence_names, identities
+from src.lease_monitor import LeaseSnapshot
+from src.lease_sources import Lease, LeaseSource, LeaseFetch, HttpLeaseSource
+from src.replay import ReplayServer, read_recording, synthetic_captures
+from src.utils import int_to_mac
+
+LEASES = int(os.getenv("BENCH_LEASES", 10000))
+ENTITIES = int(os.getenv("BENCH_ENTITIES", 5000))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", 500))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 20))
+TICKS = int(os.getenv("BENCH_TICKS", 20))
+RECORDING = os.getenv("BENCH_RECORDING")
+PROFILE = os.getenv("BENCH_PROFILE", "day")
+REPLAY_TICKS = int(os.getenv("BENCH_REPLAY_TICKS", 5760))
+
+
+def synthetic_leases(count: int) -> list[Lease]:
+    return [Lease(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", f"host-{i}", int_to_mac(0x020000000000 + i))
+            for i in range(count)]
+
+
+class ChurnSource(LeaseSource):
+    """Serves the population with a random slice of it missing on every fetch."""
+
+    def __init__(self, leases: list[Lease], churn: int):
+        super().__init__("bench")
+        self._leases = leases
+        self._churn = churn
+
+    async def _fetch(self, http) -> LeaseFetch:
+        missing = set(random.sample(range(len(self._leases)), min(self._churn, len(self._leases))))
+        return LeaseFetch(200, [lease for i, lease in enumerate(self._leases) if i not in missing])
+
+
+class QueryCounter():
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+@pytest_asyncio.fixture
+async def bench_sessionmaker(tmp_path):
+    # A file rather than :memory:, which shares one connection between all sessions
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'bench.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+    BenchSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    BenchSessionLocal.queries = QueryCounter(engine)
+    yield BenchSessionLocal
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def population(bench_sessionmaker) -> list[Lease]:
+    leases = synthetic_leases(LEASES)
+    created = datetime.datetime.now().replace(microsecond=0)
+    async with bench_sessionmaker() as session:
+        await session.execute(insert(models.TrackedEntity), [
+            {"id": i + 1, "name": f"entity{i}", "created_datetime": created}
+            for i in range(ENTITIES)
+        ])
+        await session.execute(insert(models.Device), [
+            {"mac_addr": leases[i].mac_addr, "hostname": leases[i].hostname, "tracked_entity_id": i + 1}
+            for i in range(min(ENTITIES, LEASES))
+        ])
+        await session.commit()
+    return leases
+
+
+@pytest_asyncio.fixture
+async def bench_app(monkeypatch, bench_sessionmaker, population):
+    async def get_session_override():
+        async with bench_sessionmaker() as session:
+            yield session
+
+    presence_names.invalidate()
+    identities.clear()
+    monkeypatch.setattr(main.lease_monitor, "_snapshot", LeaseSnapshot(population))
+    monkeypatch.setattr(main.lease_monitor, "_sessionmaker", bench_sessionmaker)
+    monkeypatch.setattr(main.lease_monitor, "_leave_hysteresis", 0)
+    monkeypatch.setattr(main.lease_monitor, "_snapshot_file", None)
+    source = ChurnSource(population, churn=max(1, LEASES // 100))
+    monkeypatch.setattr(main.lease_monitor, "_sources", [source])
+    monkeypatch.setattr(main.lease_monitor, "_source_leases", {source.name: list(population)})
+    monkeypatch.setattr(main.lease_monitor, "start", lambda: asyncio.sleep(0))
+    for listener in (main.presence_history, main.occupancy_rollups, main.presence_feed):
+        monkeypatch.setattr(listener, "_sessionmaker", bench_sessionmaker)
+    main.app.dependency_overrides[main.get_session] = get_session_override
+    yield main.app
+    main.app.dependency_overrides.clear()
+
+
+def client_for(app, ip: str) -> AsyncClient:
+    return AsyncClient(transport=ASGITransport(app=app, client=(ip, 50000)), base_url="http://bench")
+
+
+async def run_scenario(name: str, operations: list[Callable[[], Awaitable[None]]],
+                       queries: QueryCounter, concurrency: int) -> dict:
+    latencies: list[float] = []
+    pending = iter(operations)
+    queries_before = queries.count
+
+    async def worker():
+        for operation in pending:
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "queries_per_request": round((queries.count - queries_before) / len(latencies), 2),
+    }
+
+
+def report(results: list[dict]):
+    output = json.dumps({
+        "population": {"leases": LEASES, "entities": ENTITIES},
+        "scenarios": results,
+    }, indent=2)
+    print(output)
+    if path := os.getenv("BENCH_OUTPUT"):
+        with open(path, "w") as f:
+            f.write(output)
+
+
+@pytest.mark.asyncio
+async def test_benchmark(bench_app, bench_sessionmaker, population):
+    queries = bench_sessionmaker.queries
+    registered = [lease.ipv4_addr for lease in population[:ENTITIES]]
+    unregistered = [lease.ipv4_addr for lease in population[ENTITIES:]]
+    visitors = registered + unregistered
+
+    async def get_root(ip: str):
+        async with client_for(bench_app, ip) as client:
+            response = await client.get("/")
+            assert response.status_code == 200
+
+    async def post_name_form(ip: str, name: str):
+        async with client_for(bench_app, ip) as client:
+            response = await client.post("/name-form", data={"username": name})
+            assert response.status_code == 302
+
+    async def update_leases():
+        assert await main.lease_monitor.update_leases() < 400
+
+    results = []
+    results.append(await run_scenario(
+        "get_root",
+        [lambda ip=random.choice(visitors): get_root(ip) for _ in range(REQUESTS)],
+        queries, CONCURRENCY,
+    ))
+    if signups := random.sample(unregistered, min(REQUESTS, len(unregistered))):
+        results.append(await run_scenario(
+            "post_name_form",
+            [lambda ip=ip, i=i: post_name_form(ip, f"bench{i}") for i, ip in enumerate(signups)],
+            queries, CONCURRENCY,
+        ))
+    results.append(await run_scenario(
+        "update_leases",
+        [update_leases for _ in range(TICKS)],
+        queries, 1,
+    ))
+
+    # Page loads while the poller runs, as in production
+    poller_ticks = [update_leases for _ in range(TICKS)]
+    page_loads = [lambda ip=random.choice(visitors): get_root(ip) for _ in range(REQUESTS)]
+    (mixed, ticks) = await asyncio.gather(
+        run_scenario("mixed_get_root", page_loads, queries, CONCURRENCY),
+        run_scenario("mixed_update_leases", poller_ticks, queries, 1),
+    )
+    # Queries of concurrent scenarios can't be told apart
+    mixed["queries_per_request"] = ticks["queries_per_request"] = None
+    results += [mixed, ticks]
+    report(results)
+
+
+@pytest.mark.asyncio
+async def test_replay(monkeypatch, bench_app, bench_sessionmaker, population):
+    captures = read_recording(RECORDING) if RECORDING else synthetic_captures(PROFILE, devices=LEASES)
+    server = ReplayServer(captures)
+    runner = await server.serve()
+    sources = [HttpLeaseSource(f"http://127.0.0.1:{server.port}/leases/{i}", name=name)
+               for i, name in enumerate(server.sources)]
+    monkeypatch.setattr(main.lease_monitor, "_sources", sources)
+    monkeypatch.setattr(main.lease_monitor, "_source_leases", {source.name: [] for source in sources})
+    monkeypatch.delattr(main.lease_monitor, "start")
+
+    async def tick(replay_time: float):
+        server.pin(replay_time)
+        assert await main.lease_monitor.update_leases() < 500
+
+    times = sorted({capture.time for captures in server.captures for capture in captures})[:REPLAY_TICKS]
+    try:
+        result = await run_scenario("replay_update_leases", [lambda t=t: tick(t) for t in times],
+                                    bench_sessionmaker.queries, 1)
+    finally:
+        await main.lease_monitor.close()
+        await runner.cleanup()
+    result["replayed_hours"] = round((times[-1] - times[0]) / 3600, 2)
+    report([result])
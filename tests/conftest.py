@@ -2,7 +2,8 @@ import pytest
 from sqlalchemy.orm import sessionmaker
 from src.main import app, lease_monitor, get_session
 import src.models as models
-from src.lease_monitor import Lease
+from src.lease_monitor import Lease, LeaseSnapshot
+from src.cache import presence_names, identities, rosters, name_index
 
 # async dependencies
 import pytest_asyncio
@@ -22,15 +23,19 @@ def mock_leases():
     return mock_leases
 
 @pytest_asyncio.fixture()
-async def async_session():
+async def async_sessionmaker():
     test_engine = create_async_engine("sqlite+aiosqlite:///:memory:")
     TestSessionLocal = sessionmaker(
         test_engine, expire_on_commit=False, class_=AsyncSession
     )
     async with test_engine.begin() as connection:
         await connection.run_sync(models.Base.metadata.create_all)
+    yield TestSessionLocal
+    await test_engine.dispose()
 
-    async with TestSessionLocal() as session:
+@pytest_asyncio.fixture()
+async def async_session(async_sessionmaker):
+    async with async_sessionmaker() as session:
         try:
             yield session
         finally:
@@ -41,7 +46,13 @@ async def async_client(monkeypatch, async_session, mock_leases):
     def get_session_override():
         return async_session
 
-    monkeypatch.setattr(lease_monitor, "_leases", mock_leases)
+    # Each test gets a fresh database, don't let caches leak between them
+    presence_names.invalidate()
+    identities.clear()
+    rosters.invalidate()
+    name_index.invalidate()
+    name_index.load([], name_index.generation)
+    monkeypatch.setattr(lease_monitor, "_snapshot", LeaseSnapshot(mock_leases))
     monkeypatch.setattr(lease_monitor, "fetch_leases", 200)
     app.dependency_overrides[get_session] = get_session_override
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
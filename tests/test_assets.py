@@ -0,0 +1,82 @@
+import gzip
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from src.assets import StaticAssets, AssetStaticFiles, accepted_encodings, IMMUTABLE
+
+CSS = "body { background: url('images/bg.svg'); }\n" * 20
+SVG = "<svg xmlns='http://www.w3.org/2000/svg'>" + "<rect width='1' height='1'/>" * 20 + "</svg>"
+
+
+@pytest.fixture
+def assets(tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "styles.css").write_text(CSS)
+    (tmp_path / "images" / "bg.svg").write_text(SVG)
+    StaticAssets(str(tmp_path)).build()
+    assets = StaticAssets(str(tmp_path))
+    assets.load()
+    return assets
+
+def test_build_fingerprints_and_rewrites_css(assets, tmp_path):
+    svg = assets.assets["images/bg.svg"]
+    assert svg.startswith("images/bg.") and svg.endswith(".svg")
+    css = (tmp_path / "build" / assets.assets["styles.css"]).read_text()
+    assert f"url({svg})" in css
+    assert gzip.decompress((tmp_path / "build" / (svg + ".gz")).read_bytes()).decode() == SVG
+    assert assets.url("/styles.css") == f"/static/build/{assets.assets['styles.css']}"
+    assert assets.url("missing.png") == "/static/missing.png"
+
+def test_load_falls_back_without_matching_build(assets, tmp_path):
+    (tmp_path / "images" / "bg.svg").write_text(SVG.replace("1", "2"))
+    stale = StaticAssets(str(tmp_path))
+    stale.load()
+    assert stale.url("images/bg.svg") == "/static/images/bg.svg"
+    assert stale.digest != assets.digest
+    missing = StaticAssets(str(tmp_path / "missing"))
+    missing.load()
+    assert missing.url("styles.css") == "/static/styles.css"
+
+def test_build_renames_changed_assets(assets, tmp_path):
+    built = dict(assets.assets)
+    (tmp_path / "images" / "bg.svg").write_text(SVG.replace("1", "2"))
+    StaticAssets(str(tmp_path)).build()
+    rebuilt = StaticAssets(str(tmp_path))
+    rebuilt.load()
+    assert rebuilt.assets["images/bg.svg"] != built["images/bg.svg"]
+    # The stylesheet points at the new image so it gets a new name too
+    assert rebuilt.assets["styles.css"] != built["styles.css"]
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate, br;q=0.5") == {"gzip", "deflate", "br"}
+    assert accepted_encodings("br;q=0, gzip") == {"gzip"}
+    assert accepted_encodings("") == set()
+
+@pytest.mark.asyncio
+async def test_serves_precompressed_immutable_assets(assets):
+    app = Starlette(routes=[Mount("/static", AssetStaticFiles(assets))])
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        url = assets.url("styles.css")
+        response = await client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["cache-control"] == IMMUTABLE
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.headers["content-type"].startswith("text/css")
+        assert "url(images/bg." in response.text
+
+        response = await client.get(url, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in response.headers
+        assert response.headers["cache-control"] == IMMUTABLE
+
+        response = await client.get("/static/styles.css")
+        assert response.text == CSS
+        assert "cache-control" not in response.headers
+
+@pytest.mark.asyncio
+async def test_templates_use_fingerprinted_urls(async_client):
+    response = await async_client.get("/")
+    assert "/static/build/styles." in response.text
+    assert "/static/images/" not in response.text
@@ -0,0 +1,244 @@
+import asyncio
+import datetime
+
+import pytest
+import src.crud as crud
+import src.models as models
+import src.schemas as schemas
+
+from src.cache import presence_names, identities, invalidate, name_index
+import src.cluster as cluster_module
+from src.cluster import Cluster, Coordinator, PostgresCoordinator
+from src.lease_monitor import Lease, LeaseMonitor, LeaseSnapshot, encode_leases, decode_leases
+
+
+class Bus():
+    """Advisory lock and notifications shared by the fake coordinators."""
+
+    def __init__(self):
+        self.holder = None
+        self.coordinators = []
+
+
+class FakeCoordinator(Coordinator):
+    shared = True
+
+    def __init__(self, bus: Bus):
+        self._bus = bus
+        self.alive = True
+
+    async def start(self, on_notify):
+        self._on_notify = on_notify
+        self._bus.coordinators.append(self)
+
+    async def try_lead(self):
+        if not self.alive:
+            raise OSError("Connection refused")
+        if self._bus.holder is None:
+            self._bus.holder = self
+        return self._bus.holder is self
+
+    def leading(self):
+        return self.alive and self._bus.holder is self
+
+    async def notify(self, channel, payload):
+        for coordinator in self._bus.coordinators:
+            if coordinator is not self:
+                coordinator._on_notify(channel, payload)
+
+    async def close(self):
+        self._bus.coordinators.remove(self)
+        if self._bus.holder is self:
+            self._bus.holder = None
+
+
+class Worker():
+    def __init__(self, bus, sessionmaker):
+        self.monitor = LeaseMonitor(sources=[])
+        self.monitor._sessionmaker = sessionmaker
+        self.polling = False
+        self.diffs = []
+
+        async def on_lead():
+            self.polling = True
+
+        async def on_step_down():
+            self.polling = False
+
+        async def record(diff):
+            self.diffs.append(diff)
+
+        self.monitor.subscribe(record, on_followers=True)
+        self.coordinator = FakeCoordinator(bus)
+        self.cluster = Cluster(self.coordinator, self.monitor, sessionmaker, on_lead, on_step_down, retry_interval=0.01)
+
+
+class FakeConnection():
+    """Stands in for an asyncpg connection, executed statements are recorded."""
+
+    def __init__(self):
+        self.closed = False
+        self.executed = []
+
+    def get_server_pid(self):
+        return 1
+
+    async def add_listener(self, channel, listener):
+        pass
+
+    def is_closed(self):
+        return self.closed
+
+    async def fetchval(self, query, *args):
+        return True
+
+    async def execute(self, query, *args):
+        self.executed.append(args)
+
+    async def close(self):
+        self.closed = True
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0.02)
+
+def test_encode_leases_roundtrip():
+    leases = (Lease("10.0.0.1", "host", "02:00:00:00:00:01", 1700000000.0), Lease("10.0.0.2", "", "02:00:00:00:00:02"))
+    decoded = decode_leases(encode_leases(leases))
+    assert tuple(decoded) == leases
+    assert decoded[0].expires == 1700000000.0
+
+def test_snapshot_generations_increase():
+    first = LeaseSnapshot()
+    adopted = LeaseSnapshot(generation=first.generation + 1000)
+    assert LeaseSnapshot().generation > adopted.generation
+
+@pytest.mark.asyncio
+async def test_single_worker_always_leads(async_sessionmaker):
+    started = []
+
+    async def on_lead():
+        started.append(True)
+
+    cluster = Cluster(Coordinator(), LeaseMonitor(sources=[]), async_sessionmaker, on_lead, on_lead)
+    await cluster.start()
+    assert cluster.is_leader and started == [True]
+    await cluster.stop()
+
+@pytest.mark.asyncio
+async def test_followers_adopt_leader_snapshots(async_sessionmaker):
+    bus = Bus()
+    leader, follower = Worker(bus, async_sessionmaker), Worker(bus, async_sessionmaker)
+    await leader.cluster.start()
+    await follower.cluster.start()
+    assert leader.polling and not follower.polling
+
+    leases = [Lease("10.0.0.1", "host", "02:00:00:00:00:01")]
+    diff = leader.monitor._swap_snapshot(leases)
+    await leader.monitor._publish(diff)
+    await settle()
+
+    assert follower.monitor.snapshot.generation == leader.monitor.snapshot.generation
+    assert follower.monitor.leases == tuple(leases)
+    assert [d.joined for d in follower.diffs] == [tuple(leases)]
+
+    # A late joiner loads the current snapshot straight away
+    late = Worker(bus, async_sessionmaker)
+    await late.cluster.start()
+    assert late.monitor.leases == tuple(leases)
+    for worker in (leader, follower, late):
+        await worker.cluster.stop()
+
+@pytest.mark.asyncio
+async def test_follower_takes_over_from_dead_leader(async_sessionmaker):
+    bus = Bus()
+    leader, follower = Worker(bus, async_sessionmaker), Worker(bus, async_sessionmaker)
+    await leader.cluster.start()
+    await follower.cluster.start()
+
+    # The server releases the lock of a dead connection
+    leader.coordinator.alive = False
+    bus.holder = None
+    await settle()
+    assert follower.polling and follower.cluster.is_leader
+    assert not leader.polling and not leader.cluster.is_leader
+    for worker in (leader, follower):
+        await worker.cluster.stop()
+
+@pytest.mark.asyncio
+async def test_invalidations_reach_other_workers(async_sessionmaker):
+    bus = Bus()
+    worker = Worker(bus, async_sessionmaker)
+    await worker.cluster.start()
+    received = []
+    other = FakeCoordinator(bus)
+    await other.start(lambda channel, payload: received.append((channel, payload)))
+
+    generation = presence_names.generation
+    invalidate("entities")
+    await settle()
+    assert presence_names.generation == generation + 1
+    assert received == [("seuranta_invalidate", "entities")]
+
+    # Remote invalidations apply locally without echoing back
+    identities.set("02:00:00:00:00:01", (), identities.generation)
+    worker.coordinator._on_notify("seuranta_invalidate", "entities")
+    assert identities.get("02:00:00:00:00:01") is None
+    await settle()
+    assert len(received) == 1
+    await worker.cluster.stop()
+
+@pytest.mark.asyncio
+async def test_registration_republishes_present_names(async_sessionmaker):
+    bus = Bus()
+    leader, follower = Worker(bus, async_sessionmaker), Worker(bus, async_sessionmaker)
+    await leader.cluster.start()
+    await follower.cluster.start()
+    leases = [Lease("10.0.0.1", "host", "02:00:00:00:00:01")]
+    await leader.monitor._publish(leader.monitor._swap_snapshot(leases))
+    await settle()
+    async with async_sessionmaker() as session:
+        await crud.register_device(session, "Alex", schemas.DeviceCreate(mac_addr="02:00:00:00:00:01", hostname="host"))
+    await settle()
+
+    # Both workers publish the unchanged snapshot with the new name
+    for worker in (leader, follower):
+        assert worker.diffs[-1].names_changed
+        assert presence_names.get(presence_names.key(worker.monitor.snapshot.generation)) == ["Alex"]
+    for worker in (leader, follower):
+        await worker.cluster.stop()
+
+@pytest.mark.asyncio
+async def test_write_elsewhere_reloads_name_index(async_sessionmaker):
+    worker = Worker(Bus(), async_sessionmaker)
+    name_index.load([], name_index.generation)
+    await worker.cluster.start()
+    async with async_sessionmaker() as session:
+        session.add(models.TrackedEntity(name="Kim", created_datetime=datetime.datetime.now()))
+        await session.commit()
+    # As received from the worker that wrote it
+    invalidate("entities", broadcast=False)
+    await settle()
+    assert name_index.loaded
+    assert name_index.complete("ki") == ["Kim"]
+    await worker.cluster.stop()
+
+@pytest.mark.asyncio
+async def test_notify_reconnects_after_connection_loss(monkeypatch):
+    connections = []
+    async def connect(dsn):
+        connections.append(FakeConnection())
+        return connections[-1]
+    monkeypatch.setattr(cluster_module.asyncpg, "connect", connect)
+    coordinator = PostgresCoordinator("postgresql://test")
+    await coordinator.start(lambda channel, payload: None)
+    assert await coordinator.try_lead()
+    connections[0].closed = True
+
+    await coordinator.notify("seuranta_snapshot", "1")
+    assert len(connections) == 2
+    assert connections[1].executed == [("seuranta_snapshot", "1")]
+    # The advisory lock went with the old connection
+    assert not coordinator.leading()
+    await coordinator.close()
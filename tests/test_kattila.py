@@ -0,0 +1,61 @@
+import pytest
+import httpx
+from src.kattila import KattilaExporter
+from src.sinks import PresenceUpdate
+
+
+def make_exporter(handler, **kwargs) -> tuple[KattilaExporter, httpx.MockTransport]:
+    exporter = KattilaExporter("http://kattila.test", "secret", backoff=0, **kwargs)
+    return exporter, httpx.MockTransport(handler)
+
+def test_submit_without_url_is_noop():
+    exporter = KattilaExporter(None, None)
+    exporter.submit(PresenceUpdate(1, ["Alex"]))
+    assert exporter._queue.empty()
+
+def test_submit_coalesces_pending_exports():
+    exporter = KattilaExporter("http://kattila.test", "secret")
+    exporter.submit(PresenceUpdate(1, ["Alex"]))
+    exporter.submit(PresenceUpdate(1, ["Alex", "Kim"]))
+    assert exporter.dropped == 1
+    assert exporter._queue.get_nowait().present == ["Alex", "Kim"]
+
+@pytest.mark.asyncio
+async def test_export_sends_names():
+    requests: list[httpx.Request] = []
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200)
+    exporter, transport = make_exporter(handler)
+    await exporter.start(transport=transport)
+    exporter.submit(PresenceUpdate(1, ["Alex"]))
+    await exporter.join()
+    await exporter.close()
+    assert exporter.sent == 1
+    assert requests[0].method == "PUT"
+    assert requests[0].url == "http://kattila.test/seuranta/users"
+    assert requests[0].headers["X-API-Key"] == "secret"
+    assert requests[0].content == b'{"users":[{"username":"Alex"}]}'
+
+@pytest.mark.asyncio
+async def test_export_retries_server_errors():
+    statuses = iter([503, 502, 200])
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(next(statuses))
+    exporter, transport = make_exporter(handler)
+    await exporter.start(transport=transport)
+    exporter.submit(PresenceUpdate(1, ["Alex"]))
+    await exporter.join()
+    await exporter.close()
+    assert (exporter.sent, exporter.failed) == (1, 0)
+
+@pytest.mark.asyncio
+async def test_export_gives_up_after_retries():
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("down")
+    exporter, transport = make_exporter(handler, max_retries=2)
+    await exporter.start(transport=transport)
+    exporter.submit(PresenceUpdate(1, ["Alex"]))
+    await exporter.join()
+    await exporter.close()
+    assert (exporter.sent, exporter.failed) == (0, 1)
@@ -1,14 +1,18 @@
+import asyncio
+import time
+import aiohttp
 import pytest, pytest_asyncio
 import unittest
 from unittest.mock import AsyncMock, PropertyMock, patch
-from src.lease_monitor import Lease, LeaseMonitor
-import src.utils as utils
+from src.lease_monitor import Lease, LeaseMonitor, LeaseSnapshot, LeaseDiff
+from src.lease_sources import HttpLeaseSource, FileLeaseSource, LeaseSource, LeaseFetch, parse_sources
+import src.crud as crud
+from src.cache import presence_names
 
 
 @pytest_asyncio.fixture
 async def mock_leasemonitor(monkeypatch, mock_leases):
-    monkeypatch.setattr(LeaseMonitor, "leases", mock_leases)
-    monkeypatch.delattr(utils, "export_names")
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot(mock_leases))
     leasemonitor = LeaseMonitor()
     return leasemonitor
 
@@ -56,3 +60,231 @@ async def test_get_lease_by_id_exists(mock_leasemonitor):
 async def test_get_lease_by_id_ip_not_leased_returns_none(mock_leasemonitor):
     result_lease = await mock_leasemonitor.get_lease_by_ip("192.168.1.102")
     assert result_lease is None
+
+def test_snapshot_get_by_mac(mock_leases):
+    snapshot = LeaseSnapshot(mock_leases)
+    assert snapshot.get_by_mac("6f:5e:4d:3c:2b:1a") == mock_leases[1]
+    assert snapshot.get_by_mac("00:00:00:00:00:00") is None
+
+def test_snapshot_mac_addrs_precomputed(mock_leases):
+    snapshot = LeaseSnapshot(mock_leases)
+    assert snapshot.mac_addrs == tuple(lease.mac_addr for lease in mock_leases)
+    assert snapshot.mac_addrs is snapshot.mac_addrs
+
+@pytest.mark.asyncio
+async def test_mac_addrs_follow_snapshot(mock_leasemonitor, mock_leases):
+    assert mock_leasemonitor.mac_addrs == tuple(lease.mac_addr for lease in mock_leases)
+
+def test_diff_joined_left_changed():
+    old = LeaseSnapshot([Lease("192.168.1.100","a","1a:2b:3c:4d:5e:6f"),
+                         Lease("192.168.1.101","b","6f:5e:4d:3c:2b:1a")])
+    new = LeaseSnapshot([Lease("192.168.1.105","a","1a:2b:3c:4d:5e:6f"),
+                         Lease("192.168.1.102","c","11:aa:22:bb:33:cc")])
+    diff = LeaseDiff.between(old, new)
+    assert [lease.mac_addr for lease in diff.joined] == ["11:aa:22:bb:33:cc"]
+    assert [lease.mac_addr for lease in diff.left] == ["6f:5e:4d:3c:2b:1a"]
+    assert [(a.ipv4_addr, b.ipv4_addr) for a, b in diff.changed] == [("192.168.1.100", "192.168.1.105")]
+
+def test_diff_same_snapshot_is_empty(mock_leases):
+    assert not LeaseDiff.between(LeaseSnapshot(mock_leases), LeaseSnapshot(list(mock_leases)))
+
+def test_swap_snapshot_hysteresis_keeps_missing_lease(mock_leases):
+    leasemonitor = LeaseMonitor()
+    leasemonitor._leave_hysteresis = 30
+    leasemonitor._swap_snapshot(mock_leases, now=0)
+    diff = leasemonitor._swap_snapshot(mock_leases[1:], now=10)
+    assert not diff
+    assert len(leasemonitor.snapshot) == 3
+    diff = leasemonitor._swap_snapshot(mock_leases[1:], now=40)
+    assert diff.left == (mock_leases[0],)
+    assert len(leasemonitor.snapshot) == 2
+
+def test_swap_snapshot_flapping_lease_resets_hysteresis(mock_leases):
+    leasemonitor = LeaseMonitor()
+    leasemonitor._leave_hysteresis = 30
+    leasemonitor._swap_snapshot(mock_leases, now=0)
+    leasemonitor._swap_snapshot(mock_leases[1:], now=10)
+    leasemonitor._swap_snapshot(mock_leases, now=20)
+    assert not leasemonitor._swap_snapshot(mock_leases[1:], now=45)
+
+@pytest.mark.asyncio
+async def test_update_leases_skips_work_without_changes(monkeypatch, mock_leases):
+    leasemonitor = LeaseMonitor()
+    leasemonitor._swap_snapshot(mock_leases)
+    async def fetch_unchanged():
+        leasemonitor._swap_snapshot(mock_leases)
+        return 200
+    monkeypatch.setattr(leasemonitor, "fetch_leases", fetch_unchanged)
+    listener = AsyncMock()
+    leasemonitor.subscribe(listener)
+    assert await leasemonitor.update_leases() == 200
+    listener.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_update_leases_publishes_diff(monkeypatch, mock_leases):
+    leasemonitor = LeaseMonitor()
+    async def fetch_new():
+        leasemonitor._swap_snapshot(mock_leases)
+        return 200
+    monkeypatch.setattr(leasemonitor, "fetch_leases", fetch_new)
+    monkeypatch.setattr(leasemonitor, "_sessionmaker", unittest.mock.MagicMock())
+    monkeypatch.setattr(crud, "get_tracked_entity_names_by_mac_addrs", AsyncMock(return_value=["Alex"]))
+    listener = AsyncMock()
+    leasemonitor.subscribe(listener)
+    await leasemonitor.update_leases()
+    assert presence_names.get(presence_names.key(leasemonitor.snapshot.generation)) == ["Alex"]
+    (diff,), _ = listener.await_args
+    assert len(diff.joined) == 3
+
+class MockContent():
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def iter_chunked(self, size: int):
+        for i in range(0, len(self._body), size):
+            yield self._body[i:i + size]
+
+class MockResponse():
+    def __init__(self, status: int, text: str = "", headers: dict[str, str] | None = None):
+        self.status = status
+        self.headers = headers or {}
+        self.content = MockContent(text.encode())
+
+@pytest.mark.asyncio
+async def test_read_response_stores_validators():
+    source = HttpLeaseSource("http://router.test/leases")
+    response = MockResponse(200, "0000000000 1a:2b:3c:4d:5e:6f 192.168.1.100 test-hostname 01:1a:2b:3c:4d:5e:6f",
+                            {"ETag": '"abc"', "Last-Modified": "Sun, 18 Oct 2026 12:00:00 GMT"})
+    result = await source.read_response(response)
+    assert result.status == 200
+    assert len(result.leases) == 1
+    assert source._conditional_headers() == {"If-None-Match": '"abc"',
+                                             "If-Modified-Since": "Sun, 18 Oct 2026 12:00:00 GMT"}
+
+@pytest.mark.asyncio
+async def test_read_response_not_modified_skips_parsing():
+    source = HttpLeaseSource("http://router.test/leases", parser=unittest.mock.MagicMock())
+    result = await source.read_response(MockResponse(304))
+    assert result.leases is None
+    source._parser.assert_not_called()
+
+def test_apply_not_modified_keeps_snapshot(mock_leases):
+    leasemonitor = LeaseMonitor(sources=[HttpLeaseSource("http://router.test/leases")])
+    leasemonitor._apply_fetches({"http://router.test/leases": LeaseFetch(200, mock_leases)})
+    snapshot = leasemonitor.snapshot
+    leasemonitor._apply_fetches({"http://router.test/leases": LeaseFetch(304)})
+    assert leasemonitor.snapshot is snapshot
+
+class StaticSource(LeaseSource):
+    def __init__(self, name: str, result: LeaseFetch | None, delay: float = 0, timeout: float = 10):
+        super().__init__(name, timeout=timeout)
+        self.result = result
+        self.delay = delay
+
+    async def _fetch(self, http) -> LeaseFetch:
+        await asyncio.sleep(self.delay)
+        if self.result is None:
+            raise aiohttp.ClientConnectionError("unreachable")
+        return self.result
+
+@pytest.mark.asyncio
+async def test_fetch_leases_merges_sources(monkeypatch, mock_leases):
+    newer = Lease("192.168.1.200", "test-hostname-1", "1a:2b:3c:4d:5e:6f", expires=2000)
+    older = Lease("192.168.1.100", "test-hostname-1", "1a:2b:3c:4d:5e:6f", expires=1000)
+    leasemonitor = LeaseMonitor(sources=[StaticSource("a", LeaseFetch(200, [older, mock_leases[1]])),
+                                         StaticSource("b", LeaseFetch(200, [newer, mock_leases[2]]))])
+    monkeypatch.setattr(leasemonitor, "start", AsyncMock())
+    assert await leasemonitor.fetch_leases() == 200
+    assert len(leasemonitor.snapshot) == 3
+    assert leasemonitor.snapshot.get_by_mac("1a:2b:3c:4d:5e:6f").ipv4_addr == "192.168.1.200"
+
+@pytest.mark.asyncio
+async def test_fetch_leases_dead_source_keeps_others(monkeypatch, mock_leases):
+    alive = StaticSource("alive", LeaseFetch(200, mock_leases[:2]))
+    dead = StaticSource("dead", LeaseFetch(200, mock_leases[2:]))
+    slow = StaticSource("slow", LeaseFetch(200, []), delay=1, timeout=0.01)
+    leasemonitor = LeaseMonitor(sources=[alive, dead, slow])
+    leasemonitor._leave_hysteresis = 0
+    leasemonitor._stale_grace = 0
+    monkeypatch.setattr(leasemonitor, "start", AsyncMock())
+    await leasemonitor.fetch_leases()
+    assert len(leasemonitor.snapshot) == 3
+
+    dead.result = None
+    alive.result = LeaseFetch(304)
+    assert await leasemonitor.fetch_leases() == 304
+    assert leasemonitor.last_fetches["dead"].status == 502
+    assert leasemonitor.last_fetches["slow"].status == 504
+    assert leasemonitor.snapshot.mac_addrs == tuple(lease.mac_addr for lease in mock_leases[:2])
+
+def test_failing_source_served_stale_within_grace(mock_leases):
+    leasemonitor = LeaseMonitor(sources=[StaticSource("a", None)])
+    leasemonitor._leave_hysteresis = 0
+    leasemonitor._stale_grace = 60
+    leasemonitor._apply_fetches({"a": LeaseFetch(200, mock_leases)}, now=0)
+    leasemonitor._apply_fetches({"a": LeaseFetch(502)}, now=30)
+    assert len(leasemonitor.snapshot) == 3
+    leasemonitor._apply_fetches({"a": LeaseFetch(502)}, now=61)
+    assert len(leasemonitor.snapshot) == 0
+
+def test_parse_sources():
+    sources = parse_sources('[{"url": "http://192.168.1.1/moi"}, '
+                            '{"url": "file:///var/lib/dhcp/dhcpd.leases", "parser": "isc-dhcpd", "timeout": 2}]')
+    assert isinstance(sources[0], HttpLeaseSource)
+    assert isinstance(sources[1], FileLeaseSource)
+    assert sources[1].path == "/var/lib/dhcp/dhcpd.leases"
+    assert sources[1].timeout == 2
+
+@pytest.mark.asyncio
+async def test_snapshot_survives_restart(monkeypatch, tmp_path, mock_leases):
+    monkeypatch.setattr(LeaseMonitor, "_snapshot_file", str(tmp_path / "lease_snapshot.json"))
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot(mock_leases))
+    saved = LeaseMonitor().snapshot
+    await LeaseMonitor().save_snapshot()
+
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot([], generation=0))
+    restarted = LeaseMonitor()
+    assert restarted.restore_snapshot()
+    assert restarted.snapshot.leases == saved.leases
+    assert restarted.snapshot.generation == saved.generation
+
+@pytest.mark.asyncio
+async def test_restored_source_goes_stale_while_router_down(monkeypatch, tmp_path, mock_leases):
+    monkeypatch.setattr(LeaseMonitor, "_snapshot_file", str(tmp_path / "lease_snapshot.json"))
+    leasemonitor = LeaseMonitor(sources=[StaticSource("a", None)])
+    leasemonitor._apply_fetches({"a": LeaseFetch(200, mock_leases)})
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", leasemonitor.snapshot)
+    await leasemonitor.save_snapshot()
+
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot([], generation=0))
+    restarted = LeaseMonitor(sources=[StaticSource("a", None)])
+    restarted._leave_hysteresis = 30
+    restarted._stale_grace = 60
+    assert restarted.restore_snapshot()
+    now = time.monotonic()
+    restarted._apply_fetches({"a": LeaseFetch(502)}, now=now + 30)
+    assert len(restarted.snapshot) == 3
+    # Past the grace the devices start leaving, through the hysteresis
+    restarted._apply_fetches({"a": LeaseFetch(502)}, now=now + 61)
+    assert len(restarted.snapshot) == 3
+    restarted._apply_fetches({"a": LeaseFetch(502)}, now=now + 92)
+    assert len(restarted.snapshot) == 0
+
+@pytest.mark.asyncio
+async def test_stale_snapshot_not_restored(monkeypatch, tmp_path, mock_leases):
+    monkeypatch.setattr(LeaseMonitor, "_snapshot_file", str(tmp_path / "lease_snapshot.json"))
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot(mock_leases))
+    await LeaseMonitor().save_snapshot()
+
+    monkeypatch.setattr(LeaseMonitor, "_snapshot_max_age", -1)
+    monkeypatch.setattr(LeaseMonitor, "_snapshot", LeaseSnapshot([], generation=0))
+    restarted = LeaseMonitor()
+    assert not restarted.restore_snapshot()
+    assert len(restarted.snapshot) == 0
+
+def test_missing_or_broken_snapshot_not_restored(monkeypatch, tmp_path):
+    path = tmp_path / "lease_snapshot.json"
+    monkeypatch.setattr(LeaseMonitor, "_snapshot_file", str(path))
+    assert not LeaseMonitor().restore_snapshot()
+    path.write_text('{"generation": 1, "saved_at"')
+    assert not LeaseMonitor().restore_snapshot()
@@ -0,0 +1,140 @@
+import os
+import pytest
+from src.lease_sources import (
+    Lease,
+    DnsmasqParser,
+    KeaCsvParser,
+    ArpParser,
+    IscDhcpdParser,
+    FileLeaseSource,
+)
+
+DNSMASQ = (b"1760000000 1a:2b:3c:4d:5e:6f 192.168.1.100 test-hostname-1 01:1a:2b:3c:4d:5e:6f\n"
+           b"0 6F:5E:4D:3C:2B:1A 192.168.1.101 * *\n"
+           b"duid 00:01:00:01:2c:1f:aa:bb:cc:dd:ee:ff\n"
+           b"this line is broken\n"
+           b"1760000000 11:aa:22:bb:33:cc 192.168.1.999 bad-ip *\n")
+
+
+def test_dnsmasq_skips_malformed_lines():
+    leases, skipped = DnsmasqParser.parse(DNSMASQ)
+    assert leases == [Lease("192.168.1.100", "test-hostname-1", "1a:2b:3c:4d:5e:6f"),
+                      Lease("192.168.1.101", "", "6f:5e:4d:3c:2b:1a")]
+    assert leases[0].expires == 1760000000
+    assert leases[1].expires is None
+    assert skipped == 2
+
+def test_parser_handles_chunk_boundaries():
+    parser = DnsmasqParser()
+    leases = []
+    for i in range(0, len(DNSMASQ), 7):
+        leases += parser.feed(DNSMASQ[i:i + 7])
+    leases += parser.close()
+    assert leases == DnsmasqParser.parse(DNSMASQ)[0]
+
+def test_kea_csv_active_leases_only():
+    data = ("address,hwaddr,client_id,valid_lifetime,expire,subnet_id,fqdn_fwd,fqdn_rev,hostname,state,user_context\n"
+            "192.168.1.100,1a:2b:3c:4d:5e:6f,,3600,4102444800,1,0,0,laptop.,0,\n"
+            "192.168.1.101,6f:5e:4d:3c:2b:1a,,3600,4102444800,1,0,0,phone,2,\n"
+            "192.168.1.102,nonsense,,3600,4102444800,1,0,0,x,0,\n"
+            "192.168.1.103,11:aa:22:bb:33:cc,,3600,1760000000,1,0,0,gone,0,\n")
+    leases, skipped = KeaCsvParser.parse(data)
+    assert leases == [Lease("192.168.1.100", "laptop", "1a:2b:3c:4d:5e:6f")]
+    assert leases[0].expires == 4102444800
+    assert skipped == 1
+
+def test_arp_complete_entries_only():
+    data = ("IP address       HW type     Flags       HW address            Mask     Device\n"
+            "192.168.1.100    0x1         0x2         1a:2b:3c:4d:5e:6f     *        eth0\n"
+            "192.168.1.101    0x1         0x0         00:00:00:00:00:00     *        eth0\n")
+    leases, skipped = ArpParser.parse(data)
+    assert leases == [Lease("192.168.1.100", "", "1a:2b:3c:4d:5e:6f")]
+    assert skipped == 0
+
+def test_isc_dhcpd_blocks():
+    data = """# The format of this file is documented in the dhcpd.leases(5) manual page.
+lease 192.168.1.100 {
+  starts 4 2099/10/15 10:00:00;
+  ends 4 2099/10/15 22:00:00;
+  binding state active;
+  hardware ethernet 1a:2b:3c:4d:5e:6f;
+  client-hostname "laptop";
+}
+lease 192.168.1.101 {
+  ends epoch 1760000000;
+  binding state free;
+  hardware ethernet 6f:5e:4d:3c:2b:1a;
+}
+lease 192.168.1.102 {
+  binding state active;
+}
+lease 192.168.1.103 {
+  hardware ethernet 11:aa:22:bb:33:cc;
+"""
+    leases, skipped = IscDhcpdParser.parse(data)
+    assert leases == [Lease("192.168.1.100", "laptop", "1a:2b:3c:4d:5e:6f")]
+    assert leases[0].expires == 4095784800
+    assert skipped == 2
+
+def test_isc_dhcpd_commented_statements():
+    data = """lease 192.168.1.10 {
+  starts epoch 4102441200; # Thu Dec 31 23:00:00 2099
+  ends epoch 4102444800; # Fri Jan 01 00:00:00 2100
+  binding state active; # still here
+  hardware ethernet 1a:2b:3c:4d:5e:6f;
+  client-hostname "phone#2";
+}
+"""
+    leases, skipped = IscDhcpdParser.parse(data)
+    assert leases == [Lease("192.168.1.10", "phone#2", "1a:2b:3c:4d:5e:6f")]
+    assert leases[0].expires == 4102444800
+    assert skipped == 0
+
+def test_isc_dhcpd_later_block_releases_lease():
+    data = """lease 192.168.1.10 {
+  ends epoch 4102444800;
+  binding state active;
+  hardware ethernet 1a:2b:3c:4d:5e:6f;
+}
+lease 192.168.1.11 {
+  ends epoch 1760000000;
+  binding state active;
+  hardware ethernet 6f:5e:4d:3c:2b:1a;
+}
+lease 192.168.1.10 {
+  ends epoch 4102444800;
+  binding state free;
+  hardware ethernet 1a:2b:3c:4d:5e:6f;
+}
+"""
+    assert IscDhcpdParser.parse(data) == ([], 0)
+
+def test_kea_csv_later_row_releases_lease():
+    data = ("address,hwaddr,client_id,valid_lifetime,expire,subnet_id,fqdn_fwd,fqdn_rev,hostname,state,user_context\n"
+            "192.168.1.10,1a:2b:3c:4d:5e:6f,,3600,4102444800,1,0,0,laptop,0,\n"
+            "192.168.1.11,6f:5e:4d:3c:2b:1a,,3600,4102444800,1,0,0,phone,0,\n"
+            "192.168.1.10,1a:2b:3c:4d:5e:6f,,0,4102444800,1,0,0,laptop,0,\n")
+    leases, skipped = KeaCsvParser.parse(data)
+    assert leases == [Lease("192.168.1.11", "phone", "6f:5e:4d:3c:2b:1a")]
+    assert skipped == 0
+
+@pytest.mark.asyncio
+async def test_file_source_rereads_only_on_change(tmp_path):
+    path = tmp_path / "dnsmasq.leases"
+    path.write_bytes(DNSMASQ)
+    source = FileLeaseSource(str(path))
+    result = await source.fetch(None)
+    assert (result.status, len(result.leases), result.skipped) == (200, 2, 2)
+    result = await source.fetch(None)
+    assert (result.status, result.leases) == (304, None)
+
+    path.write_bytes(DNSMASQ.splitlines(keepends=True)[0])
+    os.utime(path, ns=(0, 1))
+    result = await source.fetch(None)
+    assert (result.status, len(result.leases)) == (200, 1)
+    assert source.skipped == 2
+
+@pytest.mark.asyncio
+async def test_file_source_missing_file(tmp_path):
+    result = await FileLeaseSource(str(tmp_path / "missing")).fetch(None)
+    assert (result.status, result.leases) == (404, None)
@@ -0,0 +1,74 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+from src.cache import presence_names
+from src.lease_monitor import LeaseSnapshot, LeaseDiff
+from src.live_feed import PresenceFeed
+
+
+def test_connect_replays_latest():
+    feed = PresenceFeed(MagicMock())
+    feed.broadcast('{"present": []}')
+    queue = feed.connect()
+    assert queue.get_nowait() == '{"present": []}'
+
+def test_broadcast_reaches_every_client():
+    feed = PresenceFeed(MagicMock())
+    queues = [feed.connect() for _ in range(3)]
+    feed.broadcast("x")
+    assert [queue.get_nowait() for queue in queues] == ["x", "x", "x"]
+
+def test_slow_client_is_dropped():
+    feed = PresenceFeed(MagicMock(), max_buffer=2)
+    slow = feed.connect()
+    feed.broadcast("a")
+    feed.broadcast("b")
+    assert feed.clients == 1
+    feed.broadcast("c")
+    assert feed.clients == 0
+    assert feed.dropped == 1
+    assert slow.get_nowait() is None
+
+@pytest.mark.asyncio
+async def test_events_stream_until_dropped():
+    feed = PresenceFeed(MagicMock(), max_buffer=1)
+    queue = feed.connect()
+    feed.broadcast("a")
+    events = feed.events(queue)
+    assert await anext(events) == "data: a\n\n"
+    feed.broadcast("b")
+    feed.broadcast("c")
+    with pytest.raises(StopAsyncIteration):
+        await anext(events)
+
+@pytest.mark.asyncio
+async def test_close_ends_every_stream():
+    feed = PresenceFeed(MagicMock(), max_buffer=1)
+    queues = [feed.connect() for _ in range(2)]
+    feed.broadcast("a")
+    streams = [feed.events(queue) for queue in queues]
+    assert await anext(streams[0]) == "data: a\n\n"
+    feed.close()
+    for events in streams:
+        with pytest.raises(StopAsyncIteration):
+            await anext(events)
+    assert (feed.clients, feed.dropped) == (0, 0)
+
+@pytest.mark.asyncio
+async def test_events_heartbeat():
+    feed = PresenceFeed(MagicMock(), heartbeat=0)
+    events = feed.events(feed.connect())
+    assert await anext(events) == ": keep-alive\n\n"
+    await events.aclose()
+    assert feed.clients == 0
+
+@pytest.mark.asyncio
+async def test_publish_uses_cached_names(mock_leases):
+    sessionmaker = MagicMock()
+    feed = PresenceFeed(sessionmaker)
+    queue = feed.connect()
+    snapshot = LeaseSnapshot(mock_leases)
+    presence_names.set(presence_names.key(snapshot.generation), ["Alex"])
+    await feed.publish(LeaseDiff.between(LeaseSnapshot(), snapshot))
+    sessionmaker.assert_not_called()
+    assert json.loads(queue.get_nowait()) == {"present": ["Alex"]}
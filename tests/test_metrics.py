@@ -0,0 +1,65 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from src.metrics import Counter, Gauge, Histogram, Registry, RequestTimer, instrument_engine, db_query_seconds, http_request_seconds
+
+
+def test_counter_render():
+    counter = Counter("test_total", "Test counter.", ("source",))
+    counter.inc(source="a")
+    counter.inc(2, source='b"c')
+    assert counter.render() == ('# HELP test_total Test counter.\n# TYPE test_total counter\n'
+                                'test_total{source="a"} 1\ntest_total{source="b\\"c"} 2')
+
+def test_gauge_reads_callback():
+    value = 3
+    gauge = Gauge("test_gauge", "Test gauge.", lambda: value)
+    assert list(gauge.samples()) == ["test_gauge 3"]
+    value = None
+    assert list(gauge.samples()) == []
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "Test histogram.", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert list(histogram.samples()) == [
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 2.65",
+        "test_seconds_count 4",
+    ]
+
+def test_registry_render():
+    registry = Registry()
+    registry.register(Gauge("a", "A.", lambda: 1))
+    registry.register(Gauge("b", "B.", lambda: 2))
+    assert registry.render().endswith("b 2\n")
+
+@pytest.mark.asyncio
+async def test_instrument_engine_times_queries():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    instrument_engine(engine)
+    before = sum(sum(counts) for counts in db_query_seconds._counts.values())
+    async with engine.connect() as connection:
+        await connection.execute(text("SELECT 1"))
+        await connection.execute(text("SELECT 2"))
+    await engine.dispose()
+    assert sum(sum(counts) for counts in db_query_seconds._counts.values()) == before + 2
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(async_client):
+    await async_client.get("/")
+    response = await async_client.get("/metrics")
+    assert response.status_code == 200
+    assert 'seuranta_http_request_seconds_count{method="GET",route="/",status="200"}' in response.text
+    assert "seuranta_leases 3" in response.text
+
+@pytest.mark.asyncio
+async def test_request_timer_counts_failed_request():
+    async def failing(scope, receive, send):
+        raise RuntimeError("boom")
+    before = sum(http_request_seconds._counts.get(("POST", "unmatched", "500"), [0]))
+    with pytest.raises(RuntimeError):
+        await RequestTimer(failing)({"type": "http", "method": "POST"}, None, None)
+    assert sum(http_request_seconds._counts[("POST", "unmatched", "500")]) == before + 1
@@ -0,0 +1,93 @@
+import datetime
+import pytest
+from sqlalchemy import select
+from src.lease_monitor import LeaseSnapshot, LeaseDiff
+from src.occupancy import OccupancyRollups, get_occupancy_stats
+import src.models as models
+
+T0 = datetime.datetime(2026, 10, 18, 12, 0)
+
+
+@pytest.fixture
+def register(async_session, mock_leases):
+    async def register():
+        for i, lease in enumerate(mock_leases):
+            async_session.add(models.TrackedEntity(
+                name=f"entity{i}",
+                created_datetime=T0,
+                devices=[models.Device(mac_addr=lease.mac_addr, hostname=lease.hostname)],
+            ))
+        await async_session.commit()
+    return register
+
+def tick_diff(snapshot: LeaseSnapshot) -> LeaseDiff:
+    return LeaseDiff((), (), (), snapshot)
+
+@pytest.mark.asyncio
+async def test_tick_accumulates_daily_seconds(async_sessionmaker, async_session, register, mock_leases):
+    await register()
+    rollups = OccupancyRollups(async_sessionmaker, flush_interval=datetime.timedelta(0))
+    everyone = LeaseSnapshot(mock_leases)
+    await rollups.tick(LeaseDiff.between(LeaseSnapshot(), everyone), now=T0)
+    await rollups.tick(tick_diff(everyone), now=T0 + datetime.timedelta(seconds=15))
+    one = LeaseSnapshot(mock_leases[:1])
+    await rollups.tick(LeaseDiff.between(everyone, one), now=T0 + datetime.timedelta(seconds=30))
+
+    db_result = await async_session.execute(select(models.DailyPresence).order_by(models.DailyPresence.tracked_entity_id))
+    assert [row.seconds for row in db_result.scalars()] == [30, 15, 15]
+
+@pytest.mark.asyncio
+async def test_tick_caps_gaps_between_ticks(async_sessionmaker, async_session, register, mock_leases):
+    await register()
+    rollups = OccupancyRollups(async_sessionmaker, flush_interval=datetime.timedelta(0))
+    snapshot = LeaseSnapshot(mock_leases[:1])
+    await rollups.tick(LeaseDiff.between(LeaseSnapshot(), snapshot), now=T0)
+    await rollups.tick(tick_diff(snapshot), now=T0 + datetime.timedelta(hours=1))
+
+    db_result = await async_session.execute(select(models.DailyPresence.seconds))
+    assert db_result.scalars().all() == [120]
+
+@pytest.mark.asyncio
+async def test_tick_counts_distinct_entities_per_hour(async_sessionmaker, async_session, register, mock_leases):
+    await register()
+    rollups = OccupancyRollups(async_sessionmaker)
+    first = LeaseSnapshot(mock_leases[:1])
+    await rollups.tick(LeaseDiff.between(LeaseSnapshot(), first), now=T0)
+    second = LeaseSnapshot(mock_leases[1:])
+    await rollups.tick(LeaseDiff.between(first, second), now=T0 + datetime.timedelta(minutes=30))
+    await rollups.tick(LeaseDiff.between(second, first), now=T0 + datetime.timedelta(minutes=45))
+    await rollups.tick(tick_diff(first), now=T0 + datetime.timedelta(minutes=75))
+
+    db_result = await async_session.execute(select(models.HourlyOccupancy).order_by(models.HourlyOccupancy.hour_start))
+    assert [(row.hour_start.hour, row.entities) for row in db_result.scalars()] == [(12, 3), (13, 1)]
+
+@pytest.mark.asyncio
+async def test_occupancy_stats_from_rollups(async_session, register):
+    await register()
+    async_session.add_all([
+        models.HourlyOccupancy(hour_start=T0, entities=2),
+        models.HourlyOccupancy(hour_start=T0 - datetime.timedelta(days=7), entities=4),
+        models.DailyPresence(day=T0.date(), tracked_entity_id=1, seconds=3600),
+        models.DailyPresence(day=T0.date() - datetime.timedelta(days=1), tracked_entity_id=1, seconds=1800),
+        models.DailyPresence(day=T0.date(), tracked_entity_id=2, seconds=600),
+    ])
+    await async_session.commit()
+
+    stats = await get_occupancy_stats(async_session, days=14, now=T0 + datetime.timedelta(minutes=30))
+    assert [hour.entities for hour in stats.hourly] == [4, 2]
+    assert [(w.weekday, w.hour, w.mean_entities) for w in stats.weekday] == [(T0.weekday(), 12, 3.0)]
+    assert [(e.name, e.minutes, e.days) for e in stats.entities] == [("entity0", 90, 2), ("entity1", 10, 1)]
+
+@pytest.mark.asyncio
+async def test_weekday_mean_counts_empty_weeks(async_session):
+    async_session.add(models.HourlyOccupancy(hour_start=T0.replace(hour=3) - datetime.timedelta(days=21), entities=10))
+    await async_session.commit()
+
+    stats = await get_occupancy_stats(async_session, days=28, now=T0)
+    assert [(w.hour, w.mean_entities) for w in stats.weekday] == [(3, 2.5)]
+
+@pytest.mark.asyncio
+async def test_occupancy_endpoint(async_client):
+    response = await async_client.get("/stats/occupancy?days=7")
+    assert response.status_code == 200
+    assert response.json()["hourly"] == []
@@ -0,0 +1,76 @@
+import datetime
+import pytest
+from sqlalchemy import select
+from src.lease_monitor import Lease, LeaseSnapshot, LeaseDiff
+from src.presence_history import PresenceHistory
+import src.models as models
+
+T0 = datetime.datetime(2026, 10, 18, 12, 0)
+T1 = datetime.datetime(2026, 10, 18, 13, 0)
+
+
+@pytest.fixture
+def registered_devices(async_session, mock_leases):
+    async def register():
+        for i, lease in enumerate(mock_leases):
+            async_session.add(models.TrackedEntity(
+                name=f"entity{i}",
+                created_datetime=T0,
+                devices=[models.Device(mac_addr=lease.mac_addr, hostname=lease.hostname)],
+            ))
+        await async_session.commit()
+    return register
+
+async def presence_sessions(async_session) -> list[models.PresenceSession]:
+    db_result = await async_session.execute(select(models.PresenceSession).order_by(models.PresenceSession.device_id))
+    return list(db_result.scalars().all())
+
+@pytest.mark.asyncio
+async def test_record_opens_and_closes_sessions(async_sessionmaker, async_session, registered_devices, mock_leases):
+    await registered_devices()
+    history = PresenceHistory(async_sessionmaker)
+    first = LeaseSnapshot(mock_leases)
+    await history.record(LeaseDiff.between(LeaseSnapshot(), first), now=T0)
+    second = LeaseSnapshot(mock_leases[1:])
+    await history.record(LeaseDiff.between(first, second), now=T1)
+
+    async_session.expire_all()
+    sessions = await presence_sessions(async_session)
+    assert len(sessions) == 3
+    assert [s.start_datetime for s in sessions] == [T0, T0, T0]
+    assert [s.end_datetime for s in sessions] == [T1, None, None]
+
+@pytest.mark.asyncio
+async def test_record_ignores_unregistered_devices(async_sessionmaker, async_session):
+    history = PresenceHistory(async_sessionmaker)
+    snapshot = LeaseSnapshot([Lease("192.168.1.100", "unknown", "1a:2b:3c:4d:5e:6f")])
+    await history.record(LeaseDiff.between(LeaseSnapshot(), snapshot), now=T0)
+    assert await presence_sessions(async_session) == []
+
+@pytest.mark.asyncio
+async def test_record_reconciles_sessions_left_open(async_sessionmaker, async_session, registered_devices, mock_leases):
+    await registered_devices()
+    snapshot = LeaseSnapshot(mock_leases)
+    await PresenceHistory(async_sessionmaker).record(LeaseDiff.between(LeaseSnapshot(), snapshot), now=T0)
+
+    # A restarted process sees only the last device still present
+    restarted = LeaseSnapshot(mock_leases[2:])
+    await PresenceHistory(async_sessionmaker).record(LeaseDiff.between(LeaseSnapshot(), restarted), now=T1)
+
+    async_session.expire_all()
+    sessions = await presence_sessions(async_session)
+    assert len(sessions) == 3
+    assert [s.end_datetime for s in sessions] == [T1, T1, None]
+
+@pytest.mark.asyncio
+async def test_record_opens_session_for_device_registered_while_present(async_sessionmaker, async_session, mock_leases):
+    history = PresenceHistory(async_sessionmaker)
+    snapshot = LeaseSnapshot(mock_leases)
+    await history.record(LeaseDiff.between(LeaseSnapshot(), snapshot), now=T0)
+    async_session.add(models.TrackedEntity(name="entity0", created_datetime=T0,
+                                           devices=[models.Device(mac_addr=mock_leases[0].mac_addr, hostname="phone")]))
+    await async_session.commit()
+    await history.record(LeaseDiff((), (), (), snapshot, names_changed=True), now=T1)
+
+    sessions = await presence_sessions(async_session)
+    assert [(s.start_datetime, s.end_datetime) for s in sessions] == [(T1, None)]
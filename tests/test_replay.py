@@ -0,0 +1,81 @@
+import aiohttp
+import pytest
+from src.lease_sources import DnsmasqParser, FileLeaseSource, HttpLeaseSource
+from src.lease_monitor import LeaseMonitor
+from src.replay import Capture, LeaseRecorder, ReplayServer, read_recording, synthetic_captures
+
+TABLE_A = b"1700000000 1a:2b:3c:4d:5e:6f 192.168.1.100 phone *\n"
+TABLE_B = TABLE_A + b"1700000000 6f:5e:4d:3c:2b:1a 192.168.1.101 laptop *\n"
+
+
+def test_recording_roundtrip(tmp_path):
+    path = str(tmp_path / "leases.rec")
+    recorder = LeaseRecorder(path)
+    recorder.record("router", 200, TABLE_A, now=1)
+    recorder.record("router", 200, TABLE_A, now=2)
+    recorder.record("router", 304, now=3)
+    recorder.record("router", 200, TABLE_B, now=4)
+    recorder.close()
+    captures = list(read_recording(path))
+    assert [(capture.time, capture.status, capture.body) for capture in captures] == [
+        (1, 200, TABLE_A), (2, 200, TABLE_A), (3, 304, b""), (4, 200, TABLE_B)]
+
+def test_repeated_body_stored_once(tmp_path):
+    path = tmp_path / "leases.rec"
+    recorder = LeaseRecorder(str(path))
+    recorder.record("router", 200, TABLE_B * 50, now=1)
+    size = path.stat().st_size
+    for now in range(2, 12):
+        recorder.record("router", 200, TABLE_B * 50, now=now)
+    recorder.close()
+    assert path.stat().st_size - size < 10 * 32
+
+def test_partial_last_record_skipped(tmp_path):
+    path = tmp_path / "leases.rec"
+    recorder = LeaseRecorder(str(path))
+    recorder.record("router", 200, TABLE_A, now=1)
+    recorder.record("router", 200, TABLE_B, now=2)
+    recorder.close()
+    path.write_bytes(path.read_bytes()[:-5])
+    assert [capture.time for capture in read_recording(str(path))] == [1]
+
+def test_synthetic_day_profile_is_quiet_at_night():
+    counts = {}
+    for capture in synthetic_captures("day", devices=100, hours=24, interval=3600):
+        (leases, skipped) = DnsmasqParser.parse(capture.body)
+        assert skipped == 0
+        counts[capture.time / 3600] = len(leases)
+    assert counts[3] < counts[17]
+
+@pytest.mark.asyncio
+async def test_monitor_records_source_responses(tmp_path, monkeypatch):
+    lease_file = tmp_path / "dnsmasq.leases"
+    lease_file.write_bytes(TABLE_A)
+    monkeypatch.setattr(LeaseMonitor, "_record_file", str(tmp_path / "leases.rec"))
+    monitor = LeaseMonitor([FileLeaseSource(str(lease_file), name="router")])
+    await monitor.fetch_leases()
+    await monitor.fetch_leases()
+    await monitor.close()
+    assert [(capture.source, capture.status, capture.body) for capture in read_recording(str(tmp_path / "leases.rec"))] == [
+        ("router", 200, TABLE_A), ("router", 304, b"")]
+
+@pytest.mark.asyncio
+async def test_replay_server_follows_clock():
+    server = ReplayServer([Capture(0, "router", 200, TABLE_A), Capture(15, "router", 304, b""),
+                           Capture(30, "router", 502, b""), Capture(45, "router", 200, TABLE_B),
+                           # Recording started while this one's table was already known
+                           Capture(0, "late", 304, b""), Capture(30, "late", 200, TABLE_A)])
+    runner = await server.serve()
+    sources = [HttpLeaseSource(f"http://127.0.0.1:{server.port}/leases/{n}") for n in range(2)]
+    try:
+        async with aiohttp.ClientSession() as http:
+            results = []
+            for replay_time in (0, 20, 35, 50, 55):
+                server.pin(replay_time)
+                for source in sources:
+                    result = await source.fetch(http)
+                    results.append((result.status, len(result.leases) if result.leases is not None else None))
+    finally:
+        await runner.cleanup()
+    assert results[::2] == [(200, 1), (304, None), (502, None), (200, 2), (304, None)]
+    assert results[1::2] == [(503, None), (503, None), (200, 1), (304, None), (304, None)]
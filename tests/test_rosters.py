@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, insert
+
+import src.models as models
+from src.cache import rosters
+from src.lease_monitor import Lease, LeaseSnapshot
+from src.rosters import get_group_rosters
+
+
+@pytest_asyncio.fixture
+async def groups(async_session):
+    today = datetime.date(2026, 10, 18)
+    async_session.add_all([
+        models.Group(id=1, name="Hallitus", created_date=today),
+        models.Group(id=2, name="Kerho", created_date=today),
+    ])
+    for i, name in enumerate(["Alex", "Kim", "Sam"], start=1):
+        async_session.add(models.TrackedEntity(
+            id=i, name=name, created_datetime=datetime.datetime(2026, 1, 1),
+            devices=[models.Device(mac_addr=f"02:00:00:00:00:{i:02x}", hostname=name.lower())],
+        ))
+    await async_session.flush()
+    await async_session.execute(insert(models.Membership), [
+        {"tracked_entity_id": 1, "group_id": 1, "joined_date": today},
+        {"tracked_entity_id": 2, "group_id": 1, "joined_date": today},
+        {"tracked_entity_id": 3, "group_id": 1, "joined_date": today},
+        {"tracked_entity_id": 3, "group_id": 2, "joined_date": today},
+    ])
+    await async_session.commit()
+    async_session.expunge_all()
+    rosters.invalidate()
+
+def snapshot_of(*hosts: int) -> LeaseSnapshot:
+    return LeaseSnapshot([Lease(f"10.0.0.{i}", "", f"02:00:00:00:00:{i:02x}") for i in hosts])
+
+@pytest.mark.asyncio
+async def test_rosters_mark_present_members(async_session, groups):
+    result = await get_group_rosters(async_session, snapshot_of(2, 3))
+    assert result[1].present == 2
+    assert [(m.name, m.present) for m in result[1].members] == [("Kim", True), ("Sam", True), ("Alex", False)]
+    assert result[2].present == 1
+
+@pytest.mark.asyncio
+async def test_rosters_take_constant_queries_and_are_cached(async_session, groups):
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(async_session.bind.sync_engine, "before_cursor_execute", listener)
+    try:
+        snapshot = snapshot_of(1)
+        await get_group_rosters(async_session, snapshot)
+        queries = len(statements)
+        assert queries <= 4
+        await get_group_rosters(async_session, snapshot)
+        assert len(statements) == queries
+        result = await get_group_rosters(async_session, snapshot_of(1, 3))
+        assert len(statements) == 2 * queries
+        assert result[2].present == 1
+    finally:
+        event.remove(async_session.bind.sync_engine, "before_cursor_execute", listener)
+
+@pytest.mark.asyncio
+async def test_group_endpoints(async_client, groups):
+    response = await async_client.get("/groups")
+    assert response.status_code == 200
+    assert [group["name"] for group in response.json()] == ["Hallitus", "Kerho"]
+    response = await async_client.get("/groups/2")
+    assert response.json()["members"] == [{"name": "Sam", "present": False}]
+    response = await async_client.get("/groups/3")
+    assert response.status_code == 404
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from src.scheduler import PollScheduler
+
+
+def make_scheduler(job, churn=lambda: 0, **kwargs) -> PollScheduler:
+    return PollScheduler(job, churn, interval=16, min_interval=4, max_interval=64, max_backoff=100, jitter=0, **kwargs)
+
+@pytest.mark.asyncio
+async def test_interval_shrinks_with_churn():
+    scheduler = make_scheduler(AsyncMock(return_value=200), churn=lambda: 3)
+    assert [await scheduler.run_once() for _ in range(3)] == [8, 4, 4]
+
+@pytest.mark.asyncio
+async def test_interval_grows_when_idle():
+    scheduler = make_scheduler(AsyncMock(return_value=304))
+    assert [await scheduler.run_once() for _ in range(3)] == [20, 25, 31.25]
+
+@pytest.mark.asyncio
+async def test_failures_back_off_exponentially():
+    job = AsyncMock(side_effect=[502, RuntimeError("boom"), 502, 200])
+    scheduler = make_scheduler(job)
+    assert [await scheduler.run_once() for _ in range(4)] == [32, 64, 100, 20]
+    assert scheduler.failures == 0
+
+@pytest.mark.asyncio
+async def test_jitter_stays_in_bounds():
+    scheduler = PollScheduler(AsyncMock(return_value=304), lambda: 0, interval=10, max_interval=10, jitter=0.2)
+    for _ in range(20):
+        assert 8 <= await scheduler.run_once() <= 12
+
+@pytest.mark.asyncio
+async def test_runs_never_overlap():
+    running = 0
+    overlaps = 0
+    async def job():
+        nonlocal running, overlaps
+        running += 1
+        overlaps += running > 1
+        await asyncio.sleep(0.01)
+        running -= 1
+        return 200
+    scheduler = PollScheduler(job, lambda: 0, interval=0, min_interval=0, max_interval=0, jitter=0)
+    scheduler.start()
+    await asyncio.sleep(0.1)
+    await scheduler.stop()
+    assert scheduler.runs > 1
+    assert overlaps == 0
+
+@pytest.mark.asyncio
+async def test_start_waits_for_delay():
+    job = AsyncMock(return_value=200)
+    scheduler = make_scheduler(job)
+    scheduler.start(delay=10)
+    await asyncio.sleep(0.01)
+    await scheduler.stop()
+    job.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_default_bounds_follow_base_interval():
+    scheduler = PollScheduler(AsyncMock(return_value=200), lambda: 3, interval=120, jitter=0)
+    assert [await scheduler.run_once() for _ in range(3)] == [60, 40, 40]
+    scheduler = PollScheduler(AsyncMock(return_value=304), lambda: 0, interval=3, jitter=0)
+    for _ in range(20):
+        await scheduler.run_once()
+    assert scheduler.interval == 12
@@ -1,10 +1,16 @@
+import datetime
 import pytest
 import string
 from fastapi.testclient import TestClient
-from src.lease_monitor import Lease
+from src.lease_monitor import Lease, LeaseSnapshot
+from src.main import lease_monitor
 import src.database as database
 import src.models as models
+import src.schemas as schemas
 from sqlalchemy import select
+from unittest.mock import AsyncMock
+import src.crud as crud
+from src.cache import presence_names, identities, invalidate, NameIndex
 
 
 @pytest.mark.asyncio
@@ -33,6 +39,22 @@ async def test_name_form_minor_sanitisation(async_client, async_session):
 
     assert entity.name == "45spoons"
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("username", ["", "A", "!?", " x. "])
+async def test_name_form_rejects_short_name(async_client, async_session, username):
+    response = await async_client.post("/name-form", data={"username": username})
+    assert response.status_code == 400
+    assert await async_session.get(models.TrackedEntity, 1) is None
+
+@pytest.mark.asyncio
+async def test_rename_rejects_short_name(async_client, async_session):
+    response = await async_client.post("/name-form", data={"username": "Alex"})
+    assert response.status_code == 302
+    response = await async_client.post("/name-form", data={"username": "."})
+    assert response.status_code == 400
+    entity = await async_session.get_one(models.TrackedEntity, 1)
+    assert entity.name == "Alex"
+
 @pytest.mark.asyncio
 async def test_name_form_creates_device(async_client, async_session):
     form = {"username": "45spoons"}
@@ -74,3 +96,179 @@ async def test_name_form_changes_name(async_client, async_session):
 
     assert entity.name == "spoons"
     assert device.tracked_entity_id == entity.id
+
+@pytest.mark.asyncio
+async def test_root_caches_present_names(async_client, monkeypatch):
+    get_names = AsyncMock(return_value=["Alex"])
+    monkeypatch.setattr(crud, "get_tracked_entity_names_by_mac_addrs", get_names)
+    for _ in range(3):
+        response = await async_client.get("/")
+        assert response.status_code == 200
+        assert "Alex" in response.text
+    get_names.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_name_form_invalidates_present_names(async_client):
+    await async_client.get("/")
+    generation = presence_names.generation
+    response = await async_client.post("/name-form", data={"username": "Alex"})
+    assert response.status_code == 302
+    assert presence_names.generation > generation
+
+@pytest.mark.asyncio
+async def test_identity_served_from_cache(async_client, async_session):
+    response = await async_client.post("/name-form", data={"username": "Alex"})
+    assert response.status_code == 302
+    response = await async_client.get("/")
+    assert identities.get("11:aa:22:bb:33:cc")
+
+    async_session.expunge_all()
+    device, entity = await crud.get_identity_by_mac_addr(async_session, "11:aa:22:bb:33:cc")
+    assert entity.name == "Alex"
+    assert device.mac_addr == "11:aa:22:bb:33:cc"
+    assert device in entity.devices
+
+@pytest.mark.asyncio
+async def test_identity_cache_cleared_on_rename(async_client):
+    await async_client.post("/name-form", data={"username": "Alex"})
+    await async_client.get("/")
+    await async_client.post("/name-form", data={"username": "Kim"})
+    assert identities.get("11:aa:22:bb:33:cc") is None
+    response = await async_client.get("/")
+    assert "Hei Kim" in response.text
+
+@pytest.mark.asyncio
+async def test_identity_not_cached_across_write(async_client, async_session, monkeypatch):
+    await async_client.post("/name-form", data={"username": "Alex"})
+    execute = async_session.execute
+    async def execute_then_write(*args, **kwargs):
+        result = await execute(*args, **kwargs)
+        # A rename committing while the lookup was in flight
+        invalidate("entities")
+        return result
+    monkeypatch.setattr(async_session, "execute", execute_then_write)
+    _, entity = await crud.get_identity_by_mac_addr(async_session, "11:aa:22:bb:33:cc")
+    assert entity.name == "Alex"
+    assert identities.get("11:aa:22:bb:33:cc") is None
+
+@pytest.mark.asyncio
+async def test_device_lookup_normalises_mac(async_client, async_session):
+    response = await async_client.post("/name-form", data={"username": "Alex"})
+    assert response.status_code == 302
+    device = await crud.get_device_by_mac_addr(async_session, "11-AA-22-BB-33-CC")
+    assert device.mac_addr == "11:aa:22:bb:33:cc"
+    identities.clear()
+    _, entity = await crud.get_identity_by_mac_addr(async_session, "11AA22BB33CC")
+    assert entity.name == "Alex"
+
+@pytest.mark.asyncio
+async def test_root_not_modified(async_client, monkeypatch):
+    response = await async_client.get("/")
+    etag = response.headers["etag"]
+    get_identity = AsyncMock()
+    monkeypatch.setattr(crud, "get_identity_by_mac_addr", get_identity)
+    response = await async_client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+    get_identity.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_root_etag_changes_with_names_and_leases(async_client, mock_leases):
+    etag = (await async_client.get("/")).headers["etag"]
+    await async_client.post("/name-form", data={"username": "Alex"})
+    response = await async_client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "Hei Alex" in response.text
+
+    etag = response.headers["etag"]
+    lease_monitor._snapshot = LeaseSnapshot(mock_leases[:2])
+    response = await async_client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+@pytest.mark.asyncio
+async def test_name_form_links_device_to_existing_name(async_client, async_session):
+    await crud.register_device(async_session, "Alex", schemas.DeviceCreate(mac_addr="1A:2B:3C:4D:5E:6F", hostname="phone"))
+    response = await async_client.post("/name-form", data={"username": "Alex"})
+    assert response.status_code == 302
+
+    db_result = await async_session.execute(select(models.Device).order_by(models.Device.id))
+    devices = db_result.scalars().all()
+    assert [d.mac_addr for d in devices] == ["1a:2b:3c:4d:5e:6f", "11:aa:22:bb:33:cc"]
+    assert devices[0].tracked_entity_id == devices[1].tracked_entity_id
+    db_result = await async_session.execute(select(models.TrackedEntity))
+    assert len(db_result.scalars().all()) == 1
+
+@pytest.mark.asyncio
+async def test_register_device_is_idempotent(async_session):
+    device = schemas.DeviceCreate(mac_addr="11:aa:22:bb:33:cc", hostname="laptop")
+    first = await crud.register_device(async_session, "Alex", device)
+    assert await crud.register_device(async_session, "Alex", device) == first
+    db_result = await async_session.execute(select(models.Device))
+    assert len(db_result.scalars().all()) == 1
+
+@pytest.mark.asyncio
+async def test_name_form_rename_to_taken_name(async_client, async_session):
+    await crud.register_device(async_session, "Kim", schemas.DeviceCreate(mac_addr="1a:2b:3c:4d:5e:6f", hostname="phone"))
+    await async_client.post("/name-form", data={"username": "Alex"})
+    response = await async_client.post("/name-form", data={"username": "Kim"})
+    assert response.status_code == 409
+    response = await async_client.get("/")
+    assert "Hei Alex" in response.text
+
+@pytest.mark.asyncio
+async def test_healthz(async_client):
+    response = await async_client.get("/healthz")
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_readyz_waits_for_startup(async_client, monkeypatch):
+    from src.main import app
+    response = await async_client.get("/readyz")
+    assert response.status_code == 503
+    monkeypatch.setattr(app.state, "ready", True)
+    response = await async_client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json()["leases"] == 3
+
+@pytest.mark.asyncio
+async def test_names_complete_prefix(async_client, async_session):
+    for (name, mac_addr) in (("Kim", "aa:00:00:00:00:01"), ("kimmo", "aa:00:00:00:00:02"), ("Alex", "aa:00:00:00:00:03")):
+        await crud.register_device(async_session, name, schemas.DeviceCreate(mac_addr=mac_addr, hostname="phone"))
+    response = await async_client.get("/names", params={"prefix": "KI"})
+    assert response.json() == ["Kim", "kimmo"]
+    response = await async_client.get("/names", params={"prefix": "ki", "limit": 1})
+    assert response.json() == ["Kim"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("prefix", ["", "k", "k!"])
+async def test_names_need_prefix(async_client, async_session, prefix):
+    await crud.register_device(async_session, "Kim", schemas.DeviceCreate(mac_addr="aa:00:00:00:00:01", hostname="phone"))
+    response = await async_client.get("/names", params={"prefix": prefix})
+    assert response.json() == []
+
+@pytest.mark.asyncio
+async def test_names_follow_creates_and_renames(async_client, async_session):
+    await crud.register_device(async_session, "Kim", schemas.DeviceCreate(mac_addr="aa:00:00:00:00:01", hostname="phone"))
+    assert (await async_client.get("/names", params={"prefix": "ki"})).json() == ["Kim"]
+    await async_client.post("/name-form", data={"username": "Alex"})
+    assert (await async_client.get("/names", params={"prefix": "al"})).json() == ["Alex"]
+    await async_client.post("/name-form", data={"username": "Kimmo"})
+    assert (await async_client.get("/names", params={"prefix": "al"})).json() == []
+    assert (await async_client.get("/names", params={"prefix": "ki"})).json() == ["Kim", "Kimmo"]
+
+@pytest.mark.asyncio
+async def test_name_index_reloads_after_write_elsewhere(async_client, async_session):
+    async_session.add(models.TrackedEntity(name="Kim", created_datetime=datetime.datetime.now()))
+    await async_session.commit()
+    invalidate("entities", broadcast=False)
+    await crud.load_name_index(async_session)
+    assert (await async_client.get("/names", params={"prefix": "ki"})).json() == ["Kim"]
+
+def test_name_index_load_racing_write():
+    index = NameIndex()
+    generation = index.generation
+    index.add("Kim")
+    index.load(["Alex"], generation)
+    assert not index.loaded
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import struct
+import pytest
+import httpx
+from unittest.mock import AsyncMock, MagicMock
+import src.crud as crud
+from src.lease_monitor import Lease, LeaseDiff, LeaseSnapshot
+from src.sinks import PresenceExport, PresenceUpdate, Sink, WebhookSink, JsonlFileSink, MqttSink, parse_sinks
+
+
+class RecordingSink(Sink):
+    def __init__(self, delay: float = 0, fail: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.batches: list[list[int]] = []
+        self._delay = delay
+        self._fail = fail
+
+    async def deliver(self, batch: list[PresenceUpdate]) -> bool:
+        await asyncio.sleep(self._delay)
+        if self._fail:
+            raise RuntimeError("consumer down")
+        self.batches.append([update.generation for update in batch])
+        return True
+
+
+def updates(count: int) -> list[PresenceUpdate]:
+    return [PresenceUpdate(generation, [f"name-{generation}"]) for generation in range(1, count + 1)]
+
+@pytest.mark.asyncio
+async def test_updates_within_window_are_batched():
+    sink = RecordingSink(batch_window=0.05, max_batch=3)
+    await sink.start()
+    for update in updates(4):
+        sink.submit(update)
+    await sink.join()
+    await sink.close()
+    assert sink.batches == [[1, 2, 3], [4]]
+    assert sink.sent == 4
+
+@pytest.mark.asyncio
+async def test_full_queue_drops_oldest():
+    sink = RecordingSink(max_pending=2)
+    for update in updates(3):
+        sink.submit(update)
+    await sink.start()
+    await sink.join()
+    await sink.close()
+    assert sink.batches == [[2, 3]]
+    assert sink.dropped == 1
+
+@pytest.mark.asyncio
+async def test_deliveries_limited_by_concurrency():
+    running = 0
+    most = 0
+    class SlowSink(Sink):
+        async def deliver(self, batch):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return True
+    sink = SlowSink(max_batch=1, concurrency=2)
+    await sink.start()
+    for update in updates(6):
+        sink.submit(update)
+    await sink.join()
+    await sink.close()
+    assert most == 2
+    assert sink.sent == 6
+
+@pytest.mark.asyncio
+async def test_slow_and_failing_sinks_dont_hold_up_others():
+    slow = RecordingSink(delay=10, timeout=0.05, name="slow")
+    failing = RecordingSink(fail=True, name="failing")
+    fast = RecordingSink(name="fast")
+    export = PresenceExport(MagicMock(), [slow, failing, fast])
+    await export.start()
+    for update in updates(2):
+        for sink in export.sinks:
+            sink.submit(update)
+    await asyncio.wait_for(fast.join(), 1)
+    assert fast.sent == 2
+    await asyncio.wait_for(asyncio.gather(slow.join(), failing.join()), 1)
+    await export.close()
+    assert (slow.failed, failing.failed) == (2, 2)
+
+@pytest.mark.asyncio
+async def test_presence_export_reports_joined_and_left(monkeypatch, mock_leases):
+    names = iter([["Alex", "Kim"], ["Kim"], ["Kim"]])
+    monkeypatch.setattr(crud, "get_tracked_entity_names_by_mac_addrs", AsyncMock(side_effect=lambda *args: next(names)))
+    sink = RecordingSink()
+    export = PresenceExport(MagicMock(), [sink])
+    submitted = []
+    monkeypatch.setattr(sink, "submit", submitted.append)
+    for leases in (mock_leases, mock_leases[1:], mock_leases[2:]):
+        snapshot = LeaseSnapshot(leases)
+        await export.publish(LeaseDiff((leases[0],), (), (), snapshot))
+    # The last poll changed devices but not people
+    assert [(update.joined, update.left) for update in submitted] == [(["Alex", "Kim"], []), ([], ["Alex"])]
+
+@pytest.mark.asyncio
+async def test_webhook_posts_batches():
+    requests: list[httpx.Request] = []
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(204)
+    sink = WebhookSink("http://hook.test/presence", transport=httpx.MockTransport(handler), batch_window=0.05)
+    await sink.start()
+    for update in updates(2):
+        sink.submit(update)
+    await sink.join()
+    await sink.close()
+    assert len(requests) == 1
+    body = json.loads(requests[0].content)
+    assert [update["present"] for update in body["updates"]] == [["name-1"], ["name-2"]]
+
+@pytest.mark.asyncio
+async def test_webhook_error_counts_as_failed():
+    sink = WebhookSink("http://hook.test/presence", transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+    await sink.start()
+    sink.submit(updates(1)[0])
+    await sink.join()
+    await sink.close()
+    assert (sink.sent, sink.failed) == (0, 1)
+
+@pytest.mark.asyncio
+async def test_jsonl_file_appends_lines(tmp_path):
+    path = tmp_path / "presence.jsonl"
+    sink = JsonlFileSink(str(path), batch_window=0)
+    await sink.start()
+    for update in updates(3):
+        sink.submit(update)
+        await sink.join()
+    await sink.close()
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["generation"] for line in lines] == [1, 2, 3]
+
+class FakeBroker():
+    """Accepts MQTT connections and acknowledges publishes, recording topic and payload."""
+
+    def __init__(self):
+        self.published: list[tuple[str, bytes, bool]] = []
+        self.connects = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                (length, shift) = (0, 0)
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    length += (digit & 0x7F) << shift
+                    shift += 7
+                    if not digit & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = header >> 4
+                if kind == 1:
+                    self.connects += 1
+                    writer.write(bytes([0x20, 2, 0, 0]))
+                elif kind == 3:
+                    (topic_length,) = struct.unpack("!H", body[:2])
+                    topic = body[2:2 + topic_length].decode()
+                    rest = body[2 + topic_length:]
+                    if (header >> 1) & 3:
+                        writer.write(bytes([0x40, 2]) + rest[:2])
+                        rest = rest[2:]
+                    self.published.append((topic, rest, bool(header & 1)))
+                elif kind == 14:
+                    break
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+@pytest.mark.asyncio
+async def test_mqtt_publishes_to_broker():
+    broker = FakeBroker()
+    server = await asyncio.start_server(broker.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    sink = MqttSink("127.0.0.1", port, topic="linkki/presence", username="seuranta", password="secret")
+    await sink.start()
+    for update in updates(2):
+        sink.submit(update)
+    await sink.join()
+    await sink.close()
+    server.close()
+    await server.wait_closed()
+    assert sink.sent == 2
+    assert broker.connects == 1
+    assert [(topic, json.loads(payload)["present"], retain) for (topic, payload, retain) in broker.published] == [
+        ("linkki/presence", ["name-1"], True), ("linkki/presence", ["name-2"], True)]
+
+@pytest.mark.asyncio
+async def test_mqtt_broker_down_fails_update():
+    server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+    sink = MqttSink("127.0.0.1", port)
+    await sink.start()
+    sink.submit(updates(1)[0])
+    await sink.join()
+    await sink.close()
+    assert sink.failed == 1
+
+def test_parse_sinks():
+    sinks = parse_sinks('[{"type": "webhook", "url": "http://hook.test", "batch_window": 5},'
+                        ' {"type": "jsonl", "path": "presence.jsonl", "name": "log"},'
+                        ' {"type": "mqtt", "host": "broker", "topic": "linkki/presence", "concurrency": 4}]')
+    assert [(type(sink), sink.name) for sink in sinks] == [
+        (WebhookSink, "webhook"), (JsonlFileSink, "log"), (MqttSink, "mqtt")]
+    assert sinks[0]._batch_window == 5
+    assert sinks[2].topic == "linkki/presence"
+
+@pytest.mark.asyncio
+async def test_restart_after_close_mid_delivery():
+    sink = RecordingSink(delay=0.05)
+    await sink.start()
+    sink.submit(updates(1)[0])
+    await asyncio.sleep(0)
+    await sink.close()
+    await sink.start()
+    sink.submit(updates(2)[1])
+    await asyncio.wait_for(sink.join(), 1)
+    await sink.close()
+    assert sink.batches == [[2]]
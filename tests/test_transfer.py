@@ -0,0 +1,85 @@
+import io
+import json
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, select, func
+
+import src.models as models
+import src.transfer as transfer
+from src.cli import main
+
+
+def quiet(label):
+    return transfer.Progress(label, out=None)
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = tmp_path / "legacy.db"
+    with sqlite3.connect(path) as con:
+        con.execute("CREATE TABLE trackedentity (name TEXT, id INTEGER PRIMARY KEY, created TEXT)")
+        con.execute("CREATE TABLE device (hostname TEXT, mac TEXT, trackedentity_id INTEGER)")
+        con.executemany("INSERT INTO trackedentity VALUES (?, ?, ?)", [
+            ("Alex", 1, "2024-01-02T10:00:00"),
+            ("Kim", 2, "2024-02-03T11:00:00"),
+            ("Nobody", 3, "2024-03-04T12:00:00"),
+            ("Alex", 4, "2024-04-05T13:00:00"),
+        ])
+        con.executemany("INSERT INTO device VALUES (?, ?, ?)", [
+            ("laptop", "1A:2B:3C:4D:5E:6F", 1),
+            ("phone", "6f-5e-4d-3c-2b-1a", 2),
+            ("tablet", "11:aa:22:bb:33:cc", 4),
+            ("broken", "not a mac", 2),
+            ("duplicate", "1a:2b:3c:4d:5e:6f", 2),
+        ])
+    return str(path)
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    models.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+def test_import_legacy(legacy_db, engine):
+    counts = transfer.import_legacy(legacy_db, engine, batch_size=2, progress=quiet)
+    assert counts == {"tracked_entities": 2, "devices": 3, "skipped": 1}
+    with engine.connect() as connection:
+        names = connection.execute(select(models.TrackedEntity.name).order_by(models.TrackedEntity.id)).scalars().all()
+        devices = connection.execute(
+            select(models.Device.mac_addr, models.TrackedEntity.name)
+            .join(models.TrackedEntity)
+            .order_by(models.Device.id)
+        ).all()
+    # Entities without devices are dropped, duplicate names merged and duplicate MACs skipped
+    assert names == ["Alex", "Kim"]
+    assert devices == [("1a:2b:3c:4d:5e:6f", "Alex"), ("6f:5e:4d:3c:2b:1a", "Kim"), ("11:aa:22:bb:33:cc", "Alex")]
+
+def test_import_legacy_is_idempotent(legacy_db, engine):
+    transfer.import_legacy(legacy_db, engine, progress=quiet)
+    counts = transfer.import_legacy(legacy_db, engine, progress=quiet)
+    assert counts["devices"] == 0
+    with engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(models.TrackedEntity)).scalar() == 2
+        assert connection.execute(select(func.count()).select_from(models.Device)).scalar() == 3
+
+def test_export_csv_and_jsonl(legacy_db, engine):
+    transfer.import_legacy(legacy_db, engine, progress=quiet)
+    out = io.StringIO()
+    assert transfer.export(engine, "devices", out, "csv", batch_size=2, progress=quiet) == 3
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "id,mac_addr,name,hostname,tracked_entity_id"
+    assert lines[1] == "1,1a:2b:3c:4d:5e:6f,,laptop,1"
+
+    out = io.StringIO()
+    transfer.export(engine, "entities", out, "jsonl", progress=quiet)
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert rows[0] == {"id": 1, "name": "Alex", "created_datetime": "2024-01-02T10:00:00"}
+
+def test_cli(legacy_db, engine, tmp_path, capsys):
+    url = str(engine.url)
+    main(["--database-url", url, "--quiet", "import-legacy", legacy_db])
+    assert "Imported 2 tracked entities and 3 devices" in capsys.readouterr().out
+    output = tmp_path / "entities.jsonl"
+    main(["--database-url", url, "--quiet", "export", "entities", "--format", "jsonl", "-o", str(output)])
+    assert len(output.read_text().splitlines()) == 2
@@ -1,4 +1,5 @@
 import string
+import pytest
 import src.utils as utils
 
 
@@ -25,4 +26,35 @@ def test_sanitise_name_valid_name():
 def test_sanitise_name_remove_punctuation_characters():
     for char in string.punctuation:
         result = utils.sanitise_name(f"al{char}ex")
-        assert result == "alex"
\ No newline at end of file
+        assert result == "alex"
+
+def test_mac_to_int_round_trip():
+    value = utils.mac_to_int("1a:2b:3c:4d:5e:6f")
+    assert value == 0x1a2b3c4d5e6f
+    assert utils.int_to_mac(value) == "1a:2b:3c:4d:5e:6f"
+
+def test_int_to_mac_pads_leading_zeros():
+    assert utils.int_to_mac(0x0000000000ff) == "00:00:00:00:00:ff"
+
+def test_normalise_mac_accepts_other_notations():
+    for mac in ["1A:2B:3C:4D:5E:6F", "1a-2b-3c-4d-5e-6f", "1a2b.3c4d.5e6f", "1a2b3c4d5e6f"]:
+        assert utils.normalise_mac(mac) == "1a:2b:3c:4d:5e:6f"
+
+@pytest.mark.parametrize("mac", ["1a:2b:3c:4d:5e", "zz:2b:3c:4d:5e:6f", ""])
+def test_normalise_mac_rejects_invalid(mac):
+    with pytest.raises(ValueError):
+        utils.normalise_mac(mac)
+
+def test_etag_matches():
+    assert utils.etag_matches('W/"a", "b"', '"b"')
+    assert utils.etag_matches('"a"', 'W/"a"')
+    assert utils.etag_matches("*", '"a"')
+    assert not utils.etag_matches('"ab"', '"a"')
+    assert not utils.etag_matches(None, '"a"')
+
+def test_valid_name_sanitises():
+    assert utils.valid_name(" al ex!") == "alex"
+
+def test_valid_name_rejects_short_name():
+    with pytest.raises(ValueError):
+        utils.valid_name("a.")